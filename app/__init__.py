@@ -59,4 +59,8 @@ if not app.debug:
     app.logger.info('Contabilidad startup')
 
 # Importamos los modelos y las rutas al final para evitar importaciones circulares.
-from app import routes, models
+# database registra el perfil de SQLite antes de que se abra ninguna conexión
+# e instrumentation y metrics los contadores por petición (si están activados).
+# auth registra cómo carga Flask-Login el usuario de la sesión y assets la
+# función asset_url() de las plantillas.
+from app import database, instrumentation, metrics, routes, api, models, auth, assets
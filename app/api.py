@@ -0,0 +1,124 @@
+# app/api.py
+# API JSON de solo lectura para los gráficos y tablas del dashboard y los informes.
+#
+# Cada respuesta lleva un ETag calculado a partir de los sellos de versión
+# del usuario (app/versions.py) de los que dependen sus datos. Si el
+# navegador envía If-None-Match con ese ETag respondemos 304 sin ejecutar
+# ninguna consulta de agregación: comprobar la versión solo lee unos
+# ficheros pequeños.
+import hashlib
+from datetime import datetime
+from functools import wraps
+from flask import Response, jsonify, request
+from flask_login import current_user, login_required
+from app import app, forecast, ledger
+from app.periods import request_period
+from app.routes import transaction_page
+from app.versions import data_version
+
+
+def _etag(*scopes):
+    """Responde 304 si los datos de los que depende la vista no han cambiado.
+
+    La clave incluye la URL completa (periodo, cursor...) y la fecha de hoy,
+    porque "el mes actual" o "los últimos 6 meses" cambian al cambiar el día.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = '|'.join((str(current_user.id), request.full_path,
+                            datetime.utcnow().date().isoformat(),
+                            data_version(current_user.id, *scopes)))
+            etag = hashlib.sha1(key.encode()).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = view(*args, **kwargs)
+            response.set_etag(etag)
+            # El navegador puede guardarla, pero debe preguntar siempre antes de usarla
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+
+def _period_args():
+    """Año y mes de la URL; por defecto, el mes actual."""
+    today = datetime.utcnow()
+    return request_period(today.year, today.month)
+
+
+@app.route('/api/balance')
+@login_required
+@_etag('transactions')
+def api_balance():
+    year, month = _period_args()
+    income, expense = ledger.period_totals(current_user.id, year, month)
+    return jsonify(balance=float(current_user.balance), year=year, month=month,
+                   income=float(income), expense=float(expense), net=float(income + expense))
+
+
+@app.route('/api/expenses_by_category')
+@login_required
+@_etag('transactions', 'categories')
+def api_expenses_by_category():
+    year, month = _period_args()
+    rows = ledger.expenses_by_category(current_user.id, year, month)
+    return jsonify(year=year, month=month,
+                   categories=[{'name': name, 'total': float(total)} for name, total in rows])
+
+
+@app.route('/api/budget_progress')
+@login_required
+@_etag('transactions', 'categories', 'budgets')
+def api_budget_progress():
+    year, month = _period_args()
+    progress = ledger.budget_progress(current_user.id, year, month)
+    return jsonify(year=year, month=month, budgets=[
+        {'category_id': p.category_id, 'name': p.name, 'budget': float(p.budget),
+         'spent': float(p.spent), 'percent': p.percent, 'status': p.status} for p in progress])
+
+
+@app.route('/api/monthly_evolution')
+@login_required
+@_etag('transactions')
+def api_monthly_evolution():
+    months = min(max(request.args.get('months', 6, type=int), 1), 60)
+    rows = ledger.monthly_evolution(current_user.id, months=months)
+    return jsonify(months=[
+        {'year': int(r.year), 'month': int(r.month), 'income': float(r.total_income),
+         'expense': float(r.total_expenses)} for r in rows])
+
+
+@app.route('/api/transactions')
+@login_required
+@_etag('transactions', 'categories')
+def api_transactions():
+    """Movimientos del periodo (year=0 / month=0 para todos), paginados por cursor."""
+    year, month = request_period()
+    rows, next_cursor = transaction_page(current_user.id, year, month, cursor=request.args.get('cursor'),
+                                         per_page=app.config['TRANSACTIONS_PER_PAGE'])
+    return jsonify(next_cursor=next_cursor, transactions=[
+        {'id': t.id, 'date': t.date.isoformat(), 'description': t.description,
+         'amount': float(t.amount), 'category': t.category_name} for t in rows])
+
+
+@app.route('/api/forecast')
+@login_required
+@_etag('transactions', 'recurring', 'budgets', 'categories')
+def api_forecast():
+    """Saldo previsto día a día (months: uno de forecast.HORIZONS)."""
+    months = request.args.get('months', 12, type=int)
+    if months not in forecast.HORIZONS:
+        months = 12
+    result = forecast.user_forecast(current_user.id, months)
+    return jsonify(
+        start=result.start.isoformat(), end=result.end.isoformat(),
+        opening_balance=float(result.opening_balance),
+        lowest={'date': result.lowest[0].isoformat(), 'balance': float(result.lowest[1])},
+        negative=[{'start': n.start.isoformat(), 'end': n.end.isoformat(), 'lowest': float(n.lowest)}
+                  for n in result.negative],
+        budget_alerts=[{'date': a.date.isoformat(), 'category_id': a.category_id, 'budget': float(a.budget),
+                        'projected': float(a.projected)} for a in result.budget_alerts],
+        days=[{'date': d.date.isoformat(), 'income': float(d.income), 'expense': float(d.expense),
+               'balance': float(d.balance), 'over_budget': list(d.over_budget)} for d in result.days])
@@ -0,0 +1,310 @@
+# app/archive.py
+# Archivo de los movimientos de años cerrados en ficheros SQLite por año.
+#
+# La tabla "transaction" de app.db solo debería contener los movimientos que
+# se consultan a diario. 'flask archive --before AÑO' mueve los de los años
+# anteriores a ARCHIVE_DIR/transactions-AÑO.db (uno por año). Los saldos, el
+# resumen mensual (MonthlyRollup) y el historial de categorías no cambian:
+# siguen en app.db y cubren todos los años.
+#
+# Para leer un año archivado, su fichero se adjunta (ATTACH) en modo solo
+# lectura a la conexión como archive_AÑO, solo cuando el periodo pedido
+# llega a ese año, y se une (UNION ALL) con la tabla caliente. El dashboard
+# y el mes actual no lo necesitan nunca y solo leen la tabla caliente.
+#
+# La búsqueda de texto (FTS5) solo cubre la tabla caliente.
+#
+# 'flask backup' copia también estos ficheros (ver app/backups.py); lock()
+# impide que una copia vea un archivado a medias.
+import fcntl
+import os
+import re
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import (Column, Date, DateTime, Integer, MetaData, Numeric, String, Table, Index,
+                        false, func, insert, select, text, true, tuple_, union_all)
+from app import app, db
+from app.models import Category, Transaction
+from app.pagination import decode_cursor, keyset_page
+from app.periods import period_filters
+from app.versions import bump_version
+
+_FILE_NAME = re.compile(r'^transactions-(\d{4})\.db$')
+# SQLite admite como mucho 10 bases de datos adjuntas por conexión
+MAX_ATTACHED = 10
+
+_transaction = Transaction.__table__
+_tables = {}
+
+
+class ArchiveError(Exception):
+    """Operación de archivo que no se puede hacer."""
+
+
+def archive_path(year):
+    return os.path.join(app.config['ARCHIVE_DIR'], f'transactions-{year}.db')
+
+
+@contextmanager
+def lock():
+    """Bloqueo entre procesos: mientras se archiva, no se copia ni se
+    restaura ARCHIVE_DIR, y al revés."""
+    os.makedirs(app.config['ARCHIVE_DIR'], exist_ok=True)
+    with open(os.path.join(app.config['ARCHIVE_DIR'], '.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def archived_years():
+    """Años con fichero de archivo, de más antiguo a más reciente."""
+    try:
+        names = os.listdir(app.config['ARCHIVE_DIR'])
+    except FileNotFoundError:
+        return []
+    return sorted(int(match.group(1)) for match in map(_FILE_NAME.match, names) if match)
+
+
+def _schema(year):
+    return f'archive_{year}'
+
+
+def archive_table(year):
+    """Tabla "transaction" del archivo de un año (mismas columnas que la caliente)."""
+    table = _tables.get(year)
+    if table is None:
+        table = Table(
+            'transaction', MetaData(),
+            Column('id', Integer, primary_key=True),
+            Column('description', String(140)),
+            Column('amount', Numeric(10, 2), nullable=False),
+            Column('date', DateTime),
+            Column('category_id', Integer),
+            Column('user_id', Integer),
+            Column('recurring_id', Integer),
+            Column('occurrence_date', Date),
+            Column('import_hash', String(40)),
+            Index(f'ix_archive_{year}_user_id_date', 'user_id', 'date'),
+            Index(f'ix_archive_{year}_user_id_import_hash', 'user_id', 'import_hash'),
+            schema=_schema(year))
+        _tables[year] = table
+    return table
+
+
+def attach(years, writable=False, connection=None):
+    """Adjunta a la conexión (por defecto, la de la sesión) los archivos de
+    esos años que aún no lo estén (las conexiones del pool los conservan adjuntos)."""
+    connection = connection or db.session.connection()
+    attached = {row[1] for row in connection.exec_driver_sql('PRAGMA database_list')} - {'main', 'temp'}
+    if writable:
+        # Puede estar adjunto en solo lectura (p. ej. por archived_hashes): se
+        # vuelve a adjuntar con escritura
+        detach([year for year in years if _schema(year) in attached], connection)
+        attached -= {_schema(year) for year in years}
+    missing = [year for year in years if _schema(year) not in attached]
+    if len(attached) + len(missing) > MAX_ATTACHED:
+        raise ArchiveError(f'No se pueden adjuntar más de {MAX_ATTACHED} años archivados a la vez.')
+    for year in missing:
+        path = os.path.abspath(archive_path(year))
+        # mode=ro: ninguna consulta de la aplicación puede escribir en el archivo
+        uri = path if writable else f'file:{path}?mode=ro'
+        connection.exec_driver_sql(f'ATTACH DATABASE ? AS {_schema(year)}', (uri,))
+
+
+def detach(years, connection=None):
+    """Quita de la conexión los archivos de esos años (que deben estar adjuntos)."""
+    connection = connection or db.session.connection()
+    for year in years:
+        connection.exec_driver_sql(f'DETACH DATABASE {_schema(year)}')
+
+
+def period_years(year=0):
+    """Años archivados a los que llega el periodo (0 = todos los años)."""
+    years = archived_years()
+    if year:
+        return [year] if year in years else []
+    return years
+
+
+def tables_for_period(year=0):
+    """Tablas con movimientos del periodo: la caliente y, si hace falta, las
+    de los años archivados (ya adjuntadas)."""
+    years = period_years(year)
+    if not years:
+        return [_transaction]
+    attach(years)
+    return [_transaction] + [archive_table(y) for y in years]
+
+
+def all_transactions():
+    """Todos los movimientos, calientes y archivados (para recalcular saldos y
+    el resumen mensual). Sin archivos es la tabla caliente tal cual."""
+    tables = tables_for_period()
+    if len(tables) == 1:
+        return _transaction
+    columns = ('id', 'amount', 'date', 'category_id', 'user_id')
+    return union_all(*[select(*(t.c[name] for name in columns)) for t in tables]).subquery('transaction_all')
+
+
+def feed_page(user_id, year=0, month=0, cursor=None, per_page=50):
+    """Como keyset_page sobre las columnas de los listados, uniendo la tabla
+    caliente y los años archivados del periodo.
+
+    Cada parte aplica el cursor y el LIMIT por su índice (user_id, date)
+    antes de unirse, así que una página cuesta lo mismo con un año que con
+    diez. Las filas archivadas llevan archived=True (no se pueden editar).
+    """
+    position = decode_cursor(cursor)
+    parts = []
+    for table in tables_for_period(year):
+        part = select(table.c.id, table.c.date, table.c.description, table.c.amount, table.c.category_id,
+                      (false() if table is _transaction else true()).label('archived')).where(
+            table.c.user_id == user_id, *period_filters(table.c.date, year, month))
+        if position is not None:
+            part = part.where(tuple_(table.c.date, table.c.id) < tuple_(*position))
+        parts.append(part.order_by(table.c.date.desc(), table.c.id.desc()).limit(per_page + 1).subquery())
+    rows = union_all(*[select(part) for part in parts]).subquery('feed')
+    query = db.session.query(
+        rows.c.id, rows.c.date, rows.c.description, rows.c.amount,
+        Category.name.label('category_name'), rows.c.archived
+    ).outerjoin(Category, rows.c.category_id == Category.id)
+    return keyset_page(query, rows.c.date, rows.c.id, per_page=per_page)
+
+
+def archived_hashes(user_id, hashes):
+    """Hashes de importación de la lista que están en algún año archivado."""
+    years = archived_years()
+    if not hashes or not years:
+        return set()
+    attach(years)
+    found = set()
+    for year in years:
+        table = archive_table(year)
+        found.update(db.session.scalars(select(table.c.import_hash).where(
+            table.c.user_id == user_id, table.c.import_hash.in_(hashes))))
+    return found
+
+
+# --- Archivado ---
+
+def _months(year):
+    for month in range(1, 13):
+        yield month, datetime(year, month, 1), datetime(year + (month == 12), month % 12 + 1, 1)
+
+
+def _same_row(columns):
+    """SQL: la fila t de la tabla caliente y su copia a en el archivo coinciden."""
+    return ' AND '.join(f'a.{name} IS t.{name}' for name in columns)
+
+
+def archive_year(year, log=None):
+    """Mueve a su fichero los movimientos de un año, mes a mes (un commit por
+    paso, para no bloquear a los escritores mucho tiempo). Devuelve cuántos
+    ha movido. Se puede repetir: lo que ya estaba archivado no se duplica.
+
+    Va por una conexión propia: la tabla temporal con los ids copiados en
+    cada mes tiene que seguir ahí en el paso siguiente.
+    """
+    os.makedirs(app.config['ARCHIVE_DIR'], exist_ok=True)
+    db.session.commit()
+    with db.engine.connect() as connection:
+        attach([year], writable=True, connection=connection)
+        try:
+            moved = _archive_months(connection, year, log)
+        finally:
+            # La conexión vuelve al pool: las consultas lo adjuntarán en solo lectura
+            connection.rollback()
+            detach([year], connection)
+    return moved
+
+
+def _archive_months(connection, year, log):
+    """Los pasos de archive_year, sobre su conexión."""
+    table = archive_table(year)
+    columns = [c.name for c in table.columns]
+    archived_table = f'{_schema(year)}."transaction"'
+    moved = 0
+    table.create(connection, checkfirst=True)
+    connection.exec_driver_sql('CREATE TEMP TABLE IF NOT EXISTS archive_copied (id INTEGER PRIMARY KEY)')
+    connection.commit()
+
+    for month, start, end in _months(year):
+        period = {'start': start, 'end': end}
+        users = connection.scalars(select(_transaction.c.user_id).where(
+            _transaction.c.date >= start, _transaction.c.date < end).distinct()).all()
+        if not users:
+            continue
+        # 0. Un id que ya está en el archivo solo puede ser el mismo
+        #    movimiento, copiado por una ejecución interrumpida. Si no lo es
+        #    (ids reutilizados antes de que "transaction" tuviera
+        #    AUTOINCREMENT), no se toca nada: se perdería uno de los dos.
+        conflicts = connection.scalars(text(f"""
+            SELECT t.id FROM "transaction" t JOIN {archived_table} a ON a.id = t.id
+            WHERE t.date >= :start AND t.date < :end
+              AND NOT ({_same_row(('user_id', 'date', 'amount'))})
+        """), period).all()
+        if conflicts:
+            raise ArchiveError(f'{year}-{month:02d}: movimientos con el mismo id en la tabla caliente y '
+                               f'en el archivo ({", ".join(map(str, conflicts[:10]))}). No se ha archivado.')
+
+        # 1. Copia al archivo, en su propia transacción: si el proceso muere
+        #    después, las filas siguen en la tabla caliente y repetir no
+        #    duplica (REPLACE: la copia de una ejecución interrumpida se
+        #    actualiza). archive_copied guarda qué filas se han copiado.
+        connection.exec_driver_sql('DELETE FROM archive_copied')
+        connection.execute(text("""
+            INSERT INTO archive_copied SELECT id FROM "transaction" WHERE date >= :start AND date < :end
+        """), period)
+        connection.execute(insert(table).prefix_with('OR REPLACE').from_select(
+            columns, select(*(_transaction.c[name] for name in columns)).where(
+                _transaction.c.id.in_(text('SELECT id FROM archive_copied')))))
+        connection.commit()
+
+        # 2. Borrado de la tabla caliente, solo de las filas copiadas en el
+        #    paso 1 que el archivo tiene idénticas. La primera escritura (el
+        #    historial) bloquea a los demás escritores hasta el commit.
+        #    Los triggers restan esas filas del historial de categorías, que
+        #    debe seguir contándolas: antes se vuelven a sumar.
+        copied = (f't.id IN (SELECT id FROM archive_copied) AND EXISTS ('
+                  f'SELECT 1 FROM {archived_table} a WHERE a.id = t.id AND {_same_row(columns)})')
+        connection.execute(text(f"""
+            INSERT INTO category_history (user_id, description, category_id, count)
+            SELECT user_id, coalesce(description, ''), category_id, count(*) FROM "transaction" t
+            WHERE {copied} AND user_id IS NOT NULL AND category_id IS NOT NULL
+            GROUP BY user_id, coalesce(description, ''), category_id
+            ON CONFLICT (user_id, description, category_id) DO UPDATE SET count = count + excluded.count
+        """))
+        count = connection.execute(text(f'DELETE FROM "transaction" AS t WHERE {copied}')).rowcount
+        # Las editadas entre la copia y el borrado siguen en la tabla
+        # caliente: su copia se quita para no contarlas dos veces, y se
+        # archivarán la próxima vez
+        connection.execute(text(f"""
+            DELETE FROM {archived_table} AS a WHERE a.id IN (SELECT id FROM archive_copied)
+              AND EXISTS (SELECT 1 FROM "transaction" t WHERE t.id = a.id)
+        """))
+        connection.commit()
+        for user_id in users:
+            bump_version(user_id, 'transactions')
+        moved += count
+        if log:
+            log(f'{year}-{month:02d}: {count} movimientos archivados.')
+    connection.exec_driver_sql('DROP TABLE archive_copied')
+    return moved
+
+
+def archive_before(before, log=None):
+    """Archiva todos los años anteriores a before. Devuelve {año: movidos}."""
+    if before > datetime.utcnow().year:
+        raise ArchiveError('Solo se pueden archivar años cerrados.')
+    first = db.session.execute(select(func.min(_transaction.c.date))).scalar()
+    if first is None:
+        return {}
+    years = [year for year in range(first.year, before) if db.session.execute(
+        select(_transaction.c.id).where(_transaction.c.date >= datetime(year, 1, 1),
+                                        _transaction.c.date < datetime(year + 1, 1, 1)).limit(1)).first()]
+    if len(set(archived_years()) | set(years)) > MAX_ATTACHED:
+        raise ArchiveError(f'Como mucho se pueden tener {MAX_ATTACHED} años archivados.')
+    with lock():
+        return {year: archive_year(year, log) for year in years}
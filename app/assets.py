@@ -0,0 +1,182 @@
+# app/assets.py
+# Ficheros estáticos con huella y precomprimidos.
+#
+# 'flask assets build' copia app/static a ASSETS_DIR con el hash del
+# contenido en el nombre (css/style.css -> css/style.1a2b3c4d5e.css), junto
+# con sus versiones comprimidas (.gz y .br, o .zz con zlib si no está
+# instalado el paquete brotli), y escribe un manifiesto con la
+# correspondencia. Las plantillas enlazan los ficheros con asset_url(), que
+# da la URL con huella si existe el manifiesto y la de /static si no.
+#
+# Como el nombre cambia con el contenido, las respuestas de /assets se
+# pueden guardar un año sin volver a preguntar (immutable), y se sirve ya
+# comprimida la variante que acepte el navegador: cada visita no cuesta ni
+# una petición ni una compresión.
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import zlib
+from flask import abort, request, send_file, url_for
+from app import app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = 'assets-manifest.json'
+# Tipos que merece la pena comprimir (las imágenes PNG ya lo están)
+COMPRESSIBLE = {'.css', '.js', '.json', '.svg', '.txt', '.html', '.map', '.ico'}
+# Una variante comprimida solo se guarda si ahorra al menos esto
+MIN_SAVING = 0.1
+HASH_LENGTH = 10
+ONE_YEAR = 365 * 24 * 3600
+
+# Content-Encoding de cada variante, en orden de preferencia
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'), ('deflate', '.zz'))
+
+_manifest = {'mtime': None, 'files': {}, 'by_file': {}}
+
+
+def _compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11)
+    if encoding == 'gzip':
+        # mtime=0: el mismo contenido da siempre el mismo .gz
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    return zlib.compress(data, 9)
+
+
+def _hashed_name(relative_path, data):
+    root, extension = os.path.splitext(relative_path)
+    digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+    return f'{root}.{digest}{extension}'
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as target:
+        target.write(data)
+    os.replace(tmp_path, path)
+
+
+def load_manifest(directory=None):
+    try:
+        with open(os.path.join(directory or app.config['ASSETS_DIR'], MANIFEST)) as manifest:
+            return json.load(manifest)
+    except FileNotFoundError:
+        return {'files': {}, 'previous': {}}
+
+
+def _served_files(files):
+    """Todos los ficheros de un manifiesto (con huella y sus variantes)."""
+    names = set()
+    for entry in files.values():
+        names.add(entry['file'])
+        names.update(entry['encodings'].values())
+    return names
+
+
+def build(source=None, target=None, log=None):
+    """Genera ASSETS_DIR a partir de app/static. Devuelve el manifiesto.
+
+    Se conservan los ficheros de la compilación anterior (las páginas ya
+    servidas pueden seguir pidiéndolos) y se borran los más antiguos.
+    """
+    source = source or app.static_folder
+    target = target or app.config['ASSETS_DIR']
+    # deflate solo hace falta si no hay brotli
+    encodings = [e for e in ENCODINGS if e[0] != ('deflate' if brotli is not None else 'br')]
+
+    previous = load_manifest(target)['files']
+    files = {}
+    for directory, _, names in os.walk(source):
+        for name in sorted(names):
+            path = os.path.join(directory, name)
+            relative_path = os.path.relpath(path, source).replace(os.sep, '/')
+            with open(path, 'rb') as asset:
+                data = asset.read()
+            hashed = _hashed_name(relative_path, data)
+            entry = {'file': hashed, 'size': len(data), 'encodings': {}}
+            if not os.path.exists(os.path.join(target, hashed)):
+                _write(os.path.join(target, hashed), data)
+            if os.path.splitext(name)[1].lower() in COMPRESSIBLE:
+                for encoding, suffix in encodings:
+                    compressed = _compress(data, encoding)
+                    if len(compressed) <= len(data) * (1 - MIN_SAVING):
+                        _write(os.path.join(target, hashed + suffix), compressed)
+                        entry['encodings'][encoding] = hashed + suffix
+                        entry[f'{encoding}_size'] = len(compressed)
+            files[relative_path] = entry
+            if log:
+                sizes = ', '.join(f"{encoding} {entry[f'{encoding}_size']}" for encoding in entry['encodings'])
+                log(f"{relative_path} -> {hashed} ({len(data)} bytes{', ' + sizes if sizes else ''})")
+
+    keep = _served_files(files) | _served_files(previous) | {MANIFEST}
+    for directory, _, names in os.walk(target):
+        for name in names:
+            relative_path = os.path.relpath(os.path.join(directory, name), target).replace(os.sep, '/')
+            if relative_path not in keep:
+                os.remove(os.path.join(directory, name))
+
+    # La compilación anterior sigue en el manifiesto para poder servirla
+    manifest = {'files': files, 'previous': {
+        name: entry for name, entry in previous.items() if files.get(name, {}).get('file') != entry['file']}}
+    _write(os.path.join(target, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+
+def _current_manifest():
+    """Manifiesto en uso; se vuelve a leer si 'flask assets build' lo cambia."""
+    try:
+        mtime = os.stat(os.path.join(app.config['ASSETS_DIR'], MANIFEST)).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if mtime != _manifest['mtime']:
+        manifest = load_manifest() if mtime is not None else {'files': {}}
+        by_file = {e['file']: e for e in manifest.get('previous', {}).values()}
+        by_file.update((e['file'], e) for e in manifest['files'].values())
+        _manifest.update(mtime=mtime, files=manifest['files'], by_file=by_file)
+    return _manifest
+
+
+@app.template_global()
+def asset_url(filename):
+    """Como url_for('static', filename=...), pero con la huella si está compilado."""
+    entry = _current_manifest()['files'].get(filename)
+    if entry is None:
+        return url_for('static', filename=filename)
+    return url_for('asset', filename=entry['file'])
+
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    # Solo ficheros del manifiesto: nada de rutas arbitrarias dentro de ASSETS_DIR
+    entry = _current_manifest()['by_file'].get(filename)
+    if entry is None:
+        abort(404)
+    path, encoding = filename, None
+    for name, _ in ENCODINGS:
+        if name in entry['encodings'] and request.accept_encodings[name]:
+            path, encoding = entry['encodings'][name], name
+            break
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response = send_file(os.path.join(app.config['ASSETS_DIR'], path), mimetype=mimetype,
+                         conditional=True, etag=True, max_age=ONE_YEAR)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if entry['encodings']:
+        response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def clean(target=None):
+    """Borra ASSETS_DIR: las plantillas vuelven a usar /static."""
+    shutil.rmtree(target or app.config['ASSETS_DIR'], ignore_errors=True)
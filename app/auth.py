@@ -0,0 +1,75 @@
+# app/auth.py
+# Usuario de la sesión sin consultar la base de datos en cada petición.
+#
+# Flask-Login llama a load_user en cada petición autenticada. En vez de
+# cargar el User completo, cada proceso guarda un registro ligero (id,
+# nombre y huella de la contraseña) durante USER_CACHE_TTL segundos o hasta
+# que cambia el sello 'auth' del usuario, que se renueva al cambiar la
+# contraseña (ver app/versions.py).
+#
+# El identificador que se guarda en la sesión y en la cookie "recordarme"
+# lleva la huella de la contraseña (User.get_id): tras un cambio de
+# contraseña ya no coincide y esas sesiones se cierran en todos los procesos.
+#
+# current_user es un SessionUser. Las rutas que necesitan el objeto del ORM
+# (comprobar o cambiar la contraseña, relaciones) lo piden con
+# current_user.model, que lo carga en ese momento.
+import hmac
+from collections import namedtuple
+from flask_login import UserMixin
+from sqlalchemy import select
+from app import app, db, login_manager
+from app.models import User, password_token
+from app.versions import VersionedCache, get_version
+
+UserRecord = namedtuple('UserRecord', 'id username token')
+
+_cache = VersionedCache(max_entries=app.config['USER_CACHE_SIZE'], max_age=app.config['USER_CACHE_TTL'])
+
+
+class SessionUser(UserMixin):
+    """El usuario autenticado de la petición, sin pasar por el ORM."""
+
+    def __init__(self, record):
+        self.id = record.id
+        self.username = record.username
+        self._token = record.token
+        self._model = None
+
+    def get_id(self):
+        return f'{self.id}:{self._token}'
+
+    @property
+    def model(self):
+        """El User del ORM (una consulta, solo la primera vez en la petición)."""
+        if self._model is None:
+            self._model = db.session.get(User, self.id)
+        return self._model
+
+    @property
+    def balance(self):
+        # El saldo cambia con cada movimiento: no se guarda en la caché
+        if self._model is not None:
+            return self._model.balance
+        return db.session.execute(select(User.balance).where(User.id == self.id)).scalar()
+
+
+def _load(user_id):
+    row = db.session.execute(
+        select(User.id, User.username, User.password_hash).where(User.id == user_id)).first()
+    if row is None:
+        return None
+    return UserRecord(row.id, row.username, password_token(row.password_hash))
+
+
+@login_manager.user_loader
+def load_user(session_id):
+    user_id, _, token = session_id.partition(':')
+    # Las sesiones sin huella (anteriores a este esquema) no valen
+    if not user_id.isdigit() or not token:
+        return None
+    user_id = int(user_id)
+    record = _cache.get_or_load(user_id, get_version(user_id, 'auth'), lambda: _load(user_id))
+    if record is None or not hmac.compare_digest(record.token, token):
+        return None
+    return SessionUser(record)
@@ -0,0 +1,362 @@
+# app/backups.py
+# Copias de seguridad en caliente de la base de datos SQLite.
+#
+# - La copia se hace con la API de backup de SQLite por bloques de páginas,
+#   con una pausa entre bloques: nunca bloquea a los escritores (con WAL
+#   solo mantiene una transacción de lectura) y no satura el disco.
+# - La copia se comprueba con PRAGMA integrity_check antes de darla por
+#   buena y se comprime en streaming (gzip) sin cargarla en memoria.
+# - Cada copia queda anotada en un manifiesto (manifest.json) con su tamaño,
+#   sus sumas SHA-256 (comprimida y sin comprimir) y la revisión de Alembic,
+#   y se rotan las antiguas: las últimas BACKUP_KEEP más la primera de cada
+#   uno de los últimos BACKUP_KEEP_MONTHLY meses.
+# - restore() valida la copia (suma, integridad, esquema) antes de volcarla
+#   sobre la base de datos en uso, también con la API de backup: los demás
+#   procesos ven la base de datos anterior o la restaurada, nunca una mezcla.
+# - Los años archivados (ARCHIVE_DIR, ver app/archive.py) van en la misma
+#   copia, un fichero comprimido por año anotado en la entrada del
+#   manifiesto: app.db sin sus años archivados, o con los de otro momento,
+#   daría saldos que no cuadran con los movimientos.
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from contextlib import closing
+from datetime import datetime
+from app import app, archive, db
+from app.versions import SCOPES, bump_version
+
+MANIFEST = 'manifest.json'
+SNAPSHOT_PREFIX = 'contabilidad-'
+SNAPSHOT_SUFFIX = '.db.gz'
+# Trozos en los que se comprime y se calculan las sumas
+CHUNK_SIZE = 1024 * 1024
+
+
+class BackupError(Exception):
+    """Copia que no se puede hacer, verificar o restaurar."""
+
+
+def database_path():
+    """Ruta del fichero de la base de datos (solo SQLite)."""
+    url = db.engine.url
+    if url.get_backend_name() != 'sqlite' or not url.database or url.database == ':memory:':
+        raise BackupError('Las copias solo están disponibles para bases de datos SQLite en fichero.')
+    return os.path.abspath(url.database)
+
+
+def _connect(path):
+    connection = sqlite3.connect(path)
+    connection.execute(f"PRAGMA busy_timeout = {int(app.config['SQLITE_BUSY_TIMEOUT'])}")
+    return connection
+
+
+def _copy(source, target, pages, pause, max_restarts, log=None):
+    """Copia source en target por bloques de pages páginas, con pause
+    segundos entre bloques.
+
+    Si otro proceso escribe durante la copia, SQLite la reinicia. Tras
+    max_restarts reinicios se termina de un solo paso: con WAL eso solo
+    mantiene una lectura abierta, así que tampoco bloquea a los escritores.
+    """
+    state = {'remaining': None, 'restarts': 0}
+
+    def progress(status, remaining, total):
+        if state['remaining'] is not None and remaining > state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] > max_restarts:
+                raise InterruptedError
+        state['remaining'] = remaining
+        if remaining:
+            time.sleep(pause)
+
+    try:
+        source.backup(target, pages=pages, progress=progress)
+    except InterruptedError:
+        if log:
+            log(f"La base de datos ha cambiado {max_restarts} veces durante la copia; se termina de un solo paso.")
+        source.backup(target, pages=-1)
+    return state['restarts']
+
+
+def _check_integrity(connection):
+    result = [row[0] for row in connection.execute('PRAGMA integrity_check')]
+    if result != ['ok']:
+        raise BackupError('La copia no supera PRAGMA integrity_check: ' + '; '.join(result[:5]))
+
+
+def _check(connection):
+    """Lanza BackupError si la base de datos no está íntegra o no tiene esquema."""
+    _check_integrity(connection)
+    try:
+        revision = connection.execute('SELECT version_num FROM alembic_version').fetchone()
+    except sqlite3.DatabaseError:
+        revision = None
+    if revision is None:
+        raise BackupError('La copia no tiene tabla alembic_version: no es una base de datos de la aplicación.')
+    return revision[0]
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _compress(source_path, target_path):
+    """Comprime en streaming; devuelve el SHA-256 del fichero sin comprimir."""
+    digest = hashlib.sha256()
+    with open(source_path, 'rb') as source, gzip.open(target_path, 'wb', compresslevel=6) as target:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            target.write(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as manifest:
+            return json.load(manifest)
+    except FileNotFoundError:
+        return {'snapshots': []}
+
+
+def _save_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as target:
+        json.dump(manifest, target, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _rotate(directory, manifest, keep, keep_monthly, log=None):
+    """Deja las keep copias más recientes y la primera de cada uno de los
+    últimos keep_monthly meses; borra las demás."""
+    snapshots = sorted(manifest['snapshots'], key=lambda s: s['created_at'], reverse=True)
+    kept = {s['file'] for s in snapshots[:keep]}
+    first_of_month = {}
+    for snapshot in snapshots:
+        first_of_month[snapshot['created_at'][:7]] = snapshot['file']
+    for month in sorted(first_of_month, reverse=True)[:keep_monthly]:
+        kept.add(first_of_month[month])
+
+    manifest['snapshots'] = [s for s in snapshots if s['file'] in kept]
+    for snapshot in snapshots:
+        if snapshot['file'] not in kept:
+            for name in [snapshot['file']] + [a['file'] for a in snapshot.get('archives', ())]:
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+            if log:
+                log(f"Copia antigua eliminada: {snapshot['file']}")
+
+
+def _snapshot(source_path, directory, name, check, log=None):
+    """Copia source_path (con la API de backup), la comprueba con check y la
+    guarda comprimida como directory/name. Devuelve (datos para el
+    manifiesto, lo que devuelve check)."""
+    config = app.config
+    # La copia sin comprimir va junto a las demás, no en /tmp, que puede ser pequeño
+    fd, copy_path = tempfile.mkstemp(prefix='.backup-', suffix='.db', dir=directory)
+    os.close(fd)
+    compressed_path = os.path.join(directory, f'.{name}.part')
+    try:
+        with closing(_connect(source_path)) as source, closing(sqlite3.connect(copy_path)) as target:
+            restarts = _copy(source, target, config['BACKUP_PAGES_PER_STEP'], config['BACKUP_STEP_SLEEP'],
+                             config['BACKUP_MAX_RESTARTS'], log)
+            checked = check(target)
+        db_sha256 = _compress(copy_path, compressed_path)
+        db_size = os.path.getsize(copy_path)
+        os.replace(compressed_path, os.path.join(directory, name))
+    finally:
+        for path in (copy_path, compressed_path):
+            if os.path.exists(path):
+                os.remove(path)
+    return {
+        'file': name,
+        'size': os.path.getsize(os.path.join(directory, name)),
+        'sha256': _sha256(os.path.join(directory, name)),
+        'db_size': db_size,
+        'db_sha256': db_sha256,
+        'restarts': restarts,
+    }, checked
+
+
+def backup(directory=None, keep=None, keep_monthly=None, log=None):
+    """Hace una copia verificada y comprimida en directory (la base de datos
+    y sus años archivados). Devuelve su entrada del manifiesto."""
+    config = app.config
+    directory = directory or config['BACKUP_DIR']
+    keep = config['BACKUP_KEEP'] if keep is None else keep
+    keep_monthly = config['BACKUP_KEEP_MONTHLY'] if keep_monthly is None else keep_monthly
+    os.makedirs(directory, exist_ok=True)
+    source_path = database_path()
+
+    started = time.perf_counter()
+    created_at = datetime.utcnow()
+    stem = f"{SNAPSHOT_PREFIX}{created_at.strftime('%Y%m%d-%H%M%S')}"
+    name = stem + SNAPSHOT_SUFFIX
+    written = []
+    try:
+        # Sin archivados a medias: los movimientos de un mes estarían en los
+        # dos sitios o en ninguno
+        with archive.lock():
+            snapshot, revision = _snapshot(source_path, directory, name, _check, log)
+            written.append(name)
+            archives = []
+            for year in archive.archived_years():
+                entry, _ = _snapshot(archive.archive_path(year), directory,
+                                     f'{stem}.archive-{year}{SNAPSHOT_SUFFIX}', _check_integrity, log)
+                written.append(entry['file'])
+                del entry['restarts']
+                archives.append(dict(entry, year=year))
+    except BaseException:
+        for written_name in written:
+            os.remove(os.path.join(directory, written_name))
+        raise
+
+    entry = dict(snapshot, created_at=created_at.isoformat(timespec='seconds'), source=source_path,
+                 revision=revision, integrity='ok', archives=archives,
+                 seconds=round(time.perf_counter() - started, 2))
+    manifest = load_manifest(directory)
+    manifest['snapshots'] = [s for s in manifest['snapshots'] if s['file'] != name] + [entry]
+    _rotate(directory, manifest, keep, keep_monthly, log)
+    _save_manifest(directory, manifest)
+    return entry
+
+
+def _manifest_entry(path):
+    directory, name = os.path.split(os.path.abspath(path))
+    for snapshot in load_manifest(directory)['snapshots']:
+        if snapshot['file'] == name:
+            return snapshot
+    return None
+
+
+def _unpack(path, db_sha256, directory, check):
+    """Descomprime path en un temporal de directory y lo comprueba (suma sin
+    comprimir si se conoce, y check). Devuelve (ruta del temporal, check)."""
+    fd, copy_path = tempfile.mkstemp(prefix='.restore-', suffix='.db', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as target:
+            if path.endswith('.gz'):
+                try:
+                    with gzip.open(path, 'rb') as source:
+                        shutil.copyfileobj(source, target, CHUNK_SIZE)
+                except (OSError, EOFError) as error:
+                    raise BackupError(f'No se puede descomprimir la copia: {error}')
+            else:
+                with open(path, 'rb') as source:
+                    shutil.copyfileobj(source, target, CHUNK_SIZE)
+        if db_sha256 is not None and _sha256(copy_path) != db_sha256:
+            raise BackupError(f'{os.path.basename(path)} descomprimida no coincide con la del manifiesto.')
+        try:
+            with closing(sqlite3.connect(copy_path)) as connection:
+                return copy_path, check(connection)
+        except sqlite3.DatabaseError as error:
+            raise BackupError(f'La copia no es una base de datos SQLite válida: {error}')
+    except BaseException:
+        os.remove(copy_path)
+        raise
+
+
+def _verify(path, log=None):
+    """Comprueba una copia y sus años archivados. Devuelve (entrada del
+    manifiesto o None, ruta de la base de datos descomprimida, {año: ruta
+    del archivo descomprimido}); los temporales los borra quien llama."""
+    if not os.path.isfile(path):
+        raise BackupError(f'No existe la copia {path}.')
+    entry = _manifest_entry(path)
+    if entry is None:
+        if log:
+            log('La copia no está en el manifiesto: no se puede comprobar su suma.')
+    elif _sha256(path) != entry['sha256']:
+        raise BackupError('La suma SHA-256 de la copia no coincide con la del manifiesto.')
+
+    copy_path, revision = _unpack(path, entry and entry['db_sha256'], os.path.dirname(database_path()), _check)
+    archives = {}
+    try:
+        for item in (entry or {}).get('archives', ()):
+            archive_file = os.path.join(os.path.dirname(os.path.abspath(path)), item['file'])
+            if not os.path.isfile(archive_file):
+                raise BackupError(f"Falta {item['file']}, el año archivado {item['year']} de la copia.")
+            if _sha256(archive_file) != item['sha256']:
+                raise BackupError(f"La suma SHA-256 de {item['file']} no coincide con la del manifiesto.")
+            os.makedirs(app.config['ARCHIVE_DIR'], exist_ok=True)
+            archives[item['year']], _ = _unpack(archive_file, item['db_sha256'], app.config['ARCHIVE_DIR'],
+                                                _check_integrity)
+    except BaseException:
+        for temporary in [copy_path, *archives.values()]:
+            os.remove(temporary)
+        raise
+    if log:
+        years = ', '.join(str(year) for year in archives)
+        log(f"Copia verificada (revisión {revision}{'; años archivados: ' + years if years else ''}).")
+    return entry, copy_path, archives
+
+
+def verify(path, log=None):
+    """Comprueba una copia sin restaurarla: suma del manifiesto (si está),
+    descompresión, integridad y esquema, también de sus años archivados.
+    Devuelve la ruta de la base de datos descomprimida (temporal: quien
+    llama debe borrarla)."""
+    _, copy_path, archives = _verify(path, log)
+    for archive_copy in archives.values():
+        os.remove(archive_copy)
+    return copy_path
+
+
+def _restore_archives(archives, log=None):
+    """Deja en ARCHIVE_DIR exactamente los años archivados de la copia. Los
+    ficheros que había se apartan a un subdirectorio, no se borran."""
+    current = archive.archived_years()
+    if current:
+        aside = tempfile.mkdtemp(prefix=f"antes-de-restaurar-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}-",
+                                 dir=app.config['ARCHIVE_DIR'])
+        for year in current:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(archive.archive_path(year) + suffix):
+                    os.replace(archive.archive_path(year) + suffix,
+                               os.path.join(aside, os.path.basename(archive.archive_path(year)) + suffix))
+        if log:
+            log(f'Años archivados anteriores ({", ".join(map(str, current))}) apartados en {aside}.')
+    for year, archive_copy in archives.items():
+        os.replace(archive_copy, archive.archive_path(year))
+
+
+def restore(path, log=None):
+    """Sustituye el contenido de la base de datos y los años archivados por
+    los de la copia, después de verificarla. Devuelve la revisión de Alembic
+    restaurada."""
+    entry, copy_path, archives = _verify(path, log)
+    try:
+        with archive.lock():
+            if (entry is None or 'archives' not in entry) and archive.archived_years():
+                # Copia sin anotar o anterior a que se copiaran los archivados:
+                # no se sabe qué años archivados le corresponden
+                raise BackupError('Hay años archivados en ARCHIVE_DIR y la copia no dice cuáles tenía: '
+                                  'restaurarla podría contar movimientos dos veces o perderlos.')
+            db.session.remove()
+            db.engine.dispose()
+            with closing(sqlite3.connect(copy_path)) as source, closing(_connect(database_path())) as target:
+                revision = source.execute('SELECT version_num FROM alembic_version').fetchone()[0]
+                user_ids = [row[0] for row in source.execute('SELECT id FROM user')]
+                # Un solo paso: se escribe en una transacción y nadie ve un estado intermedio
+                source.backup(target, pages=-1)
+            _restore_archives(archives, log)
+    finally:
+        for temporary in [copy_path, *archives.values()]:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    # Las cachés de todos los procesos guardan datos de la base de datos anterior
+    for user_id in user_ids:
+        bump_version(user_id, *SCOPES)
+    return revision
@@ -0,0 +1,511 @@
+# app/benchmark.py
+# Datos sintéticos y banco de pruebas de rendimiento.
+#
+# - seed(): crea usuarios, categorías, presupuestos, recurrentes y millones de
+#   transacciones con un generador aleatorio con semilla (siempre los mismos
+#   datos para la misma semilla), insertados por lotes.
+# - run_benchmarks(): recorre las rutas principales con el cliente de pruebas
+#   de Flask y el comando process-recurring, y mide percentiles de latencia,
+#   número de consultas y memoria máxima. El resultado se guarda en JSON para
+#   compararlo con una ejecución anterior y detectar regresiones.
+# - categorization_batch(): descripciones como las de un extracto bancario
+#   para medir la categorización automática de un lote.
+# - login_attack(): inicios de sesión legítimos durante un ataque de fuerza
+#   bruta en otros procesos, con y sin el límite de intentos.
+import json
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import event, insert, text
+from sqlalchemy.exc import OperationalError
+from werkzeug.security import generate_password_hash
+from app import app, db, ledger, categories, categorizer
+from app.database import run_with_retry
+from app.models import User, Category, Transaction, Budget, RecurringTransaction
+
+BENCHMARK_USER_PREFIX = 'bench_'
+BENCHMARK_PASSWORD = 'benchmark'
+
+EXPENSE_CATEGORIES = {
+    'Comida': (['Mercadona', 'Carrefour', 'Lidl', 'Panadería', 'Frutería', 'Dia'], 5, 120),
+    'Transporte': (['Gasolinera Repsol', 'Metro', 'Renfe', 'Taxi', 'Parking', 'Cabify'], 2, 80),
+    'Ocio': (['Cine', 'Restaurante', 'Bar', 'Concierto', 'Libros', 'Café con amigos'], 3, 90),
+    'Hogar': (['Alquiler', 'Luz Iberdrola', 'Agua', 'Gas Naturgy', 'Ikea', 'Comunidad'], 20, 900),
+    'Suscripciones': (['Netflix', 'Spotify', 'Gimnasio', 'Móvil', 'Fibra', 'Seguro'], 5, 60),
+    'Salud': (['Farmacia', 'Dentista', 'Óptica', 'Fisioterapia'], 5, 150),
+}
+INCOME_CATEGORIES = {
+    'Nómina': (['Nómina empresa', 'Paga extra'], 1200, 3200),
+    'Otros ingresos': (['Bizum', 'Devolución Hacienda', 'Venta Wallapop', 'Intereses'], 5, 400),
+}
+
+
+def seed(users=10, transactions_per_user=100000, years=5, recurring_per_user=20,
+         seed_value=42, batch_size=10000, log=None):
+    """Genera datos sintéticos de rendimiento. Devuelve los ids de usuario creados."""
+    rng = random.Random(seed_value)
+    now = datetime.utcnow().replace(microsecond=0)
+    first_day = now - timedelta(days=365 * years)
+    span_seconds = int((now - first_day).total_seconds())
+    # Calcular el hash es caro a propósito: lo hacemos una sola vez
+    password_hash = generate_password_hash(BENCHMARK_PASSWORD)
+
+    existing = User.query.filter(User.username.like(f'{BENCHMARK_USER_PREFIX}%')).count()
+    user_ids = []
+    for n in range(existing, existing + users):
+        user = User(username=f'{BENCHMARK_USER_PREFIX}{n}', password_hash=password_hash)
+        db.session.add(user)
+        db.session.flush()
+        user_ids.append(user.id)
+
+        categories = []
+        for name, (descriptions, low, high) in EXPENSE_CATEGORIES.items():
+            categories.append((Category(name=name, type='gasto', user_id=user.id), descriptions, low, high, -1))
+        for name, (descriptions, low, high) in INCOME_CATEGORIES.items():
+            categories.append((Category(name=name, type='ingreso', user_id=user.id), descriptions, low, high, 1))
+        db.session.add_all(c[0] for c in categories)
+        db.session.flush()
+
+        # Los gastos son mucho más frecuentes que los ingresos
+        weights = [10 if sign < 0 else 1 for *_, sign in categories]
+        rows = []
+        for _ in range(transactions_per_user):
+            category, descriptions, low, high, sign = rng.choices(categories, weights)[0]
+            rows.append({
+                'description': rng.choice(descriptions),
+                'amount': round(sign * rng.uniform(low, high), 2),
+                'date': first_day + timedelta(seconds=rng.randrange(span_seconds)),
+                'category_id': category.id,
+                'user_id': user.id,
+            })
+            if len(rows) >= batch_size:
+                db.session.execute(insert(Transaction.__table__), rows)
+                rows = []
+        if rows:
+            db.session.execute(insert(Transaction.__table__), rows)
+
+        # Presupuestos de los últimos 12 meses para las categorías de gasto
+        budgets = []
+        for months_ago in range(12):
+            month_index = now.year * 12 + now.month - 1 - months_ago
+            year, month = divmod(month_index, 12)
+            for category, _, low, high, sign in categories:
+                if sign < 0:
+                    budgets.append({'user_id': user.id, 'category_id': category.id, 'year': year,
+                                    'month': month + 1, 'amount': round(rng.uniform(high, high * 4), 2)})
+        db.session.execute(insert(Budget.__table__), budgets)
+
+        schedules = []
+        for _ in range(recurring_per_user):
+            category, descriptions, low, high, sign = rng.choice(categories)
+            start = now - timedelta(days=rng.randrange(0, 120))
+            schedules.append({
+                'description': rng.choice(descriptions), 'amount': round(sign * rng.uniform(low, high), 2),
+                'frequency': rng.choice(['monthly', 'monthly', 'weekly', 'yearly']),
+                'start_date': start, 'next_date': start,
+                'category_id': category.id, 'user_id': user.id,
+            })
+        if schedules:
+            db.session.execute(insert(RecurringTransaction.__table__), schedules)
+
+        # Los datos materializados se calculan de una vez al final de cada usuario
+        ledger.rebuild_balances(user.id)
+        ledger.rebuild_rollups(user.id)
+        db.session.commit()
+        if log:
+            log(f"Usuario {user.username}: {transactions_per_user} transacciones.")
+    return user_ids
+
+
+# --- Banco de pruebas ---
+
+def _percentile(values, percent):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def _summary(latencies, queries, peak_bytes):
+    return {
+        'runs': len(latencies),
+        'p50_ms': round(_percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(_percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(_percentile(latencies, 99) * 1000, 2),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 2),
+        'queries': max(queries),
+        'peak_memory_kb': round(peak_bytes / 1024, 1),
+    }
+
+
+class _QueryCounter:
+    """Cuenta las sentencias SQL que se ejecutan mientras está activo."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+
+
+def _measure(name, call, iterations, log=None):
+    # Una llamada de calentamiento (plantillas, cachés, conexiones) que no cuenta
+    call()
+    latencies, queries = [], []
+    for _ in range(iterations):
+        with _QueryCounter(db.engine) as counter:
+            started = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - started)
+        queries.append(counter.count)
+    # tracemalloc ralentiza mucho la ejecución: la memoria se mide aparte
+    tracemalloc.start()
+    try:
+        call()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    result = _summary(latencies, queries, peak)
+    if log:
+        log(f"{name:<28} p50 {result['p50_ms']:>9.2f} ms  p95 {result['p95_ms']:>9.2f} ms  "
+            f"{result['queries']:>4} consultas  {result['peak_memory_kb']:>10.1f} KB")
+    return result
+
+
+def default_scenarios(prefix=''):
+    """Rutas a medir: (nombre, URL). La URL incluye el prefijo de PrefixMiddleware."""
+    today = datetime.utcnow()
+    return [
+        ('dashboard', f'{prefix}/dashboard'),
+        ('reports_month', f'{prefix}/reports?year={today.year}&month={today.month}'),
+        ('reports_year', f'{prefix}/reports?year={today.year}&month=0'),
+        ('reports_all', f'{prefix}/reports?year=0&month=0'),
+        ('transactions_feed', f'{prefix}/transactions/feed'),
+        ('export_csv_year', f'{prefix}/export_csv?year={today.year}&month=0'),
+        ('export_csv_all', f'{prefix}/export_csv'),
+        ('manage_budgets', f'{prefix}/budgets'),
+        ('search_text', f'{prefix}/search?q=mercadona'),
+        ('search_prefix', f'{prefix}/search?q=merc'),
+        ('search_filtered', f'{prefix}/search?q=cafe&amount_min=10&amount_max=50'
+                            f'&date_from={today.year - 1}-01-01'),
+        ('search_relevance', f'{prefix}/search?q=luz+iberdrola&order=relevance'),
+        ('forecast_5y', f'{prefix}/forecast?months=60'),
+    ]
+
+
+def categorization_batch(size=100000, seed_value=42):
+    """(descripciones, importes) al estilo de un extracto: los comercios de
+    los datos sintéticos con prefijos de tarjeta, referencias y mayúsculas,
+    y algunos que el usuario no ha visto nunca."""
+    rng = random.Random(seed_value)
+    merchants = [(d, -1) for descriptions, _, _ in EXPENSE_CATEGORIES.values() for d in descriptions]
+    merchants += [(d, 1) for descriptions, _, _ in INCOME_CATEGORIES.values() for d in descriptions]
+    unknown = ['Tienda Nueva', 'Ferretería López', 'Kiosko', 'Lavandería']
+    prefixes = ['', 'COMPRA TARJ. ', 'PAGO ', 'RECIBO ']
+    descriptions, amounts = [], []
+    for _ in range(size):
+        if rng.random() < 0.05:
+            merchant, sign = rng.choice(unknown), -1
+        else:
+            merchant, sign = rng.choice(merchants)
+        if rng.random() < 0.5:
+            merchant = merchant.upper()
+        descriptions.append(f'{rng.choice(prefixes)}{merchant} {rng.randint(1000, 999999)}')
+        amounts.append(sign * rng.randint(1, 500))
+    return descriptions, amounts
+
+
+def run_benchmarks(username, iterations=20, include_recurring=True, log=None):
+    """Mide las rutas principales para el usuario indicado. Devuelve un dict."""
+    prefix = getattr(app.wsgi_app, 'prefix', '')
+    csrf_enabled = app.config.get('WTF_CSRF_ENABLED', True)
+    app.config['WTF_CSRF_ENABLED'] = False
+    client = app.test_client()
+    try:
+        response = client.post(f'{prefix}/login',
+                               data={'username': username, 'password': BENCHMARK_PASSWORD})
+        if response.status_code != 302 or '/login' in response.headers.get('Location', ''):
+            raise RuntimeError(f"No se pudo iniciar sesión como '{username}'.")
+
+        results = {}
+        for name, url in default_scenarios(prefix):
+            def call(url=url):
+                response = client.get(url)
+                # Consumimos el cuerpo completo (las exportaciones van en streaming)
+                for _ in response.response:
+                    pass
+                response.close()
+                if response.status_code != 200:
+                    raise RuntimeError(f"{url} ha devuelto {response.status_code}")
+            results[name] = _measure(name, call, iterations, log)
+    finally:
+        app.config['WTF_CSRF_ENABLED'] = csrf_enabled
+
+    # Categorizar un lote como el de un extracto grande, con el modelo recién
+    # cargado (como al empezar una importación)
+    user_id = User.query.filter_by(username=username).one().id
+    descriptions, amounts = categorization_batch()
+    results['categorize_100k'] = _measure(
+        'categorize_100k',
+        lambda: categorizer._load(user_id).suggest_many(descriptions, amounts),
+        max(1, iterations // 5), log)
+
+    if include_recurring:
+        runner = app.test_cli_runner()
+        # En modo de prueba para que cada iteración haga el mismo trabajo
+        results['process_recurring_dry_run'] = _measure(
+            'process_recurring_dry_run',
+            lambda: runner.invoke(args=['process-recurring', '--dry-run']),
+            max(1, iterations // 5), log)
+
+    return {
+        'meta': {
+            'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+            'username': username,
+            'iterations': iterations,
+            'python': platform.python_version(),
+            'database': db.engine.url.render_as_string(hide_password=True),
+            'transactions': Transaction.query.count(),
+        },
+        'results': results,
+    }
+
+
+# --- Prueba de concurrencia ---
+
+def _stress_worker(role, user_id, category_id, seconds, seed_value):
+    """Repite lecturas o escrituras durante seconds segundos en un proceso aparte."""
+    with app.app_context():
+        # Las conexiones heredadas del proceso padre no se pueden compartir
+        db.engine.dispose(close=False)
+        rng = random.Random(seed_value)
+        today = datetime.utcnow()
+        latencies, attempts, errors = [], 0, 0
+
+        def write():
+            nonlocal attempts
+            attempts += 1
+            amount = -round(rng.uniform(1, 50), 2)
+            now = datetime.utcnow()
+            db.session.add(Transaction(description='Prueba de concurrencia', amount=amount, date=now,
+                                       category_id=category_id, user_id=user_id))
+            ledger.apply_transaction(user_id, category_id, amount, now)
+            db.session.commit()
+
+        def read():
+            ledger.period_totals(user_id, today.year, today.month)
+            ledger.budget_progress(user_id, today.year, today.month)
+            Transaction.query.filter_by(user_id=user_id).order_by(
+                Transaction.date.desc(), Transaction.id.desc()).limit(50).all()
+            # Cerramos la transacción de lectura para no retener la instantánea de WAL
+            db.session.rollback()
+
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                if role == 'writer':
+                    run_with_retry(write)
+                else:
+                    read()
+            except OperationalError:
+                db.session.rollback()
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+        return role, latencies, attempts, errors
+
+
+def stress(username, writers=3, readers=3, seconds=10, log=None):
+    """Lectores y escritores en procesos separados contra la misma base de datos.
+
+    Devuelve un dict por rol con operaciones, latencias, reintentos y errores.
+    Con el perfil de SQLite (WAL + reintentos) no debería haber errores y los
+    lectores no deberían esperar a los escritores.
+    """
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise RuntimeError(f"No existe el usuario '{username}'.")
+    expense_categories = categories.user_categories(user.id, 'gasto')
+    if not expense_categories:
+        raise RuntimeError(f"El usuario '{username}' no tiene categorías de gasto.")
+    journal_mode = db.session.execute(text('PRAGMA journal_mode')).scalar()
+    db.session.remove()
+
+    jobs = [('writer', n) for n in range(writers)] + [('reader', n) for n in range(readers)]
+    with ProcessPoolExecutor(max_workers=len(jobs),
+                             mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = [executor.submit(_stress_worker, role, user.id, expense_categories[0].id,
+                                   seconds, n) for role, n in jobs]
+        outcomes = [future.result() for future in futures]
+
+    results = {'journal_mode': journal_mode, 'seconds': seconds}
+    for role in ('writer', 'reader'):
+        latencies = [l for r, ls, _, _ in outcomes if r == role for l in ls]
+        attempts = sum(a for r, _, a, _ in outcomes if r == role)
+        errors = sum(e for r, _, _, e in outcomes if r == role)
+        summary = {'processes': writers if role == 'writer' else readers, 'operations': len(latencies),
+                   'per_second': round(len(latencies) / seconds, 1), 'errors': errors}
+        if latencies:
+            summary.update({'p50_ms': round(_percentile(latencies, 50) * 1000, 2),
+                            'p95_ms': round(_percentile(latencies, 95) * 1000, 2),
+                            'max_ms': round(max(latencies) * 1000, 2)})
+        if role == 'writer':
+            summary['retries'] = attempts - len(latencies) - errors
+        results[role] = summary
+        if log:
+            log(f"{role:<7} {summary['processes']} procesos  {summary['operations']:>7} operaciones "
+                f"({summary['per_second']}/s)  p95 {summary.get('p95_ms', 0):>8.2f} ms  "
+                f"máx {summary.get('max_ms', 0):>8.2f} ms  {errors} errores"
+                + (f"  {summary['retries']} reintentos" if role == 'writer' else ''))
+    return results
+
+
+# --- Prueba de carga del inicio de sesión ---
+
+# Pausa entre dos inicios de sesión legítimos (segundos)
+LEGIT_LOGIN_INTERVAL = 0.25
+# IPs desde las que ataca cada proceso atacante
+ATTACK_IPS_PER_PROCESS = 5
+
+
+def _login_worker(role, usernames, seconds, rate_limit, rate, seed_value):
+    """Inicios de sesión durante seconds segundos en un proceso aparte.
+
+    'legit': contraseña correcta, cada vez desde una IP distinta (usuarios
+    reales que entran a la vez). 'attacker': rate contraseñas falsas por
+    segundo contra usernames desde unas pocas IPs. Es tráfico que llega de
+    fuera a ritmo fijo: si el servidor no da abasto, se acumula el retraso.
+    """
+    with app.app_context():
+        db.engine.dispose(close=False)
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['LOGIN_RATE_LIMIT'] = rate_limit
+    prefix = getattr(app.wsgi_app, 'prefix', '')
+    rng = random.Random(seed_value)
+    latencies, outcomes = [], Counter()
+    deadline = time.monotonic() + seconds
+    next_at = time.monotonic()
+    attempt = 0
+    while time.monotonic() < deadline:
+        attempt += 1
+        if role == 'legit':
+            ip = f'10.{seed_value % 250}.{attempt // 250 % 250}.{attempt % 250}'
+            data = {'username': usernames[attempt % len(usernames)], 'password': BENCHMARK_PASSWORD}
+        else:
+            ip = f'203.0.{seed_value % 250}.{rng.randrange(ATTACK_IPS_PER_PROCESS)}'
+            data = {'username': rng.choice(usernames), 'password': f'x{rng.random()}'}
+        started = time.perf_counter()
+        # Un contexto nuevo por petición: si no, la petición reutiliza el
+        # heredado del comando y Flask-Login, el usuario de la anterior (en g)
+        with app.app_context():
+            response = app.test_client().post(f'{prefix}/login', data=data, headers={'X-Forwarded-For': ip})
+        latencies.append(time.perf_counter() - started)
+        if response.status_code == 429:
+            outcomes['limited'] += 1
+        elif '/login' in response.headers.get('Location', '/login'):
+            outcomes['failed'] += 1
+        else:
+            outcomes['ok'] += 1
+        next_at += LEGIT_LOGIN_INTERVAL if role == 'legit' else 1 / rate
+        time.sleep(max(0, next_at - time.monotonic()))
+    return role, latencies, outcomes
+
+
+def _login_phase(legit, targets, attackers, seconds, rate_limit, rate):
+    jobs = [('legit', legit, 0)] + [('attacker', targets, n + 1) for n in range(attackers)]
+    with ProcessPoolExecutor(max_workers=len(jobs),
+                             mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = [executor.submit(_login_worker, role, usernames, seconds, rate_limit, rate, n)
+                   for role, usernames, n in jobs]
+        outcomes = [future.result() for future in futures]
+
+    results = {}
+    for role in ('legit', 'attacker'):
+        latencies = [l for r, ls, _ in outcomes if r == role for l in ls]
+        counts = sum((c for r, _, c in outcomes if r == role), Counter())
+        if not latencies:
+            continue
+        results[role] = {'attempts': len(latencies), 'per_second': round(len(latencies) / seconds, 1),
+                         'ok': counts['ok'], 'failed': counts['failed'], 'limited': counts['limited'],
+                         'p50_ms': round(_percentile(latencies, 50) * 1000, 2),
+                         'p95_ms': round(_percentile(latencies, 95) * 1000, 2),
+                         'max_ms': round(max(latencies) * 1000, 2)}
+    return results
+
+
+def login_attack(username, attackers=3, rate=20, seconds=10, rate_limit=True, log=None):
+    """Latencia de los inicios de sesión legítimos de username, primero solos
+    y después con attackers procesos probando rate contraseñas por segundo
+    cada uno contra los demás usuarios de prueba. Devuelve
+    {'baseline': ..., 'attack': ...}.
+
+    El límite de intentos usa una base de datos temporal: la prueba no deja
+    bloqueados a los usuarios ni a las IPs en RATELIMIT_DB.
+    """
+    if User.query.filter_by(username=username).first() is None:
+        raise RuntimeError(f"No existe el usuario '{username}'.")
+    # Las víctimas tienen contraseña de verdad: sin límite, cada intento calcula su hash
+    targets = [name for (name,) in db.session.query(User.username).filter(
+        User.username.startswith(BENCHMARK_USER_PREFIX), User.username != username)]
+    if not targets:
+        raise RuntimeError('Hacen falta más usuarios de prueba (flask seed-benchmark --users 2 o más).')
+    db.session.remove()
+
+    ratelimit_db = app.config['RATELIMIT_DB']
+    directory = tempfile.mkdtemp(prefix='login-benchmark-')
+    app.config['RATELIMIT_DB'] = os.path.join(directory, 'ratelimit.db')
+    try:
+        results = {'rate_limit': rate_limit, 'seconds': seconds, 'attackers': attackers, 'rate': rate}
+        for phase, processes in (('baseline', 0), ('attack', attackers)):
+            results[phase] = _login_phase([username], targets, processes, seconds, rate_limit, rate)
+            if log:
+                for role, summary in results[phase].items():
+                    log(f"{phase:<8} {role:<8} {summary['attempts']:>6} intentos ({summary['per_second']}/s)  "
+                        f"ok {summary['ok']:>5}  fallidos {summary['failed']:>5}  limitados {summary['limited']:>6}  "
+                        f"p50 {summary['p50_ms']:>8.2f} ms  p95 {summary['p95_ms']:>8.2f} ms")
+    finally:
+        app.config['RATELIMIT_DB'] = ratelimit_db
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+    return results
+
+
+def compare(current, baseline, threshold=0.2):
+    """Lista de regresiones (nombre, métrica, antes, ahora) por encima del umbral."""
+    regressions = []
+    for name, result in current['results'].items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous:
+            continue
+        for metric in ('p95_ms', 'queries', 'peak_memory_kb'):
+            before, now = previous.get(metric), result.get(metric)
+            if before and now is not None and now > before * (1 + threshold):
+                regressions.append((name, metric, before, now))
+    return regressions
+
+
+def save(results, path):
+    with open(path, 'w') as output:
+        json.dump(results, output, indent=2, ensure_ascii=False)
+
+
+def load(path):
+    with open(path) as source:
+        return json.load(source)
@@ -0,0 +1,43 @@
+# app/categories.py
+# Caché por usuario de sus categorías.
+# Casi todas las páginas necesitan las categorías del usuario (desplegables,
+# tipo de la categoría elegida al guardar...). Las guardamos en memoria y solo
+# las volvemos a leer cuando cambia el sello 'categories' del usuario, que
+# actualizan add_category y delete_category (ver app/versions.py).
+from collections import namedtuple
+from app import app
+from app.models import Category
+from app.versions import VersionedCache, get_version
+
+CategoryInfo = namedtuple('CategoryInfo', 'id name type')
+
+_cache = VersionedCache(max_entries=app.config['CATEGORY_CACHE_SIZE'])
+
+
+def _load(user_id):
+    rows = Category.query.with_entities(Category.id, Category.name, Category.type).filter_by(
+        user_id=user_id).order_by(Category.name).all()
+    categories = tuple(CategoryInfo(*row) for row in rows)
+    return categories, {c.id: c for c in categories}
+
+
+def _user_entry(user_id):
+    return _cache.get_or_load(user_id, get_version(user_id, 'categories'), lambda: _load(user_id))
+
+
+def user_categories(user_id, type=None):
+    """Categorías del usuario ordenadas por nombre, opcionalmente de un tipo."""
+    categories = _user_entry(user_id)[0]
+    if type is None:
+        return categories
+    return tuple(c for c in categories if c.type == type)
+
+
+def category_choices(user_id, type=None):
+    """Lista (id, nombre) lista para un SelectField."""
+    return [(c.id, c.name) for c in user_categories(user_id, type)]
+
+
+def get_category(user_id, category_id):
+    """Categoría del usuario por id, o None si no existe o no es suya."""
+    return _user_entry(user_id)[1].get(category_id)
@@ -0,0 +1,222 @@
+# app/categorizer.py
+# Categorización automática de movimientos por su descripción.
+#
+# Para cada usuario combinamos dos fuentes:
+#   1. Sus reglas (CategoryRule): "si la descripción contiene 'mercadona',
+#      es Comida". Todas se compilan en una única expresión regular con
+#      forma de trie, así que una descripción se recorre una sola vez sea
+#      cual sea el número de reglas (la misma idea que Aho-Corasick).
+#   2. Su historial (CategoryHistory): cuántos movimientos con cada
+#      descripción ha puesto en cada categoría. Primero se busca la
+#      descripción exacta y, si no aparece, votan sus palabras.
+#
+# El historial lo mantienen unos triggers de SQLite con cada alta, edición o
+# borrado de movimientos, y es pequeño (una fila por descripción distinta y
+# categoría), así que el modelo de cada usuario se carga de ahí en unos
+# milisegundos y se guarda en memoria hasta que cambian sus movimientos, sus
+# categorías o sus reglas (ver app/versions.py).
+#
+# El modelo no se actualiza movimiento a movimiento: cualquier alta o
+# edición cambia la versión y el siguiente uso lo vuelve a cargar entero del
+# historial. Es lo que mantiene igual a todos los procesos (cada uno solo ve
+# sus propias escrituras), y una importación carga el modelo una vez para
+# todo el extracto.
+import re
+from collections import Counter, defaultdict, namedtuple
+from app import app
+from app import categories
+from app.models import CategoryHistory, CategoryRule
+from app.text import words
+from app.versions import VersionedCache, data_version
+
+Suggestion = namedtuple('Suggestion', 'category_id source confidence')
+
+# Palabras demasiado cortas ('sa', 'de'...) no sirven para votar
+MIN_TOKEN_LENGTH = 3
+# Confianza mínima del voto por palabras para sugerir algo
+MIN_CONFIDENCE = 0.5
+# Descripciones ya resueltas que recuerda cada modelo
+MEMO_SIZE = 50000
+
+_cache = VersionedCache(max_entries=app.config['CATEGORIZER_CACHE_SIZE'])
+
+
+def description_key(description):
+    """Clave con la que se comparan las descripciones: sus palabras
+    normalizadas, sin números (fechas, referencias...) ni signos."""
+    return ' '.join(words(description))
+
+
+def _trie_pattern(patterns):
+    """Expresión regular equivalente a la alternativa de todos los patrones,
+    factorizada por prefijos: 'caf|cafe|cafeteria' queda 'caf(?:e(?:teria)?)?'."""
+    trie = {}
+    for pattern in patterns:
+        node = trie
+        for char in pattern:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def build(node):
+        end = '' in node
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{body})?' if end else body
+
+    return build(trie)
+
+
+class RuleMatcher:
+    """Todas las reglas de un usuario en una sola expresión regular."""
+
+    def __init__(self, rules):
+        # rules: (id, patrón, category_id); un patrón puede estar en varias reglas,
+        # cada una guardada como (id, category_id)
+        self.rules = defaultdict(list)
+        for rule_id, pattern, category_id in sorted(rules):
+            key = description_key(pattern)
+            if key:
+                self.rules[key].append((rule_id, category_id))
+        self.regex = None
+        if self.rules:
+            # Los grupos opcionales del trie son codiciosos: en cada posición
+            # la expresión se queda con el patrón más largo que encaja
+            self.regex = re.compile(r'\b' + _trie_pattern(self.rules) + r'\b')
+
+    def match(self, key, allowed=None):
+        """Categoría de la regla que encaja con la clave: gana el patrón más
+        largo y, a igualdad, la regla más antigua. Con allowed, solo
+        categorías de ese conjunto."""
+        if self.regex is None:
+            return None
+        # Cada coincidencia es el patrón más largo en su posición; los patrones
+        # más cortos que empiezan igual ('bar' dentro de 'bar pepe') también
+        # encajan y sirven si las categorías del largo no están permitidas
+        found = set()
+        for match in self.regex.findall(key):
+            found.add(match)
+            position = match.rfind(' ')
+            while position > 0:
+                match = match[:position]
+                if match in self.rules:
+                    found.add(match)
+                position = match.rfind(' ')
+        candidates = sorted((-len(pattern), rule_id, category_id)
+                            for pattern in found for rule_id, category_id in self.rules[pattern])
+        for _, _, category_id in candidates:
+            if allowed is None or category_id in allowed:
+                return category_id
+        return None
+
+
+class CategoryModel:
+    """Modelo de categorización de un usuario (reglas + historial)."""
+
+    def __init__(self, rules, history, category_types):
+        self.matcher = RuleMatcher(rules)
+        self.types = category_types
+        self.by_type = {
+            kind: frozenset(cid for cid, t in category_types.items() if t == kind)
+            for kind in ('gasto', 'ingreso')
+        }
+        self.exact = defaultdict(Counter)
+        self.tokens = defaultdict(Counter)
+        for description, category_id, count in history:
+            if category_id not in category_types:
+                continue
+            key = description_key(description)
+            self.exact[key][category_id] += count
+            for token in set(key.split()):
+                if len(token) >= MIN_TOKEN_LENGTH:
+                    self.tokens[token][category_id] += count
+        self._memo = {}
+
+    def _allowed(self, amount):
+        if amount is None:
+            return None
+        return self.by_type['ingreso' if amount > 0 else 'gasto']
+
+    @staticmethod
+    def _best(counter, allowed):
+        total = best_count = 0
+        best = None
+        for category_id, count in counter.items():
+            if allowed is not None and category_id not in allowed:
+                continue
+            total += count
+            if count > best_count or (count == best_count and category_id < best):
+                best, best_count = category_id, count
+        return best, (best_count / total if total else 0)
+
+    def _suggest_key(self, key, allowed):
+        category_id = self.matcher.match(key, allowed)
+        if category_id is not None:
+            return Suggestion(category_id, 'rule', 1.0)
+
+        counter = self.exact.get(key)
+        if counter:
+            category_id, confidence = self._best(counter, allowed)
+            if category_id is not None:
+                return Suggestion(category_id, 'history', round(confidence, 3))
+
+        # Cada palabra reparte un voto entre sus categorías según su historial;
+        # las que aparecen en muchas categorías ('compra', 'pago') pesan menos
+        votes = Counter()
+        for token in key.split():
+            counter = self.tokens.get(token)
+            if not counter:
+                continue
+            category_id, share = self._best(counter, allowed)
+            if category_id is not None:
+                votes[category_id] += share / len(counter)
+        if votes:
+            category_id, weight = max(votes.items(), key=lambda item: (item[1], -item[0]))
+            confidence = weight / sum(votes.values())
+            if confidence >= MIN_CONFIDENCE:
+                return Suggestion(category_id, 'words', round(confidence, 3))
+        return None
+
+    def suggest(self, description, amount=None):
+        """Suggestion para una descripción, o None si no hay ninguna fiable.
+        Con amount solo se sugieren categorías de su tipo (gasto/ingreso)."""
+        # Las descripciones de un extracto se repiten salvo por referencias y
+        # fechas, que la clave descarta: recordamos lo resuelto por clave
+        key = description_key(description)
+        memo_key = (key, None if amount is None else amount > 0)
+        suggestion = self._memo.get(memo_key, False)
+        if suggestion is False:
+            suggestion = self._suggest_key(key, self._allowed(amount))
+            if len(self._memo) >= MEMO_SIZE:
+                self._memo.clear()
+            self._memo[memo_key] = suggestion
+        return suggestion
+
+    def suggest_many(self, descriptions, amounts=None):
+        """Sugerencias para un lote de descripciones (y sus importes)."""
+        if amounts is None:
+            return [self.suggest(description) for description in descriptions]
+        return [self.suggest(description, amount) for description, amount in zip(descriptions, amounts)]
+
+
+def _load(user_id):
+    rules = CategoryRule.query.with_entities(
+        CategoryRule.id, CategoryRule.pattern, CategoryRule.category_id).filter_by(user_id=user_id).all()
+    history = CategoryHistory.query.with_entities(
+        CategoryHistory.description, CategoryHistory.category_id, CategoryHistory.count
+    ).filter_by(user_id=user_id).all()
+    category_types = {c.id: c.type for c in categories.user_categories(user_id)}
+    return CategoryModel(rules, history, category_types)
+
+
+def user_model(user_id):
+    """Modelo del usuario, recargado entero (del historial) solo si han
+    cambiado sus movimientos, sus categorías o sus reglas."""
+    version = data_version(user_id, 'transactions', 'categories', 'rules')
+    return _cache.get_or_load(user_id, version, lambda: _load(user_id))
+
+
+def suggest(user_id, description, amount=None):
+    """Sugerencia para una descripción del usuario (ver CategoryModel.suggest)."""
+    return user_model(user_id).suggest(description, amount)
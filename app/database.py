@@ -0,0 +1,87 @@
+# app/database.py
+# Perfil de SQLite para producción y gestión de bloqueos de escritura.
+#
+# gunicorn arranca varios procesos y el cron de process-recurring escribe a
+# la vez que ellos. Con el diario por defecto (rollback journal) un escritor
+# bloquea a todos los lectores y las escrituras simultáneas acaban en
+# "database is locked". Con WAL los lectores no se bloquean nunca y los
+# escritores esperan su turno (busy_timeout).
+#
+# Aun así, SQLite puede devolver el error sin esperar: una transacción que
+# empezó leyendo y luego quiere escribir falla al instante si otro proceso
+# escribió entretanto. Para eso están run_with_retry() y el decorador
+# retry_on_locked, que repiten la unidad de trabajo completa con espera
+# exponencial.
+import random
+import sqlite3
+import time
+from functools import wraps
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from app import app, db
+
+_LOCK_MESSAGES = ('database is locked', 'database table is locked', 'database is busy')
+
+
+@event.listens_for(Engine, 'connect')
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Aplica el perfil de SQLite a cada conexión nueva (de cualquier proceso)."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    config = app.config
+    cursor = dbapi_connection.cursor()
+    try:
+        # busy_timeout primero: cambiar a WAL también necesita el bloqueo
+        cursor.execute(f"PRAGMA busy_timeout = {int(config['SQLITE_BUSY_TIMEOUT'])}")
+        if config['SQLITE_JOURNAL_MODE']:
+            cursor.execute(f"PRAGMA journal_mode = {config['SQLITE_JOURNAL_MODE']}")
+        if config['SQLITE_SYNCHRONOUS']:
+            cursor.execute(f"PRAGMA synchronous = {config['SQLITE_SYNCHRONOUS']}")
+        cursor.execute(f"PRAGMA cache_size = {int(config['SQLITE_CACHE_SIZE'])}")
+        cursor.execute(f"PRAGMA mmap_size = {int(config['SQLITE_MMAP_SIZE'])}")
+        if config['SQLITE_TEMP_STORE']:
+            cursor.execute(f"PRAGMA temp_store = {config['SQLITE_TEMP_STORE']}")
+    finally:
+        cursor.close()
+
+
+def is_locked_error(error):
+    """True si la excepción es un bloqueo de SQLite que merece reintentarse."""
+    return isinstance(error, OperationalError) and any(
+        message in str(error.orig) for message in _LOCK_MESSAGES)
+
+
+def run_with_retry(work, retries=None, backoff=None, rollback=True):
+    """Ejecuta work() y lo repite si SQLite devuelve un error de bloqueo.
+
+    work debe ser la unidad de trabajo completa (lecturas, escrituras y
+    commit): antes de cada reintento se hace rollback de la sesión. La espera
+    se dobla en cada intento, con algo de azar para que los procesos que
+    chocaron no vuelvan a chocar. Con rollback=False la sesión no se toca,
+    para el trabajo que va por una conexión propia (ver app/jobs.py).
+    """
+    retries = app.config['SQLITE_WRITE_RETRIES'] if retries is None else retries
+    backoff = app.config['SQLITE_RETRY_BACKOFF'] if backoff is None else backoff
+    attempt = 0
+    while True:
+        try:
+            return work()
+        except OperationalError as error:
+            if not is_locked_error(error) or attempt >= retries:
+                raise
+            if rollback:
+                db.session.rollback()
+            delay = backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+            app.logger.warning(f"Base de datos bloqueada; reintento {attempt + 1} de {retries} "
+                               f"en {delay:.3f} s.")
+            time.sleep(delay)
+            attempt += 1
+
+
+def retry_on_locked(view):
+    """Decorador para las vistas que escriben: repite la petición si hay bloqueo."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        return run_with_retry(lambda: view(*args, **kwargs))
+    return wrapper
@@ -0,0 +1,90 @@
+# app/exports.py
+# Exportación a CSV en streaming.
+# Las filas se leen de la base de datos por bloques y se escriben al cliente
+# según se generan, así que la memoria usada no depende del número de
+# transacciones exportadas.
+# Si el periodo llega a años archivados, sus ficheros se unen a la consulta
+# (ver app/archive.py).
+import csv
+import zlib
+from io import StringIO
+from sqlalchemy import select, func, union_all
+from app import db, archive
+from app.models import Transaction, Category
+from app.periods import period_filters
+
+CSV_HEADER = ['Fecha', 'Descripcion', 'Categoria', 'Importe']
+
+
+def _period_rows(user_id, year=0, month=0):
+    """Movimientos del periodo: la tabla caliente o, si el periodo llega a años
+    archivados, la unión con ellos (ver app/archive.py), ya filtrada en cada parte."""
+    tables = archive.tables_for_period(year)
+    parts = [select(t.c.id, t.c.date, t.c.description, t.c.category_id, t.c.amount).where(
+        t.c.user_id == user_id, *period_filters(t.c.date, year, month)) for t in tables]
+    return parts[0].subquery('rows') if len(parts) == 1 else union_all(*parts).subquery('rows')
+
+
+def export_statement(user_id, year=0, month=0):
+    """SELECT de las columnas del CSV, con el nombre de la categoría ya unido
+    (una sola consulta en lugar de una por transacción)."""
+    if not archive.period_years(year):
+        return select(
+            Transaction.date, Transaction.description,
+            Category.name.label('category_name'), Transaction.amount
+        ).outerjoin(Category, Transaction.category_id == Category.id).where(
+            Transaction.user_id == user_id, *period_filters(Transaction.date, year, month)
+        ).order_by(Transaction.date.asc(), Transaction.id.asc())
+    rows = _period_rows(user_id, year, month)
+    return select(
+        rows.c.date, rows.c.description, Category.name.label('category_name'), rows.c.amount
+    ).outerjoin(Category, rows.c.category_id == Category.id).order_by(rows.c.date.asc(), rows.c.id.asc())
+
+
+def count_rows(user_id, year=0, month=0):
+    """Filas que tendrá el CSV (sin la cabecera); sale del índice (user_id, date)."""
+    if not archive.period_years(year):
+        return db.session.execute(select(func.count()).select_from(Transaction).where(
+            Transaction.user_id == user_id, *period_filters(Transaction.date, year, month))).scalar()
+    return db.session.execute(select(func.count()).select_from(_period_rows(user_id, year, month))).scalar()
+
+
+def iter_csv(user_id, year=0, month=0, chunk_size=1000, progress=None):
+    """Genera el CSV en trozos de texto de como mucho chunk_size filas.
+
+    progress(filas), si se pasa, recibe las filas ya entregadas (sin la
+    cabecera) después de cada trozo. No sirve contar saltos de línea: una
+    descripción con saltos de línea va entre comillas en una sola fila.
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_HEADER)
+
+    # yield_per hace que SQLAlchemy lea del cursor por bloques (cursor en el
+    # servidor en los motores que lo soportan) en vez de cargarlo todo.
+    result = db.session.execute(
+        export_statement(user_id, year, month).execution_options(yield_per=chunk_size))
+    rows = 0
+    for partition in result.partitions():
+        for row in partition:
+            writer.writerow([row.date.strftime('%Y-%m-%d'), row.description,
+                             row.category_name or '', row.amount])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        rows += len(partition)
+        if progress is not None:
+            progress(rows)
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def gzip_chunks(chunks, encoding='utf-8'):
+    """Comprime en formato gzip un generador de trozos de texto, sin acumularlos."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode(encoding))
+        if data:
+            yield data
+    yield compressor.flush()
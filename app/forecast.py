@@ -0,0 +1,149 @@
+# app/forecast.py
+# Previsión de tesorería a partir de las transacciones recurrentes.
+#
+# Cada recurrente se expande con las mismas reglas que process-recurring
+# (recurring.iter_occurrences, contando desde su start_date) desde su
+# next_date hasta el final del horizonte. Las ocurrencias se generan bajo
+# demanda y se acumulan por día, sin crear objetos por ocurrencia, y
+# después se recorre el calendario una sola vez partiendo del saldo actual:
+# saldo previsto de cada día, días en negativo y días en los que una
+# categoría supera su presupuesto del mes.
+#
+# El resultado se guarda en memoria por usuario, horizonte y día, y se
+# recalcula solo cuando cambian sus movimientos (el saldo), sus recurrentes,
+# sus presupuestos o sus categorías (ver app/versions.py).
+import bisect
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+from itertools import takewhile
+from sqlalchemy import select
+from app import app, db
+from app.models import User, Budget, MonthlyRollup, RecurringTransaction
+from app.recurring import FREQUENCY_STEPS, iter_occurrences
+from app.versions import VersionedCache, data_version
+
+# Horizontes que se pueden pedir, en meses
+HORIZONS = (3, 6, 12, 24, 60)
+
+ForecastDay = namedtuple('ForecastDay', 'date income expense balance over_budget')
+NegativeStretch = namedtuple('NegativeStretch', 'start end lowest')
+BudgetAlert = namedtuple('BudgetAlert', 'date category_id year month budget projected')
+Forecast = namedtuple('Forecast', 'start end opening_balance days negative budget_alerts lowest')
+
+_cache = VersionedCache(max_entries=app.config['FORECAST_CACHE_SIZE'])
+
+
+def _daily_totals(schedules, start, end):
+    """{día: {category_id: importe}} de todas las ocurrencias hasta end.
+
+    Las ocurrencias atrasadas (next_date anterior a start, si el cron no se
+    ha ejecutado aún) se contabilizarán en cuanto se ejecute: cuentan en start.
+    """
+    totals = defaultdict(lambda: defaultdict(int))
+    for start_date, next_date, frequency, amount, category_id in schedules:
+        if frequency not in FREQUENCY_STEPS:
+            continue
+        occurrences = takewhile(lambda moment: moment.date() <= end,
+                                iter_occurrences(start_date, frequency, since=next_date))
+        for moment in occurrences:
+            totals[max(moment.date(), start)][category_id] += amount
+    return totals
+
+
+def _budget_lookup(budgets):
+    """Función (category_id, year, month) -> presupuesto o None.
+
+    Los meses sin presupuesto propio heredan el último que tuvo la categoría:
+    quien presupuesta 300 € de comida este mes lo sigue esperando después.
+    """
+    by_category = defaultdict(list)
+    for category_id, year, month, amount in sorted(budgets):
+        by_category[category_id].append((year * 12 + month, amount))
+
+    def lookup(category_id, year, month):
+        periods = by_category.get(category_id)
+        if not periods:
+            return None
+        index = bisect.bisect_right(periods, (year * 12 + month, float('inf'))) - 1
+        return periods[index][1] if index >= 0 else None
+
+    return lookup
+
+
+def project(opening_balance, schedules, budgets, spent, start, end):
+    """Previsión día a día entre start y end (incluidos).
+
+    schedules: (start_date, next_date, frecuencia, importe, category_id) de cada recurrente.
+    budgets: (category_id, año, mes, importe) de los presupuestos.
+    spent: {category_id: gasto ya realizado en el mes de start}, en positivo.
+    """
+    totals = _daily_totals(schedules, start, end)
+    budget_for = _budget_lookup(budgets)
+    month_spent = defaultdict(int, spent)
+    current_month = (start.year, start.month)
+
+    days, negative, alerts = [], [], []
+    balance = opening_balance
+    lowest = (start, balance)
+    stretch = None
+    day = start
+    while day <= end:
+        if (day.year, day.month) != current_month:
+            current_month = (day.year, day.month)
+            month_spent = defaultdict(int)
+        income = expense = 0
+        over_budget = []
+        for category_id, amount in totals.get(day, {}).items():
+            if amount >= 0:
+                income += amount
+                continue
+            expense += amount
+            budget = budget_for(category_id, day.year, day.month)
+            before = month_spent[category_id]
+            month_spent[category_id] = before - amount
+            # Solo avisamos el día en que se cruza el presupuesto
+            if budget is not None and before <= budget < month_spent[category_id]:
+                over_budget.append(category_id)
+                alerts.append(BudgetAlert(day, category_id, day.year, day.month,
+                                          budget, month_spent[category_id]))
+        balance += income + expense
+        days.append(ForecastDay(day, income, expense, balance, tuple(over_budget)))
+
+        if balance < lowest[1]:
+            lowest = (day, balance)
+        if balance < 0:
+            if stretch is None:
+                stretch = [day, day, balance]
+            stretch[1], stretch[2] = day, min(stretch[2], balance)
+        elif stretch is not None:
+            negative.append(NegativeStretch(*stretch))
+            stretch = None
+        day += timedelta(days=1)
+    if stretch is not None:
+        negative.append(NegativeStretch(*stretch))
+
+    return Forecast(start, end, opening_balance, days, negative, alerts, lowest)
+
+
+def _load(user_id, start, end):
+    opening_balance = db.session.execute(select(User.balance).where(User.id == user_id)).scalar() or 0
+    schedules = db.session.execute(select(
+        RecurringTransaction.start_date, RecurringTransaction.next_date, RecurringTransaction.frequency,
+        RecurringTransaction.amount, RecurringTransaction.category_id
+    ).where(RecurringTransaction.user_id == user_id)).all()
+    budgets = db.session.execute(select(
+        Budget.category_id, Budget.year, Budget.month, Budget.amount
+    ).where(Budget.user_id == user_id)).all()
+    spent = {category_id: abs(expense) for category_id, expense in db.session.execute(select(
+        MonthlyRollup.category_id, MonthlyRollup.expense
+    ).where(MonthlyRollup.user_id == user_id, MonthlyRollup.year == start.year,
+            MonthlyRollup.month == start.month))}
+    return project(opening_balance, schedules, budgets, spent, start, end)
+
+
+def user_forecast(user_id, months=12, today=None):
+    """Forecast del usuario para los próximos meses (uno de HORIZONS)."""
+    start = today or datetime.utcnow().date()
+    end = FREQUENCY_STEPS['monthly'](start, months)
+    version = data_version(user_id, 'transactions', 'recurring', 'budgets', 'categories')
+    return _cache.get_or_load((user_id, months, start), version, lambda: _load(user_id, start, end))
@@ -1,7 +1,8 @@
 # app/forms.py
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired
 from wtforms import StringField, PasswordField, SubmitField, BooleanField, DecimalField, SelectField
-from wtforms.validators import DataRequired, EqualTo, ValidationError
+from wtforms.validators import DataRequired, EqualTo, ValidationError, Optional, Length, NumberRange
 from wtforms.fields import DateField
 from app.models import User
 from datetime import datetime
@@ -26,13 +27,8 @@ class RegistrationForm(FlaskForm):
 class TransactionForm(FlaskForm):
     description = StringField('Descripción', validators=[DataRequired()])
     amount = DecimalField('Cantidad', validators=[DataRequired()])
-    category = SelectField('Categoría', choices=[
-        ('Ingreso', 'Ingreso'),
-        ('Comida', 'Comida'),
-        ('Transporte', 'Transporte'),
-        ('Ocio', 'Ocio'),
-        ('Hogar', 'Hogar')
-    ], validators=[DataRequired()])
+    # Las opciones se rellenan en cada vista con las categorías del usuario
+    category = SelectField('Categoría', coerce=int, validators=[DataRequired()])
     submit = SubmitField('Añadir Transacción')
 
 class CategoryForm(FlaskForm):
@@ -43,6 +39,12 @@ class CategoryForm(FlaskForm):
     ], validators=[DataRequired()])
     submit = SubmitField('Añadir Categoría')
 
+class CategoryRuleForm(FlaskForm):
+    pattern = StringField('Si la descripción contiene', validators=[DataRequired(), Length(max=64)])
+    # Las opciones se rellenan en la vista con las categorías del usuario
+    category = SelectField('Categoría', coerce=int, validators=[DataRequired()])
+    submit = SubmitField('Añadir Regla')
+
 class ReportForm(FlaskForm):
     # Generamos una lista de años desde el actual hasta 2020
     current_year = datetime.utcnow().year
@@ -79,3 +81,34 @@ class RecurringTransactionForm(FlaskForm):
     ], validators=[DataRequired()])
     start_date = DateField('Fecha de Inicio', format='%Y-%m-%d', validators=[DataRequired()])
     submit = SubmitField('Guardar Transacción Recurrente')
+
+class ImportForm(FlaskForm):
+    file = FileField('Extracto bancario', validators=[FileRequired()])
+    format = SelectField('Formato', choices=[
+        ('auto', 'Detectar automáticamente'),
+        ('csv', 'CSV'),
+        ('ofx', 'OFX / QFX'),
+        ('n43', 'Norma 43 (AEB)')
+    ])
+    # Categorías para los movimientos que no traen una que coincida con las del usuario
+    expense_category = SelectField('Categoría para los gastos', coerce=int, validators=[DataRequired()])
+    income_category = SelectField('Categoría para los ingresos', coerce=int, validators=[DataRequired()])
+    submit = SubmitField('Previsualizar')
+
+class SearchForm(FlaskForm):
+    # Se envía por GET: sin token CSRF, para que una búsqueda se pueda enlazar
+    class Meta:
+        csrf = False
+
+    q = StringField('Texto', validators=[Optional(), Length(max=200)])
+    # Las opciones se rellenan en la vista; 0 es "todas"
+    category = SelectField('Categoría', coerce=int, validators=[Optional()])
+    date_from = DateField('Desde', format='%Y-%m-%d', validators=[Optional()])
+    date_to = DateField('Hasta', format='%Y-%m-%d', validators=[Optional()])
+    amount_min = DecimalField('Importe mínimo', validators=[Optional(), NumberRange(min=0)])
+    amount_max = DecimalField('Importe máximo', validators=[Optional(), NumberRange(min=0)])
+    order = SelectField('Ordenar por', choices=[
+        ('date', 'Fecha'),
+        ('relevance', 'Relevancia')
+    ], default='date')
+    submit = SubmitField('Buscar')
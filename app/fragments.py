@@ -0,0 +1,138 @@
+# app/fragments.py
+# Caché de fragmentos HTML ya renderizados (dashboard e informes).
+#
+# Las partes caras de esas páginas (saldo, gráficos, presupuestos, primera
+# página de movimientos) solo cambian cuando cambian los datos del usuario.
+# Cada fragmento se guarda con la clave (usuario, fragmento, periodo) y la
+# versión de los ámbitos de los que depende (ver app/versions.py): mientras
+# la versión no cambie, la página no hace ni las consultas ni el render.
+# Toda escritura (rutas, process-recurring, importaciones, reconstrucciones)
+# ya cambia la versión al hacer commit.
+#
+# Cada proceso guarda los fragmentos en memoria, en un LRU limitado por
+# tamaño (FRAGMENT_CACHE_BYTES). Con FRAGMENT_CACHE_DIR, además, se guardan
+# en disco y los comparten los procesos de gunicorn: lo que renderiza uno ya
+# no lo tiene que renderizar otro.
+#
+# Los aciertos, los fallos, los descartes y la memoria ocupada salen en
+# /metrics (METRICS_ENABLED=true): cada proceso tiene su propia caché y solo
+# allí se suman las de todos.
+import hashlib
+import os
+import sys
+import time
+from collections import OrderedDict
+from markupsafe import Markup
+from app import app, metrics
+from app.versions import data_version
+
+# Cada cuántas escrituras en disco se borran los ficheros caducados
+PURGE_EVERY = 200
+
+
+class FragmentCache:
+    """LRU en memoria (limitado en bytes) con copia opcional en disco."""
+
+    def __init__(self, max_bytes, directory=None, max_age=86400):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_age = max_age
+        self.size = 0
+        self._entries = OrderedDict()
+        self._writes = 0
+
+    def _path(self, key, version):
+        name = hashlib.sha256(repr((key, version)).encode()).hexdigest()
+        return os.path.join(self.directory, name[:2], name + '.html')
+
+    def _read(self, key, version):
+        path = self._path(key, version)
+        try:
+            with open(path, encoding='utf-8') as fragment:
+                html = fragment.read()
+            # La fecha de modificación marca el último uso (ver purge)
+            os.utime(path)
+            return html
+        except FileNotFoundError:
+            return None
+
+    def _write(self, key, version, html):
+        path = self._path(key, version)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fragment:
+            fragment.write(html)
+        os.replace(tmp_path, path)
+        self._writes += 1
+        if self._writes % PURGE_EVERY == 0:
+            self.purge()
+
+    def _store(self, key, version, html):
+        """Guarda en memoria y devuelve cuántos fragmentos se han descartado."""
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size -= previous[2]
+            if self.directory and previous[0] != version:
+                # La versión anterior ya no la va a pedir nadie
+                try:
+                    os.remove(self._path(key, previous[0]))
+                except FileNotFoundError:
+                    pass
+        size = sys.getsizeof(html)
+        self._entries[key] = (version, html, size)
+        self.size += size
+        evictions = 0
+        while self.size > self.max_bytes and self._entries:
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.size -= evicted
+            evictions += 1
+        return evictions
+
+    def get_or_render(self, key, version, render):
+        """(html, origen, descartados): origen es 'memory', 'disk' o 'render' si
+        se ha tenido que generar; descartados, los que ha echado de memoria."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            self._entries.move_to_end(key)
+            return entry[1], 'memory', 0
+
+        html = self._read(key, version) if self.directory else None
+        source = 'disk'
+        if html is None:
+            html, source = str(render()), 'render'
+            if self.directory:
+                self._write(key, version, html)
+        return html, source, self._store(key, version, html)
+
+    def purge(self):
+        """Borra del disco los fragmentos sin usar desde hace max_age segundos."""
+        removed = 0
+        limit = time.time() - self.max_age
+        for directory, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    if os.stat(path).st_mtime < limit:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_cache = FragmentCache(app.config['FRAGMENT_CACHE_BYTES'], app.config['FRAGMENT_CACHE_DIR'],
+                       app.config['FRAGMENT_CACHE_MAX_AGE'])
+
+
+def cached(user_id, name, period, scopes, render):
+    """HTML del fragmento name del usuario para period. render() solo se
+    llama si no está guardado con la versión actual de scopes."""
+    if not app.config['FRAGMENT_CACHE_ENABLED']:
+        return Markup(render())
+    version = data_version(user_id, *scopes)
+    html, source, evictions = _cache.get_or_render((user_id, name, period), version, render)
+    metrics.record_fragment(name, source, len(_cache), _cache.size, evictions)
+    return Markup(html)
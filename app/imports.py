@@ -0,0 +1,497 @@
+# app/imports.py
+# Importación de extractos bancarios: CSV, OFX y Norma 43 (AEB cuaderno 43).
+#
+# - Los ficheros se leen en streaming, línea a línea (o por trozos en OFX):
+#   la memoria no depende del tamaño del extracto.
+# - Cada movimiento lleva un hash de su contenido. Un índice único por
+#   (usuario, hash) impide importar dos veces el mismo movimiento, y antes de
+#   insertar cada bloque se descartan con una sola consulta los que ya están,
+#   así que reimportar un extracto que se solapa con otro no duplica nada.
+# - Primero se hace una previsualización (mismo recorrido, sin escribir) y
+#   después se confirma. Las filas nuevas se insertan por bloques con
+#   executemany y se aplican al ledger en el mismo commit.
+import codecs
+import csv
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from html import unescape
+from sqlalchemy import select, insert
+from app import app, db, archive, ledger, categories, categorizer
+from app.models import Job, Transaction
+from app.text import normalize
+
+ParsedRow = namedtuple('ParsedRow', 'line date amount description category reference')
+RowError = namedtuple('RowError', 'line message')
+
+FORMATS = {'csv': 'CSV', 'ofx': 'OFX / QFX', 'n43': 'Norma 43 (AEB)'}
+DESCRIPTION_LENGTH = 140  # Transaction.description
+_CENT = Decimal('0.01')
+
+_transaction = Transaction.__table__
+
+
+class ImportCategoryError(Exception):
+    """Las categorías por defecto elegidas ya no existen."""
+
+
+# --- Utilidades de lectura ---
+
+def open_text(path):
+    """Abre el fichero como texto. Los bancos españoles exportan a menudo en
+    Windows-1252: si el principio no es UTF-8 válido, usamos esa codificación."""
+    with open(path, 'rb') as head:
+        sample = head.read(65536)
+    try:
+        # Incremental para no fallar si el bloque corta un carácter multibyte
+        codecs.getincrementaldecoder('utf-8')().decode(sample)
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError:
+        encoding = 'cp1252'
+    return open(path, encoding=encoding, errors='replace', newline='')
+
+
+def detect_format(path, filename=''):
+    """'csv', 'ofx' o 'n43' según la extensión y el contenido."""
+    extension = os.path.splitext(filename.lower())[1]
+    if extension in ('.ofx', '.qfx'):
+        return 'ofx'
+    with open_text(path) as text:
+        head = text.read(4096)
+    if 'OFXHEADER' in head or '<OFX>' in head.upper():
+        return 'ofx'
+    first_line = head.splitlines()[0] if head else ''
+    if first_line.startswith('11') and len(first_line.rstrip()) == 80:
+        return 'n43'
+    return 'csv'
+
+
+def parse_amount(text):
+    """Importe con formato español (1.234,56) o inglés (1,234.56) a Decimal."""
+    value = (text or '').strip().replace('€', '').replace('EUR', '').replace(' ', '').replace('\xa0', '')
+    if not value:
+        raise ValueError('importe vacío')
+    negative = False
+    if value.startswith('(') and value.endswith(')'):
+        negative, value = True, value[1:-1]
+    if value.endswith('-'):
+        negative, value = True, value[:-1]
+    # El separador decimal es el último que aparece
+    if ',' in value and '.' in value:
+        if value.rfind(',') > value.rfind('.'):
+            value = value.replace('.', '').replace(',', '.')
+        else:
+            value = value.replace(',', '')
+    elif ',' in value:
+        value = value.replace(',', '.')
+    try:
+        amount = Decimal(value).quantize(_CENT)
+    except InvalidOperation:
+        raise ValueError(f"importe no válido: '{text}'")
+    return -amount if negative else amount
+
+
+_DATE_FORMATS = ('%d/%m/%Y', '%d-%m-%Y', '%Y-%m-%d', '%d/%m/%y', '%d.%m.%Y', '%Y/%m/%d', '%Y%m%d', '%d-%m-%y')
+
+
+class _DateParser:
+    """Prueba los formatos habituales y recuerda el último que funcionó:
+    dentro de un extracto todas las fechas vienen igual. strptime es lento y
+    hay muchos movimientos por día, así que también recuerda cada fecha."""
+
+    def __init__(self):
+        self.last_format = None
+        self.parsed = {}
+
+    def __call__(self, text):
+        text = (text or '').strip()[:10]
+        value = self.parsed.get(text)
+        if value is None:
+            value = self.parsed[text] = self._parse_any(text)
+        return value
+
+    def _parse_any(self, text):
+        if self.last_format:
+            value = self._parse(text, self.last_format)
+            if value:
+                return value
+        for date_format in _DATE_FORMATS:
+            value = self._parse(text, date_format)
+            if value:
+                self.last_format = date_format
+                return value
+        raise ValueError(f"fecha no válida: '{text}'")
+
+    @staticmethod
+    def _parse(text, date_format):
+        try:
+            value = datetime.strptime(text, date_format).date()
+        except ValueError:
+            return None
+        # %Y también acepta '24': un año así es que el formato era %y
+        return value if value.year >= 1900 else None
+
+
+# --- CSV ---
+
+_CSV_COLUMNS = {
+    # En orden de preferencia
+    'date': ('fecha operacion', 'fecha de operacion', 'f. operacion', 'fecha contable', 'fecha',
+             'date', 'booking date', 'fecha valor', 'f. valor'),
+    'description': ('concepto', 'descripcion', 'description', 'movimiento', 'detalle', 'beneficiario',
+                    'payee', 'memo', 'texto'),
+    'amount': ('importe', 'amount', 'cantidad', 'importe (eur)', 'importe eur'),
+    'debit': ('cargo', 'cargos', 'debe', 'debit', 'gasto', 'gastos'),
+    'credit': ('abono', 'abonos', 'haber', 'credit', 'ingreso', 'ingresos'),
+    'category': ('categoria', 'category'),
+}
+
+
+def _csv_columns(header):
+    names = [normalize(name) for name in header]
+    columns = {}
+    for key, candidates in _CSV_COLUMNS.items():
+        for candidate in candidates:
+            if candidate in names:
+                columns[key] = names.index(candidate)
+                break
+    has_amount = 'amount' in columns or ('debit' in columns and 'credit' in columns)
+    if 'date' in columns and has_amount:
+        return columns
+    return None
+
+
+def parse_csv(text):
+    """Movimientos de un CSV con cabecera. Muchos bancos ponen antes unas
+    líneas con el titular o la cuenta: la cabecera es la primera fila que
+    tenga una columna de fecha y otra de importe."""
+    sample = text.read(16384)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=';,\t|')
+    except csv.Error:
+        class dialect(csv.excel):
+            delimiter = ';' if sample.count(';') > sample.count(',') else ','
+    reader = csv.reader(text, dialect)
+    parse_date = _DateParser()
+
+    columns = None
+    for row in reader:
+        columns = _csv_columns(row)
+        if columns:
+            break
+    if columns is None:
+        yield RowError(reader.line_num, 'No se ha encontrado la cabecera (columnas de fecha e importe).')
+        return
+
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+        line = reader.line_num
+        try:
+            value_date = parse_date(row[columns['date']])
+            if 'amount' in columns:
+                amount = parse_amount(row[columns['amount']])
+            else:
+                debit, credit = row[columns['debit']].strip(), row[columns['credit']].strip()
+                amount = parse_amount(credit) if credit else -abs(parse_amount(debit))
+        except (ValueError, IndexError) as error:
+            yield RowError(line, str(error))
+            continue
+        description = row[columns['description']].strip() if 'description' in columns else ''
+        category = row[columns['category']].strip() if 'category' in columns else None
+        yield ParsedRow(line, value_date, amount, description, category, None)
+
+
+# --- OFX (SGML 1.x y XML 2.x) ---
+
+_OFX_TAG = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<]*)')
+_OFX_LIST_END = {'BANKTRANLIST', 'STMTRS', 'CCSTMTRS', 'OFX'}
+
+
+def _ofx_tags(text):
+    """(cierre, etiqueta, valor) de cada etiqueta, leyendo el fichero por trozos."""
+    pending = ''
+    for chunk in iter(lambda: text.read(65536), ''):
+        pending += chunk
+        cut = pending.rfind('<')
+        for match in _OFX_TAG.finditer(pending, 0, cut if cut > 0 else 0):
+            yield match.group(1) == '/', match.group(2).upper(), match.group(3)
+        pending = pending[cut:] if cut > 0 else pending
+    for match in _OFX_TAG.finditer(pending):
+        yield match.group(1) == '/', match.group(2).upper(), match.group(3)
+
+
+def parse_ofx(text):
+    """Movimientos (STMTTRN) de un fichero OFX. La 'línea' es el número de movimiento."""
+    current, number = None, 0
+    for closing, tag, value in _ofx_tags(text):
+        # En SGML los movimientos no siempre se cierran: termina al empezar
+        # el siguiente o al cerrarse la lista que los contiene.
+        if tag == 'STMTTRN' or (closing and tag in _OFX_LIST_END):
+            if current is not None:
+                yield _ofx_row(number, current)
+                current = None
+            if tag == 'STMTTRN' and not closing:
+                current, number = {}, number + 1
+        elif current is not None and not closing and value.strip():
+            current[tag] = unescape(value.strip())
+
+
+def _ofx_row(number, fields):
+    try:
+        value_date = datetime.strptime(fields['DTPOSTED'][:8], '%Y%m%d').date()
+        amount = parse_amount(fields['TRNAMT'])
+    except (KeyError, ValueError) as error:
+        return RowError(number, f'movimiento incompleto o no válido ({error})')
+    name, memo = fields.get('NAME', ''), fields.get('MEMO', '')
+    description = name if not memo or memo == name else f'{name} - {memo}' if name else memo
+    return ParsedRow(number, value_date, amount, description, None, fields.get('FITID'))
+
+
+# --- Norma 43 (registros de 80 posiciones) ---
+
+# Conceptos comunes de la AEB, para los movimientos sin texto propio
+_N43_CONCEPTS = {
+    '01': 'Talones / reintegros', '02': 'Abonarés / entregas / ingresos', '03': 'Recibos domiciliados',
+    '04': 'Transferencias / traspasos', '05': 'Amortización de préstamos', '06': 'Remesas de efectos',
+    '07': 'Suscripciones', '08': 'Dividendos / cupones', '09': 'Operaciones de bolsa',
+    '10': 'Cheques gasolina', '11': 'Cajero automático', '12': 'Tarjetas', '13': 'Operaciones con el extranjero',
+    '14': 'Devoluciones e impagados', '15': 'Nóminas / seguros sociales', '16': 'Timbres / corretajes',
+    '17': 'Intereses / comisiones / gastos', '98': 'Anulaciones / correcciones', '99': 'Varios',
+}
+
+
+def parse_norma43(text):
+    """Movimientos (registro 22) con sus conceptos complementarios (registros 23)."""
+    pending = None
+    for line_number, line in enumerate(text, 1):
+        line = line.rstrip('\r\n')
+        code = line[:2]
+        if code == '23' and pending is not None:
+            pending[2].extend(part.strip() for part in (line[4:42], line[42:80]) if part.strip())
+            continue
+        if pending is not None:
+            yield _norma43_row(*pending)
+            pending = None
+        if code == '22':
+            pending = (line_number, line, [])
+    if pending is not None:
+        yield _norma43_row(*pending)
+
+
+def _norma43_row(line_number, record, concepts):
+    if len(record) < 80:
+        return RowError(line_number, 'registro 22 incompleto')
+    try:
+        value_date = datetime.strptime(record[10:16], '%y%m%d').date()
+        amount = (Decimal(int(record[28:42])) / 100).quantize(_CENT)
+    except ValueError as error:
+        return RowError(line_number, f'registro 22 no válido ({error})')
+    if record[27] == '1':  # 1 = debe (cargo), 2 = haber (abono)
+        amount = -amount
+    description = ' '.join(concepts) or record[64:80].strip() or _N43_CONCEPTS.get(record[22:24], 'Movimiento')
+    return ParsedRow(line_number, value_date, amount, description, None, None)
+
+
+PARSERS = {'csv': parse_csv, 'ofx': parse_ofx, 'n43': parse_norma43}
+
+
+# --- Deduplicación y categorías ---
+
+def _content_hash(row, seen):
+    """Hash estable de un movimiento. Si el banco da un identificador (FITID
+    de OFX) se usa ese. Si no, fecha + importe + descripción, con un contador
+    para los movimientos idénticos del mismo extracto (dos cafés iguales el
+    mismo día son dos movimientos).
+
+    Algunos bancos repiten un FITID dentro del mismo fichero: la repetición
+    con el mismo contenido da el mismo hash (es un duplicado) y la que tiene
+    otro contenido se distingue por él."""
+    content = f'{row.date.isoformat()}|{row.amount}|{normalize(row.description)}'
+    if row.reference:
+        base = f'ref|{row.reference}'
+        if seen.setdefault(base, content) != content:
+            base = f'{base}|{content}'
+    else:
+        seen[content] = seen.get(content, 0) + 1
+        base = f'{content}|{seen[content]}'
+    return hashlib.sha1(base.encode()).hexdigest()
+
+
+def _already_imported(user_id, hashes):
+    """Hashes de la lista que el usuario ya tiene importados (una consulta)."""
+    if not hashes:
+        return set()
+    found = set(db.session.scalars(select(_transaction.c.import_hash).where(
+        _transaction.c.user_id == user_id, _transaction.c.import_hash.in_(hashes))))
+    # Un extracto antiguo puede solaparse con años ya archivados
+    return found | archive.archived_hashes(user_id, [h for h in hashes if h not in found])
+
+
+class _CategoryMapper:
+    """Categoría de cada movimiento: la de la columna 'categoría' del CSV si
+    coincide con una del usuario; si no, la que sugiera la categorización
+    automática (reglas e historial del usuario) y, si tampoco, la categoría
+    por defecto según el signo."""
+
+    def __init__(self, user_id, expense_category_id, income_category_id):
+        self.user_id = user_id
+        self.by_name = {normalize(c.name): c for c in categories.user_categories(user_id)}
+        self.model = categorizer.user_model(user_id)
+        self.expense = categories.get_category(user_id, expense_category_id)
+        self.income = categories.get_category(user_id, income_category_id)
+        # Se eligieron al previsualizar: entretanto se pueden haber borrado
+        if self.expense is None or self.income is None:
+            raise ImportCategoryError('La categoría por defecto de gastos o de ingresos ya no existe. '
+                                      'Vuelve a subir el extracto y elige otra.')
+
+    def __call__(self, row):
+        if row.category:
+            category = self.by_name.get(normalize(row.category))
+            if category is not None:
+                return category
+        suggestion = self.model.suggest(row.description, row.amount)
+        if suggestion is not None:
+            category = categories.get_category(self.user_id, suggestion.category_id)
+            if category is not None:
+                return category
+        return self.income if row.amount > 0 else self.expense
+
+
+# --- Previsualización e importación ---
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def process(path, file_format, user_id, expense_category_id, income_category_id,
+            write=False, batch_size=1000, sample_size=20, max_errors=20, progress=None):
+    """Recorre el extracto y devuelve un resumen. Con write=True inserta las
+    filas nuevas (sin commit). Con write=False solo previsualiza.
+
+    progress(líneas), si se pasa, recibe después de cada bloque las líneas
+    ya leídas (movimientos y líneas con errores). Puede hacer commit: cada
+    bloque se inserta junto con su parte del ledger.
+
+    Lanza ImportCategoryError si alguna de las categorías por defecto no existe.
+    """
+    mapper = _CategoryMapper(user_id, expense_category_id, income_category_id)
+    summary = {'rows': 0, 'new': 0, 'duplicates': 0, 'errors': [], 'error_count': 0,
+               'income': Decimal(0), 'expense': Decimal(0), 'first_date': None, 'last_date': None,
+               'sample': [], 'seconds': 0}
+    started = time.perf_counter()
+    seen = {}
+    # Hashes ya vistos en este fichero: una repetición es un duplicado, no
+    # un segundo INSERT que el índice único rechazaría
+    in_file = set()
+
+    with open_text(path) as text:
+        for batch in _batches(PARSERS[file_format](text), batch_size):
+            parsed = []
+            for row in batch:
+                if isinstance(row, RowError):
+                    summary['error_count'] += 1
+                    if len(summary['errors']) < max_errors:
+                        summary['errors'].append(row)
+                    continue
+                parsed.append((row, _content_hash(row, seen)))
+
+            existing = _already_imported(user_id, [h for _, h in parsed])
+            new_rows = []
+            for row, row_hash in parsed:
+                category = mapper(row)
+                duplicate = row_hash in existing or row_hash in in_file
+                in_file.add(row_hash)
+                summary['rows'] += 1
+                if len(summary['sample']) < sample_size:
+                    summary['sample'].append({'date': row.date, 'description': row.description,
+                                              'amount': row.amount, 'category': category.name,
+                                              'duplicate': duplicate})
+                if duplicate:
+                    summary['duplicates'] += 1
+                    continue
+                summary['new'] += 1
+                summary['income' if row.amount > 0 else 'expense'] += row.amount
+                if summary['first_date'] is None or row.date < summary['first_date']:
+                    summary['first_date'] = row.date
+                if summary['last_date'] is None or row.date > summary['last_date']:
+                    summary['last_date'] = row.date
+                new_rows.append({
+                    'description': row.description[:DESCRIPTION_LENGTH],
+                    'amount': row.amount,
+                    'date': datetime.combine(row.date, datetime.min.time()),
+                    'category_id': category.id,
+                    'user_id': user_id,
+                    'import_hash': row_hash,
+                })
+
+            if write and new_rows:
+                db.session.execute(insert(_transaction), new_rows)
+                ledger.apply_transactions(
+                    (row['user_id'], row['category_id'], row['amount'], row['date']) for row in new_rows)
+            if progress is not None:
+                progress(summary['rows'] + summary['error_count'])
+
+    summary['seconds'] = time.perf_counter() - started
+    return summary
+
+
+# --- Ficheros pendientes de confirmar ---
+
+def save_upload(file_storage, user_id):
+    """Guarda el fichero subido hasta que se confirme. Devuelve su token."""
+    directory = app.config['IMPORT_DIR']
+    os.makedirs(directory, exist_ok=True)
+    # De paso, borramos los que nadie confirmó ni canceló
+    limit = time.time() - app.config['IMPORT_MAX_AGE']
+    stale = [name for name in os.listdir(directory) if os.path.getmtime(os.path.join(directory, name)) < limit]
+    if stale:
+        pending = _pending_uploads()
+        for name in stale:
+            if name not in pending:
+                os.remove(os.path.join(directory, name))
+    token = uuid.uuid4().hex
+    file_storage.save(upload_path(user_id, token))
+    return token
+
+
+def _pending_uploads():
+    """Nombres de los ficheros subidos que aún necesita una importación en
+    cola o en marcha (ver app/jobs.py): el trabajo los borra al terminar."""
+    rows = db.session.execute(select(Job.user_id, Job.params).where(
+        Job.kind == 'import_statement', Job.status.in_(('queued', 'running')))).all()
+    names = set()
+    for user_id, params in rows:
+        try:
+            names.add(os.path.basename(upload_path(user_id, json.loads(params).get('token'))))
+        except ValueError:
+            pass
+    return names
+
+
+def upload_path(user_id, token):
+    # El token viene de la sesión, pero lo validamos igual: es parte de una ruta
+    if not re.fullmatch(r'[0-9a-f]{32}', token or ''):
+        raise ValueError('token no válido')
+    return os.path.join(app.config['IMPORT_DIR'], f'{user_id}-{token}')
+
+
+def discard_upload(user_id, token):
+    try:
+        os.remove(upload_path(user_id, token))
+    except (FileNotFoundError, ValueError):
+        pass
@@ -0,0 +1,123 @@
+# app/instrumentation.py
+# Instrumentación de SQL por petición (opcional: PERF_INSTRUMENTATION=true).
+#
+# - Cuenta las consultas y el tiempo de base de datos de cada petición y los
+#   envía en la cabecera Server-Timing (visible en las herramientas de
+#   desarrollo del navegador, pestaña Red > Tiempos).
+# - Escribe en un log aparte (PERF_LOG_FILE) las peticiones y las consultas
+#   que superan los umbrales, con el endpoint y el SQL normalizado.
+# - Avisa de posibles N+1: la misma sentencia repetida más de
+#   PERF_N_PLUS_ONE_THRESHOLD veces en una sola petición.
+#
+# Las respuestas en streaming (export_csv) siguen consultando después de
+# enviar las cabeceras: su Server-Timing solo incluye lo que pasó antes, pero
+# el log se escribe al cerrar la respuesta, con todo.
+import logging
+import os
+import re
+import time
+from collections import Counter
+from logging.handlers import RotatingFileHandler
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app
+
+perf_logger = logging.getLogger('contabilidad.perf')
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_sql(statement):
+    """SQL sin literales ni listas de parámetros, para agrupar sentencias iguales."""
+    statement = _STRING_LITERAL.sub('?', statement)
+    statement = _NUMBER_LITERAL.sub('?', statement)
+    statement = _PLACEHOLDER_LIST.sub('(?...)', statement)
+    return _WHITESPACE.sub(' ', statement).strip()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # El inicio va en el contexto de la sentencia y no en la conexión: si la
+    # sentencia falla, after_cursor_execute no llega, y con el contexto se
+    # descarta sin dejar nada atrás. Sin contexto (consultas internas del
+    # dialecto al conectar) no se mide.
+    if context is not None:
+        context._perf_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_perf_started', None)
+    if started is None:
+        return
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if not has_request_context() or 'perf' not in g:
+        return
+    perf = g.perf
+    perf['queries'] += 1
+    perf['db_ms'] += elapsed_ms
+    # Las métricas solo usan los dos contadores de arriba; lo demás es para
+    # el log. Se cuenta el SQL tal cual y se normaliza al escribir el log.
+    if not app.config['PERF_INSTRUMENTATION']:
+        return
+    perf['statements'][statement] += 1
+    if elapsed_ms >= app.config['PERF_SLOW_QUERY_MS']:
+        perf_logger.warning(f"Consulta lenta {elapsed_ms:.1f} ms en {request.method} {request.endpoint}: "
+                            f"{normalize_sql(statement)}")
+
+
+def _start_request():
+    g.perf = {'started': time.perf_counter(), 'queries': 0, 'db_ms': 0.0, 'statements': Counter()}
+
+
+def _finish_request(response):
+    perf = g.get('perf')
+    if perf is None:
+        return response
+    total_ms = (time.perf_counter() - perf['started']) * 1000
+    response.headers.add('Server-Timing',
+                         f'db;dur={perf["db_ms"]:.1f};desc="SQL ({perf["queries"]})", '
+                         f'app;dur={total_ms - perf["db_ms"]:.1f}, total;dur={total_ms:.1f}')
+    # El log se escribe al cerrar la respuesta: en las que van en streaming es
+    # cuando el generador ya ha terminado y se conocen todas las consultas.
+    endpoint = f'{request.method} {request.endpoint or request.path}'
+    response.call_on_close(lambda: _log_request(perf, endpoint))
+    return response
+
+
+def _log_request(perf, endpoint):
+    total_ms = (time.perf_counter() - perf['started']) * 1000
+    if total_ms >= app.config['PERF_SLOW_REQUEST_MS']:
+        perf_logger.warning(f"Petición lenta {total_ms:.1f} ms {endpoint}: "
+                            f"{perf['queries']} consultas, {perf['db_ms']:.1f} ms en SQL")
+    # Sentencias que solo se distinguen por sus literales cuentan juntas
+    repeated = Counter()
+    for statement, count in perf['statements'].items():
+        repeated[normalize_sql(statement)] += count
+    for statement, count in repeated.items():
+        if count > app.config['PERF_N_PLUS_ONE_THRESHOLD']:
+            perf_logger.warning(f"Posible N+1 en {endpoint}: {count} veces la misma consulta: {statement}")
+
+
+def _configure_log():
+    log_file = app.config['PERF_LOG_FILE']
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    handler = RotatingFileHandler(log_file, maxBytes=1024 * 1024, backupCount=5)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [pid %(process)d]: %(message)s'))
+    perf_logger.addHandler(handler)
+    perf_logger.setLevel(logging.INFO)
+    # Que no acabe también en auth.log a través del logger de la aplicación
+    perf_logger.propagate = False
+
+
+# Los contadores por petición (g.perf) también los usan las métricas de
+# app/metrics.py; la cabecera y el log solo con PERF_INSTRUMENTATION.
+if app.config['PERF_INSTRUMENTATION'] or app.config['METRICS_ENABLED']:
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    app.before_request(_start_request)
+if app.config['PERF_INSTRUMENTATION']:
+    _configure_log()
+    app.after_request(_finish_request)
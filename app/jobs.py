@@ -0,0 +1,491 @@
+# app/jobs.py
+# Trabajos en segundo plano sin broker externo.
+#
+# La cola es la tabla 'job' de la propia base de datos. Las peticiones web
+# solo insertan una fila (enqueue) y devuelven su id; los procesos de
+# 'flask worker' van reclamando trabajos y los ejecutan fuera de gunicorn,
+# así una exportación de varios años o una importación grande no ocupan un
+# proceso web ni se cortan por el timeout.
+#
+# - Reclamar un trabajo es un único UPDATE condicionado (status='queued' y
+#   los límites de concurrencia por tipo y por usuario): aunque dos procesos
+#   elijan el mismo, solo a uno le afecta el UPDATE.
+# - El estado del trabajo se escribe por una conexión propia y no por la
+#   sesión, que es del handler y puede estar a mitad de una transacción.
+# - Los fallos se reintentan con espera creciente hasta max_attempts. Un
+#   trabajo cuyo proceso muere (sin latido en JOB_STALE_AFTER) vuelve a la cola.
+# - Cancelar un trabajo en cola es inmediato; uno en marcha se detiene en el
+#   siguiente latido (JobContext.progress).
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, func
+from app import app, db, exports, imports, ledger, metrics
+from app.database import run_with_retry
+from app.models import Job
+
+FINISHED = ('done', 'failed', 'cancelled')
+PENDING = ('queued', 'running')
+
+STATUS_NAMES = {'queued': 'En cola', 'running': 'En curso', 'done': 'Terminado',
+                'failed': 'Fallido', 'cancelled': 'Cancelado'}
+KIND_NAMES = {'export_csv': 'Exportación a CSV', 'import_statement': 'Importación de extracto',
+              'rebuild_balances': 'Recalcular saldos', 'rebuild_rollups': 'Regenerar resumen mensual'}
+
+_job = Job.__table__
+
+# Funciones que ejecutan cada tipo de trabajo (ver el decorador handler)
+HANDLERS = {}
+
+
+class JobError(Exception):
+    """Error definitivo: el trabajo falla sin más reintentos."""
+
+
+class JobCancelled(Exception):
+    """El usuario ha cancelado el trabajo mientras se ejecutaba."""
+
+
+class QueueFull(Exception):
+    """El usuario ya tiene demasiados trabajos pendientes."""
+
+
+def handler(kind):
+    """Registra la función que ejecuta los trabajos de un tipo.
+
+    Recibe un JobContext y devuelve un diccionario con el resultado, que se
+    guarda en JSON y se enseña en la página del trabajo.
+    """
+    def decorator(function):
+        HANDLERS[kind] = function
+        return function
+    return decorator
+
+
+def _execute(statement):
+    """Ejecuta una sentencia sobre la tabla de trabajos en su propia
+    transacción y devuelve las filas afectadas."""
+    def work():
+        with db.engine.begin() as connection:
+            return connection.execute(statement).rowcount
+    return run_with_retry(work, rollback=False)
+
+
+def _kind_limits():
+    limits = {}
+    for item in app.config['JOB_KIND_LIMITS'].split(','):
+        kind, _, limit = item.partition('=')
+        if kind.strip() and limit.strip():
+            limits[kind.strip()] = int(limit)
+    return limits
+
+
+# --- Encolar y consultar (desde las vistas y los comandos CLI) ---
+
+def enqueue(kind, user_id=None, max_attempts=None, **params):
+    """Añade un trabajo a la cola y devuelve el Job. No hace commit.
+
+    Lanza QueueFull si el usuario ya tiene JOB_USER_QUEUE_LIMIT trabajos
+    pendientes: así nadie puede llenar la cola a base de clics.
+    """
+    if kind not in HANDLERS:
+        raise ValueError(f'tipo de trabajo desconocido: {kind}')
+    if user_id is not None:
+        pending = db.session.execute(select(func.count()).select_from(_job).where(
+            _job.c.user_id == user_id, _job.c.status.in_(PENDING))).scalar()
+        if pending >= app.config['JOB_USER_QUEUE_LIMIT']:
+            raise QueueFull()
+    job = Job(user_id=user_id, kind=kind, params=json.dumps(params), status='queued',
+              attempts=0, max_attempts=max_attempts or app.config['JOB_MAX_ATTEMPTS'],
+              run_after=datetime.utcnow(), cancel_requested=False, progress=0)
+    db.session.add(job)
+    db.session.flush()
+    return job
+
+
+def describe(job):
+    """Estado de un trabajo en un diccionario listo para JSON."""
+    return {
+        'id': job.id, 'kind': job.kind, 'kind_name': KIND_NAMES.get(job.kind, job.kind),
+        'status': job.status,
+        'status_name': STATUS_NAMES[job.status], 'finished': job.status in FINISHED,
+        'progress': job.progress, 'total': job.total,
+        'percent': min(100, round(100 * job.progress / job.total)) if job.total else None,
+        'attempts': job.attempts, 'max_attempts': job.max_attempts,
+        'result': json.loads(job.result) if job.result else None,
+        'error': job.error, 'download': bool(job.artifact and job.status == 'done'),
+        'created_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def artifact_path(job):
+    """Ruta del fichero generado por un trabajo terminado, o None."""
+    if job.status != 'done' or not job.artifact:
+        return None
+    path = os.path.join(app.config['JOBS_DIR'], job.artifact)
+    return path if os.path.exists(path) else None
+
+
+def cancel(job):
+    """Cancela un trabajo del usuario. Devuelve False si ya había terminado.
+
+    En cola se cancela en el acto; en marcha se marca y el proceso que lo
+    ejecuta lo detiene en su siguiente latido.
+    """
+    cancelled = _execute(update(_job).where(_job.c.id == job.id, _job.c.status == 'queued').values(
+        status='cancelled', finished_at=datetime.utcnow()))
+    if cancelled:
+        return True
+    requested = _execute(update(_job).where(_job.c.id == job.id, _job.c.status == 'running').values(
+        cancel_requested=True))
+    return bool(requested)
+
+
+# --- Ejecución (en los procesos de 'flask worker') ---
+
+class JobContext:
+    """Lo que recibe un handler: parámetros, progreso y fichero de salida."""
+
+    def __init__(self, job):
+        self.job_id = job.id
+        self.user_id = job.user_id
+        self.params = json.loads(job.params)
+        self.artifact = None
+        self.artifact_name = None
+        self.done = job.progress
+        self.total = None
+        self._last_beat = time.monotonic()
+
+    def progress(self, done, total=None):
+        """Guarda el progreso y sirve de latido, como mucho cada JOB_HEARTBEAT
+        segundos. Lanza JobCancelled si el usuario ha cancelado el trabajo."""
+        self.done = done
+        if total is not None:
+            self.total = total
+        now = time.monotonic()
+        if now - self._last_beat < app.config['JOB_HEARTBEAT']:
+            return
+        self._last_beat = now
+        values = {'progress': done, 'heartbeat_at': datetime.utcnow()}
+        if total is not None:
+            values['total'] = total
+        def beat():
+            with db.engine.begin() as connection:
+                connection.execute(update(_job).where(_job.c.id == self.job_id).values(**values))
+                return connection.execute(select(_job.c.cancel_requested).where(
+                    _job.c.id == self.job_id)).scalar()
+        if run_with_retry(beat, rollback=False):
+            raise JobCancelled()
+
+    def write_artifact(self, name, chunks):
+        """Escribe el fichero del trabajo a partir de trozos de bytes.
+
+        Se escribe con otro nombre y se renombra al terminar: nunca se puede
+        descargar un fichero a medias.
+        """
+        os.makedirs(app.config['JOBS_DIR'], exist_ok=True)
+        self.artifact, self.artifact_name = f'{self.job_id}-{name}', name
+        path = os.path.join(app.config['JOBS_DIR'], self.artifact)
+        with open(f'{path}.part', 'wb') as output:
+            for chunk in chunks:
+                output.write(chunk)
+        os.replace(f'{path}.part', path)
+
+    def discard_artifact(self):
+        if self.artifact is None:
+            return
+        path = os.path.join(app.config['JOBS_DIR'], self.artifact)
+        for leftover in (path, f'{path}.part'):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        self.artifact = self.artifact_name = None
+
+
+def claim(worker):
+    """Reclama el siguiente trabajo que se pueda ejecutar, o devuelve None."""
+    now = datetime.utcnow()
+    with db.engine.connect() as connection:
+        candidates = connection.execute(select(_job.c.id, _job.c.kind, _job.c.user_id).where(
+            _job.c.status == 'queued', _job.c.run_after <= now).order_by(_job.c.id).limit(20)).all()
+    limits = _kind_limits()
+    running = _job.alias('running')
+
+    def running_count(column, value):
+        return select(func.count()).select_from(running).where(
+            running.c.status == 'running', running.c[column] == value).scalar_subquery()
+
+    for candidate in candidates:
+        conditions = [_job.c.id == candidate.id, _job.c.status == 'queued']
+        if candidate.kind in limits:
+            conditions.append(running_count('kind', candidate.kind) < limits[candidate.kind])
+        if candidate.user_id is not None:
+            conditions.append(running_count('user_id', candidate.user_id) < app.config['JOB_USER_LIMIT'])
+        # Un solo UPDATE: la comprobación de límites y el cambio de estado son atómicos
+        claimed = _execute(update(_job).where(*conditions).values(
+            status='running', worker=worker, attempts=_job.c.attempts + 1, cancel_requested=False,
+            started_at=now, heartbeat_at=now, progress=0, total=None, error=None))
+        if claimed:
+            with db.engine.connect() as connection:
+                return connection.execute(select(_job).where(_job.c.id == candidate.id)).one()
+    return None
+
+
+def _finish(job, worker, status, **values):
+    """Cierra un trabajo, salvo que entretanto lo haya recuperado otro proceso."""
+    _execute(update(_job).where(_job.c.id == job.id, _job.c.worker == worker,
+                                _job.c.status == 'running').values(
+        status=status, finished_at=datetime.utcnow(), **values))
+
+
+def run_job(job, worker):
+    """Ejecuta un trabajo reclamado y guarda cómo ha terminado."""
+    context = JobContext(job)
+    started = time.perf_counter()
+    try:
+        function = HANDLERS.get(job.kind)
+        if function is None:
+            raise JobError(f'Tipo de trabajo desconocido: {job.kind}')
+        result = function(context)
+    except JobCancelled:
+        db.session.rollback()
+        context.discard_artifact()
+        status = 'cancelled'
+        _finish(job, worker, status)
+    except JobError as error:
+        db.session.rollback()
+        context.discard_artifact()
+        status = 'failed'
+        _finish(job, worker, status, error=str(error))
+    except Exception as error:
+        db.session.rollback()
+        context.discard_artifact()
+        app.logger.exception(f"El trabajo {job.id} ({job.kind}) ha fallado en el intento {job.attempts}.")
+        if job.attempts < job.max_attempts:
+            status = 'retry'
+            delay = app.config['JOB_RETRY_BACKOFF'] * 2 ** (job.attempts - 1)
+            _execute(update(_job).where(_job.c.id == job.id, _job.c.worker == worker,
+                                        _job.c.status == 'running').values(
+                status='queued', worker=None, error=str(error),
+                run_after=datetime.utcnow() + timedelta(seconds=delay)))
+        else:
+            status = 'failed'
+            _finish(job, worker, status, error=str(error))
+    else:
+        status = 'done'
+        _finish(job, worker, status, result=json.dumps(result or {}), artifact=context.artifact,
+                artifact_name=context.artifact_name, progress=context.done, total=context.total)
+    finally:
+        db.session.remove()
+    metrics.record_job(job.kind, status, time.perf_counter() - started)
+    return status
+
+
+def requeue_stale(now=None):
+    """Devuelve a la cola los trabajos cuyo proceso ha dejado de dar señales.
+
+    Son los que llevan JOB_STALE_AFTER sin latido, y los de procesos de esta
+    máquina que ya no existen (un 'flask worker' reiniciado). Si ya han
+    agotado los intentos, se dan por fallidos.
+    """
+    now = now or datetime.utcnow()
+    limit = now - timedelta(seconds=app.config['JOB_STALE_AFTER'])
+    with db.engine.connect() as connection:
+        running = connection.execute(select(_job.c.id, _job.c.worker, _job.c.heartbeat_at).where(
+            _job.c.status == 'running')).all()
+    host = socket.gethostname()
+    stale = [job.id for job in running
+             if job.heartbeat_at < limit or (job.worker.startswith(f'{host}:') and not _alive(job.worker))]
+    if not stale:
+        return 0
+    running_stale = (_job.c.id.in_(stale), _job.c.status == 'running')
+    _execute(update(_job).where(*running_stale, _job.c.attempts < _job.c.max_attempts).values(
+        status='queued', worker=None, run_after=now,
+        error='El proceso que lo ejecutaba dejó de responder.'))
+    _execute(update(_job).where(*running_stale).values(
+        status='failed', finished_at=now, error='El proceso que lo ejecutaba dejó de responder.'))
+    return len(stale)
+
+
+def _alive(worker):
+    try:
+        os.kill(int(worker.rpartition(':')[2]), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        # Existe, aunque sea de otro usuario
+        pass
+    return True
+
+
+def purge_finished(now=None):
+    """Borra los trabajos terminados hace más de JOB_RETENTION y sus ficheros."""
+    now = now or datetime.utcnow()
+    limit = now - timedelta(seconds=app.config['JOB_RETENTION'])
+    finished = (_job.c.status.in_(FINISHED), _job.c.finished_at < limit)
+    with db.engine.connect() as connection:
+        artifacts = connection.execute(select(_job.c.artifact).where(
+            *finished, _job.c.artifact.isnot(None))).scalars().all()
+    for artifact in artifacts:
+        path = os.path.join(app.config['JOBS_DIR'], artifact)
+        if os.path.exists(path):
+            os.remove(path)
+    return _execute(delete(_job).where(*finished))
+
+
+# --- Pool de procesos de 'flask worker' ---
+
+def _worker_process(stopping, burst):
+    # Ctrl+C lo gestiona el proceso principal: este termina el trabajo en curso
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    with app.app_context():
+        # Conexiones propias: las heredadas del padre no se pueden compartir
+        db.engine.dispose(close=False)
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+        while not stopping.is_set():
+            job = claim(worker)
+            if job is None:
+                if burst:
+                    return
+                stopping.wait(app.config['JOB_POLL_INTERVAL'])
+                continue
+            status = run_job(job, worker)
+            app.logger.info(f"Trabajo {job.id} ({job.kind}): {status}.")
+
+
+def work(processes=None, burst=False, maintenance_interval=30, log=None):
+    """Arranca el pool de procesos y lo mantiene hasta recibir SIGTERM o Ctrl+C.
+
+    Con burst=True cada proceso termina cuando no quedan trabajos en cola
+    (útil desde cron o para vaciar la cola a mano).
+    """
+    processes = max(processes or app.config['JOB_WORKERS'], 1)
+    context = multiprocessing.get_context('fork')
+    stopping = context.Event()
+    pool = []
+
+    def stop(signum, frame):
+        if stopping.is_set():
+            # Segunda señal: no esperamos a que terminen los trabajos en curso
+            for process in pool:
+                process.terminate()
+        stopping.set()
+        if log:
+            log("Deteniendo: se espera a que terminen los trabajos en curso.")
+
+    def spawn():
+        process = context.Process(target=_worker_process, args=(stopping, burst), daemon=False)
+        process.start()
+        return process
+
+    requeued = requeue_stale()
+    purge_finished()
+    if log and requeued:
+        log(f"{requeued} trabajos huérfanos devueltos a la cola.")
+    # Cerramos la sesión y las conexiones del padre antes de crear los hijos
+    db.session.remove()
+    db.engine.dispose()
+
+    previous = (signal.signal(signal.SIGTERM, stop), signal.signal(signal.SIGINT, stop))
+    pool.extend(spawn() for _ in range(processes))
+    if log:
+        log(f"{processes} procesos esperando trabajos (pid {os.getpid()}).")
+    try:
+        last_maintenance = time.monotonic()
+        while any(process.is_alive() for process in pool):
+            time.sleep(1)
+            if stopping.is_set() or burst:
+                continue
+            for index, process in enumerate(pool):
+                if not process.is_alive():
+                    # Un proceso caído se sustituye; su trabajo lo recupera requeue_stale
+                    if log:
+                        log(f"El proceso {process.pid} ha terminado ({process.exitcode}); se arranca otro.")
+                    pool[index] = spawn()
+            if time.monotonic() - last_maintenance >= maintenance_interval:
+                last_maintenance = time.monotonic()
+                requeue_stale()
+                purge_finished()
+                db.session.remove()
+    finally:
+        for process in pool:
+            process.join()
+        signal.signal(signal.SIGTERM, previous[0])
+        signal.signal(signal.SIGINT, previous[1])
+
+
+# --- Tipos de trabajo ---
+
+@handler('export_csv')
+def _export_csv(context):
+    """CSV de un periodo (year=0 / month=0 para todo), opcionalmente en gzip."""
+    year, month = context.params.get('year', 0), context.params.get('month', 0)
+    total = exports.count_rows(context.user_id, year, month)
+    exported = 0
+
+    def progress(rows):
+        nonlocal exported
+        exported = rows
+        context.progress(rows, total)
+
+    chunks = exports.iter_csv(context.user_id, year, month, progress=progress)
+    if context.params.get('gzip'):
+        context.write_artifact('informe_contabilidad.csv.gz', exports.gzip_chunks(chunks))
+    else:
+        context.write_artifact('informe_contabilidad.csv', (chunk.encode('utf-8') for chunk in chunks))
+    context.progress(total, total)
+    return {'rows': exported}
+
+
+@handler('import_statement')
+def _import_statement(context):
+    """Importación confirmada de un extracto ya subido (ver confirm_import).
+
+    Se hace commit en cada bloque: así el latido (que escribe por otra
+    conexión) no espera al bloqueo de escritura de la importación. Si se
+    cancela o se corta, lo ya importado se queda; repetir la importación
+    completa el resto sin duplicar nada (ver imports._content_hash).
+    """
+    params = context.params
+    try:
+        path = imports.upload_path(context.user_id, params['token'])
+    except ValueError:
+        raise JobError('El fichero de la importación no es válido.')
+    if not os.path.exists(path):
+        raise JobError('El fichero subido ha caducado. Vuelve a subirlo.')
+    total = params.get('lines')
+
+    def progress(lines):
+        db.session.commit()
+        context.progress(lines, total)
+
+    try:
+        summary = imports.process(path, params['format'], context.user_id,
+                                  params['expense_category'], params['income_category'], write=True,
+                                  progress=progress)
+    except imports.ImportCategoryError as error:
+        imports.discard_upload(context.user_id, params['token'])
+        raise JobError(str(error))
+    db.session.commit()
+    imports.discard_upload(context.user_id, params['token'])
+    return {'new': summary['new'], 'duplicates': summary['duplicates'],
+            'error_count': summary['error_count']}
+
+
+@handler('rebuild_balances')
+def _rebuild_balances(context):
+    ledger.rebuild_balances(context.params.get('only_user_id'))
+    db.session.commit()
+    return {}
+
+
+@handler('rebuild_rollups')
+def _rebuild_rollups(context):
+    ledger.rebuild_rollups(context.params.get('only_user_id'))
+    db.session.commit()
+    return {}
@@ -0,0 +1,256 @@
+# app/ledger.py
+# Datos materializados a partir de las transacciones:
+#  - Saldos por usuario y por categoría.
+#  - Resumen mensual (MonthlyRollup) por usuario, mes y categoría.
+# En lugar de recorrer todo el historial en cada petición, los mantenemos
+# actualizados en cada escritura. Todas las rutas y comandos que crean,
+# editan o borran transacciones deben pasar por aquí antes del commit.
+# Aquí también se marca el cambio del sello 'transactions' de cada usuario
+# afectado (ver app/versions.py), del que dependen los ETag de la API.
+from collections import defaultdict, namedtuple
+from datetime import datetime
+from sqlalchemy import func, select, update, insert, delete, bindparam, case, extract, tuple_
+from sqlalchemy.dialects import sqlite, postgresql
+from app import db, archive
+from app.models import User, Category, MonthlyRollup, Budget
+from app.versions import mark_changed
+
+# Progreso de un presupuesto ya calculado, listo para pintar en la plantilla
+BudgetProgress = namedtuple('BudgetProgress', 'category_id name budget spent percent status')
+
+_user = User.__table__
+_category = Category.__table__
+_rollup = MonthlyRollup.__table__
+
+
+def apply_transaction(user_id, category_id, amount, date, sign=1):
+    """Aplica (sign=1) o revierte (sign=-1) una transacción sobre los datos
+    materializados. No hace commit."""
+    apply_transactions([(user_id, category_id, amount, date)], sign)
+
+
+def apply_transactions(rows, sign=1):
+    """Versión por lotes de apply_transaction.
+
+    rows es un iterable de tuplas (user_id, category_id, importe, fecha).
+    Los cambios se agregan en Python y se escriben con una sentencia
+    executemany por tabla, así que el coste no depende de cuántas
+    transacciones afectan a la misma cuenta. No hace commit.
+    """
+    user_deltas = defaultdict(int)
+    category_deltas = defaultdict(int)
+    rollup_deltas = defaultdict(lambda: [0, 0, 0])
+
+    for user_id, category_id, amount, date in rows:
+        delta = amount * sign
+        user_deltas[user_id] += delta
+        # Las transacciones sin categoría no se pueden resumir por categoría
+        if category_id is None:
+            continue
+        category_deltas[category_id] += delta
+        totals = rollup_deltas[(user_id, date.year, date.month, category_id)]
+        if amount > 0:
+            totals[0] += delta
+        else:
+            totals[1] += delta
+        totals[2] += sign
+
+    if not user_deltas:
+        return
+    for user_id in user_deltas:
+        mark_changed(user_id, 'transactions')
+
+    # UPDATE ... SET balance = balance + delta: dos escrituras concurrentes no
+    # se pisan porque nunca leemos el saldo en Python.
+    db.session.execute(
+        update(_user).where(_user.c.id == bindparam('b_id'))
+        .values(balance=_user.c.balance + bindparam('b_delta')),
+        [{'b_id': k, 'b_delta': v} for k, v in user_deltas.items()])
+    if category_deltas:
+        db.session.execute(
+            update(_category).where(_category.c.id == bindparam('b_id'))
+            .values(balance=_category.c.balance + bindparam('b_delta')),
+            [{'b_id': k, 'b_delta': v} for k, v in category_deltas.items()])
+    if rollup_deltas:
+        _upsert_rollups([
+            {'user_id': user_id, 'year': year, 'month': month, 'category_id': category_id,
+             'income': income, 'expense': expense, 'count': count}
+            for (user_id, year, month, category_id), (income, expense, count) in rollup_deltas.items()
+        ])
+
+
+def _upsert_rollups(values):
+    """Suma los incrementos a las filas del resumen, creándolas si no existen."""
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        dialect_insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        stmt = dialect_insert(_rollup)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_id', 'year', 'month', 'category_id'],
+            set_={'income': _rollup.c.income + stmt.excluded.income,
+                  'expense': _rollup.c.expense + stmt.excluded.expense,
+                  'count': _rollup.c.count + stmt.excluded.count})
+        db.session.execute(stmt, values)
+        return
+
+    # Otros motores: actualizamos y, si la fila no existía, la insertamos
+    for row in values:
+        result = db.session.execute(
+            update(_rollup).where(
+                _rollup.c.user_id == row['user_id'], _rollup.c.year == row['year'],
+                _rollup.c.month == row['month'], _rollup.c.category_id == row['category_id'])
+            .values(income=_rollup.c.income + row['income'],
+                    expense=_rollup.c.expense + row['expense'],
+                    count=_rollup.c.count + row['count']))
+        if result.rowcount == 0:
+            db.session.execute(insert(_rollup).values(**row))
+
+
+def rebuild_balances(user_id=None):
+    """Recalcula desde cero los saldos a partir de la tabla de transacciones.
+    Si no se indica usuario, se recalculan todos. No hace commit."""
+    # Los años archivados también cuentan para el saldo (ver app/archive.py)
+    transactions = archive.all_transactions()
+    user_total = select(func.coalesce(func.sum(transactions.c.amount), 0)).where(
+        transactions.c.user_id == User.id).scalar_subquery()
+    category_total = select(func.coalesce(func.sum(transactions.c.amount), 0)).where(
+        transactions.c.category_id == Category.id).scalar_subquery()
+
+    users = User.query
+    categories = Category.query
+    if user_id is not None:
+        users = users.filter_by(id=user_id)
+        categories = categories.filter_by(user_id=user_id)
+
+    users.update({User.balance: user_total}, synchronize_session=False)
+    categories.update({Category.balance: category_total}, synchronize_session=False)
+    _mark_rebuilt(user_id)
+
+
+def _mark_rebuilt(user_id=None):
+    # Lo recalculado puede no coincidir con lo que ya se había servido
+    user_ids = [user_id] if user_id is not None else db.session.scalars(select(_user.c.id))
+    for changed_id in user_ids:
+        mark_changed(changed_id, 'transactions')
+
+
+def _rollups_from_transactions(user_id=None):
+    """SELECT que calcula el resumen mensual directamente desde las transacciones."""
+    t = archive.all_transactions().c
+    year = extract('year', t.date)
+    month = extract('month', t.date)
+    query = select(
+        t.user_id, year.label('year'), month.label('month'), t.category_id,
+        func.coalesce(func.sum(case((t.amount > 0, t.amount), else_=0)), 0).label('income'),
+        func.coalesce(func.sum(case((t.amount < 0, t.amount), else_=0)), 0).label('expense'),
+        func.count().label('count')
+    ).where(t.category_id.isnot(None)).group_by(
+        t.user_id, year, month, t.category_id)
+    if user_id is not None:
+        query = query.where(t.user_id == user_id)
+    return query
+
+
+def rebuild_rollups(user_id=None):
+    """Borra y vuelve a generar el resumen mensual. No hace commit."""
+    stmt = delete(_rollup)
+    if user_id is not None:
+        stmt = stmt.where(_rollup.c.user_id == user_id)
+    db.session.execute(stmt)
+    db.session.execute(insert(_rollup).from_select(
+        ['user_id', 'year', 'month', 'category_id', 'income', 'expense', 'count'],
+        _rollups_from_transactions(user_id)))
+    _mark_rebuilt(user_id)
+
+
+def verify_rollups(user_id=None):
+    """Compara el resumen mensual con las transacciones.
+
+    Devuelve una lista de (clave, esperado, guardado) con las diferencias;
+    una lista vacía significa que el resumen está al día.
+    """
+    def as_dict(rows):
+        return {(r.user_id, int(r.year), int(r.month), r.category_id):
+                (round(float(r.income), 2), round(float(r.expense), 2), r.count) for r in rows}
+
+    expected = as_dict(db.session.execute(_rollups_from_transactions(user_id)))
+    stored_query = select(_rollup)
+    if user_id is not None:
+        stored_query = stored_query.where(_rollup.c.user_id == user_id)
+    # Las filas que se han quedado a cero (p. ej. tras borrar) equivalen a no tener fila
+    stored = {k: v for k, v in as_dict(db.session.execute(stored_query)).items() if v[2] != 0}
+
+    return [(key, expected.get(key), stored.get(key))
+            for key in sorted(set(expected) | set(stored))
+            if expected.get(key) != stored.get(key)]
+
+
+# --- Consultas de lectura sobre el resumen mensual ---
+
+def _period_filter(query, user_id, year=0, month=0):
+    query = query.filter(MonthlyRollup.user_id == user_id)
+    if year:
+        query = query.filter(MonthlyRollup.year == year)
+    if month:
+        query = query.filter(MonthlyRollup.month == month)
+    return query
+
+
+def period_totals(user_id, year=0, month=0):
+    """(ingresos, gastos) del período. 0 en año o mes significa 'todos'."""
+    query = db.session.query(
+        func.coalesce(func.sum(MonthlyRollup.income), 0),
+        func.coalesce(func.sum(MonthlyRollup.expense), 0))
+    return tuple(_period_filter(query, user_id, year, month).one())
+
+
+def expenses_by_category(user_id, year, month):
+    """[(nombre de categoría, total gastado en positivo)] del mes, de mayor a menor."""
+    query = db.session.query(
+        Category.name, func.sum(MonthlyRollup.expense * -1).label('total_gastado')
+    ).join(Category, MonthlyRollup.category_id == Category.id).filter(MonthlyRollup.expense < 0)
+    return _period_filter(query, user_id, year, month).group_by(Category.name).order_by(
+        func.sum(MonthlyRollup.expense).asc()).all()
+
+
+def monthly_evolution(user_id, months=6, today=None):
+    """Ingresos y gastos de los últimos 'months' meses (incluido el actual)."""
+    today = today or datetime.utcnow()
+    first = today.year * 12 + today.month - 1 - (months - 1)
+    first_year, first_month = divmod(first, 12)
+    return db.session.query(
+        MonthlyRollup.year, MonthlyRollup.month,
+        func.sum(MonthlyRollup.income).label('total_income'),
+        func.sum(MonthlyRollup.expense).label('total_expenses')
+    ).filter(
+        MonthlyRollup.user_id == user_id,
+        tuple_(MonthlyRollup.year, MonthlyRollup.month) >= tuple_(first_year, first_month + 1)
+    ).group_by(MonthlyRollup.year, MonthlyRollup.month).order_by(
+        MonthlyRollup.year, MonthlyRollup.month).all()
+
+
+def budget_progress(user_id, year, month):
+    """Lista de BudgetProgress del mes, en una sola consulta.
+
+    Se parte de los presupuestos (no de los gastos), así que un presupuesto
+    sin ningún gasto en el mes aparece con 0 gastado.
+    """
+    rows = db.session.query(
+        Budget.category_id, Category.name, Budget.amount,
+        func.coalesce(MonthlyRollup.expense, 0)
+    ).join(Category, Budget.category_id == Category.id).outerjoin(
+        MonthlyRollup, (MonthlyRollup.user_id == Budget.user_id)
+        & (MonthlyRollup.category_id == Budget.category_id)
+        & (MonthlyRollup.year == Budget.year)
+        & (MonthlyRollup.month == Budget.month)
+    ).filter(
+        Budget.user_id == user_id, Budget.year == year, Budget.month == month
+    ).order_by(Category.name).all()
+
+    progress = []
+    for category_id, name, budget, expense in rows:
+        spent = abs(expense)
+        percent = round(spent / budget * 100) if budget > 0 else 0
+        status = 'success' if percent <= 75 else 'warning' if percent <= 100 else 'danger'
+        progress.append(BudgetProgress(category_id, name, budget, spent, percent, status))
+    return progress
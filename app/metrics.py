@@ -0,0 +1,173 @@
+# app/metrics.py
+# Métricas en formato Prometheus (opcional: METRICS_ENABLED=true).
+#
+# gunicorn arranca varios procesos y cada uno solo ve sus propias peticiones.
+# prometheus_client en modo multiproceso guarda los valores de cada proceso
+# en ficheros mmap dentro de METRICS_DIR, y /metrics los suma todos. El cron
+# de process-recurring escribe en el mismo directorio, así que sus contadores
+# también salen en /metrics.
+#
+# gunicorn.conf.py vacía el directorio al arrancar y marca los procesos que
+# terminan, para que no se acumulen ficheros de procesos muertos.
+import hmac
+import os
+import time
+from flask import Response, abort, g, request, got_request_exception
+from app import app
+
+if app.config['METRICS_ENABLED']:
+    # prometheus_client decide al importarse si trabaja en modo multiproceso:
+    # la variable tiene que estar definida antes del import.
+    os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', app.config['METRICS_DIR'])
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REQUESTS = Counter('contabilidad_http_requests_total', 'Peticiones atendidas',
+                   ['endpoint', 'method', 'status'])
+REQUEST_LATENCY = Histogram('contabilidad_http_request_duration_seconds',
+                            'Duración de las peticiones (hasta enviar el último byte)',
+                            ['endpoint', 'method'], buckets=_LATENCY_BUCKETS)
+REQUEST_EXCEPTIONS = Counter('contabilidad_http_request_exceptions_total',
+                             'Excepciones no controladas en las vistas', ['endpoint'])
+DB_QUERIES = Counter('contabilidad_db_queries_total', 'Consultas SQL', ['endpoint'])
+DB_TIME = Histogram('contabilidad_db_duration_seconds', 'Tiempo en base de datos por petición',
+                    ['endpoint'], buckets=_LATENCY_BUCKETS)
+
+RECURRING_SCHEDULES = Counter('contabilidad_recurring_schedules_processed_total',
+                              'Recurrentes procesadas por process-recurring')
+RECURRING_POSTED = Counter('contabilidad_recurring_rows_posted_total',
+                           'Transacciones contabilizadas por process-recurring')
+RECURRING_SKIPPED = Counter('contabilidad_recurring_rows_skipped_total',
+                            'Ocurrencias que ya estaban contabilizadas')
+RECURRING_FAILED = Counter('contabilidad_recurring_schedules_failed_total',
+                           'Recurrentes que no se pudieron procesar')
+RECURRING_RUNS = Counter('contabilidad_recurring_runs_total', 'Ejecuciones de process-recurring',
+                         ['status'])
+RECURRING_DURATION = Gauge('contabilidad_recurring_last_run_duration_seconds',
+                           'Duración de la última ejecución de process-recurring',
+                           multiprocess_mode='mostrecent')
+RECURRING_LAST_SUCCESS = Gauge('contabilidad_recurring_last_success_timestamp_seconds',
+                               'Momento (epoch) de la última ejecución completa',
+                               multiprocess_mode='mostrecent')
+
+JOBS = Counter('contabilidad_jobs_total', 'Trabajos en segundo plano ejecutados (retry: fallo que se reintentará)',
+               ['kind', 'status'])
+JOB_DURATION = Histogram('contabilidad_job_duration_seconds', 'Duración de los trabajos en segundo plano',
+                         ['kind'], buckets=_LATENCY_BUCKETS + (60, 300, 900))
+
+LOGINS = Counter('contabilidad_login_attempts_total',
+                 'Intentos de inicio de sesión (limited_*: rechazados sin comprobar la contraseña)',
+                 ['result'])
+LOGIN_BLOCKS = Counter('contabilidad_login_blocks_total', 'Bloqueos del límite de intentos', ['scope'])
+
+FRAGMENTS = Counter('contabilidad_fragment_cache_requests_total',
+                    'Fragmentos pedidos a la caché (source: memory, disk o render si no estaba)',
+                    ['fragment', 'source'])
+FRAGMENT_EVICTIONS = Counter('contabilidad_fragment_cache_evictions_total',
+                             'Fragmentos descartados de memoria por falta de espacio (FRAGMENT_CACHE_BYTES)')
+FRAGMENT_ENTRIES = Gauge('contabilidad_fragment_cache_entries', 'Fragmentos en memoria',
+                         multiprocess_mode='livesum')
+FRAGMENT_BYTES = Gauge('contabilidad_fragment_cache_bytes', 'Memoria ocupada por los fragmentos',
+                       multiprocess_mode='livesum')
+
+
+def _endpoint():
+    # Las URL que no existen van todas a la misma etiqueta para no crear una
+    # serie por cada ruta que se invente un escáner.
+    return request.endpoint or 'not_found'
+
+
+def _observe_request(response):
+    perf = g.get('perf')
+    if perf is None:
+        return response
+    endpoint, method, status = _endpoint(), request.method, str(response.status_code)
+
+    def observe():
+        # Al cerrar la respuesta: en streaming (export_csv) incluye todo el envío
+        REQUEST_LATENCY.labels(endpoint, method).observe(time.perf_counter() - perf['started'])
+        REQUESTS.labels(endpoint, method, status).inc()
+        DB_QUERIES.labels(endpoint).inc(perf['queries'])
+        DB_TIME.labels(endpoint).observe(perf['db_ms'] / 1000)
+
+    response.call_on_close(observe)
+    return response
+
+
+def _count_exception(sender, exception, **extra):
+    REQUEST_EXCEPTIONS.labels(_endpoint()).inc()
+
+
+def record_recurring_run(results, seconds, status):
+    """Suma a las métricas el resultado de una ejecución de process-recurring."""
+    if not app.config['METRICS_ENABLED']:
+        return
+    for stats in results.values():
+        if stats is None:
+            continue
+        RECURRING_SCHEDULES.inc(stats['schedules'])
+        RECURRING_POSTED.inc(stats['posted'])
+        RECURRING_SKIPPED.inc(stats['skipped'])
+        RECURRING_FAILED.inc(stats['failed'])
+    RECURRING_RUNS.labels(status).inc()
+    RECURRING_DURATION.set(seconds)
+    if status == 'done':
+        RECURRING_LAST_SUCCESS.set_to_current_time()
+
+
+def record_job(kind, status, seconds):
+    """Cuenta un intento de un trabajo en segundo plano (ver app/jobs.py)."""
+    if not app.config['METRICS_ENABLED']:
+        return
+    JOBS.labels(kind, status).inc()
+    JOB_DURATION.labels(kind).observe(seconds)
+
+
+def record_login(result, blocked_scope=None):
+    """Cuenta un intento de inicio de sesión (ver app/ratelimit.py)."""
+    if not app.config['METRICS_ENABLED']:
+        return
+    LOGINS.labels(result).inc()
+    if blocked_scope:
+        LOGIN_BLOCKS.labels(blocked_scope).inc()
+
+
+def record_fragment(fragment, source, entries, size, evictions=0):
+    """Cuenta un fragmento servido, los descartados y el tamaño de la caché (ver app/fragments.py)."""
+    if not app.config['METRICS_ENABLED']:
+        return
+    FRAGMENTS.labels(fragment, source).inc()
+    if evictions:
+        FRAGMENT_EVICTIONS.inc(evictions)
+    FRAGMENT_ENTRIES.set(entries)
+    FRAGMENT_BYTES.set(size)
+
+
+def _authorized():
+    """Con METRICS_TOKEN hace falta 'Authorization: Bearer <token>'. Sin token,
+    solo se aceptan peticiones directas desde la propia máquina (Prometheus
+    contra el puerto de gunicorn), nunca las que llegan a través de Nginx."""
+    token = app.config['METRICS_TOKEN']
+    if token:
+        return hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    return (request.remote_addr in ('127.0.0.1', '::1')
+            and 'X-Forwarded-For' not in request.headers and 'X-Real-IP' not in request.headers)
+
+
+@app.route('/metrics')
+def metrics():
+    # 404 y no 403: desde fuera no se debe saber ni que existe
+    if not app.config['METRICS_ENABLED'] or not _authorized():
+        abort(404)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+if app.config['METRICS_ENABLED']:
+    app.after_request(_observe_request)
+    got_request_exception.connect(_count_exception, app)
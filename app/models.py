@@ -1,17 +1,20 @@
 # app/models.py
-from app import db, login_manager
+import hashlib
+from app import db
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
+def password_token(password_hash):
+    """Huella corta del hash de la contraseña: cambia al cambiar la contraseña."""
+    return hashlib.sha256((password_hash or '').encode()).hexdigest()[:16]
 
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     password_hash = db.Column(db.String(128))
+    # Saldo materializado: se actualiza en cada escritura (ver app/ledger.py)
+    balance = db.Column(db.Numeric(12, 2), nullable=False, default=0, server_default='0')
     
     transactions = db.relationship('Transaction', backref='owner', lazy='dynamic')
 
@@ -21,12 +24,19 @@ class User(db.Model, UserMixin):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    def get_id(self):
+        # Lo que Flask-Login guarda en la sesión: con la huella de la contraseña,
+        # cambiarla invalida las sesiones abiertas (ver app/auth.py)
+        return f'{self.id}:{password_token(self.password_hash)}'
+
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), nullable=False)
     # 'type' será 'ingreso' o 'gasto'
     type = db.Column(db.String(10), nullable=False, default='gasto')
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    # Saldo materializado de la categoría (ver app/ledger.py)
+    balance = db.Column(db.Numeric(12, 2), nullable=False, default=0, server_default='0')
 
     def __repr__(self):
         return f'<Category {self.name}>'
@@ -46,6 +56,27 @@ class Transaction(db.Model):
 
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
+    # Si la generó una transacción recurrente: cuál y para qué fecha.
+    # El índice único impide contabilizar dos veces la misma ocurrencia.
+    recurring_id = db.Column(db.Integer, db.ForeignKey('recurring_transaction.id', ondelete='SET NULL'))
+    occurrence_date = db.Column(db.Date)
+
+    # Hash del contenido de los movimientos importados de un extracto (ver
+    # app/imports.py). Único por usuario: reimportar no duplica movimientos.
+    import_hash = db.Column(db.String(40))
+
+    # Índices compuestos: casi todas las consultas filtran por usuario y rango
+    # de fechas (y a veces por categoría). El id va implícito al final del
+    # índice en SQLite, lo que también sirve a la paginación por (fecha, id).
+    __table_args__ = (
+        db.Index('ix_transaction_user_id_date', 'user_id', 'date'),
+        db.Index('ix_transaction_user_id_category_id_date', 'user_id', 'category_id', 'date'),
+        db.Index('uq_transaction_recurring_occurrence', 'recurring_id', 'occurrence_date', unique=True),
+        db.Index('uq_transaction_user_id_import_hash', 'user_id', 'import_hash', unique=True),
+        # Los ids no se reutilizan nunca: no chocan con los de los años archivados
+        {'sqlite_autoincrement': True},
+    )
+
 class RecurringTransaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     description = db.Column(db.String(140))
@@ -60,6 +91,10 @@ class RecurringTransaction(db.Model):
     category = db.relationship('Category')
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
+    __table_args__ = (
+        db.Index('ix_recurring_transaction_user_id_next_date', 'user_id', 'next_date'),
+    )
+
     def __repr__(self):
         return f'<RecurringTransaction {self.description}>'
 
@@ -76,3 +111,101 @@ class Budget(db.Model):
     
     # Restricción para que no haya dos presupuestos para la misma categoría/mes/año/usuario
     __table_args__ = (db.UniqueConstraint('user_id', 'category_id', 'year', 'month', name='_user_category_period_uc'),)
+
+class MonthlyRollup(db.Model):
+    # Resumen mensual por usuario y categoría, mantenido en cada escritura
+    # (ver app/ledger.py). Los informes y gráficos leen de aquí en lugar de
+    # agrupar todas las transacciones.
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Integer, primary_key=True)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), primary_key=True)
+
+    income = db.Column(db.Numeric(12, 2), nullable=False, default=0, server_default='0')
+    # Suma de los importes negativos (siempre <= 0), igual que en la tabla de transacciones
+    expense = db.Column(db.Numeric(12, 2), nullable=False, default=0, server_default='0')
+    count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    category = db.relationship('Category')
+
+class RecurringRun(db.Model):
+    # Una ejecución de 'flask process-recurring'. Si se interrumpe queda en
+    # estado 'running' y la siguiente ejecución del mismo día la reanuda.
+    id = db.Column(db.Integer, primary_key=True)
+    run_date = db.Column(db.Date, nullable=False, index=True)
+    shards = db.Column(db.Integer, nullable=False, default=1)
+    # 'running', 'done' o 'failed'
+    status = db.Column(db.String(10), nullable=False, default='running')
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    shard_states = db.relationship('RecurringRunShard', backref='run', lazy=True,
+                                   order_by='RecurringRunShard.shard')
+
+class RecurringRunShard(db.Model):
+    # Punto de control de un trozo (shard) de usuarios de una ejecución.
+    # Se actualiza en la misma transacción que cada bloque procesado.
+    run_id = db.Column(db.Integer, db.ForeignKey('recurring_run.id'), primary_key=True)
+    shard = db.Column(db.Integer, primary_key=True)
+    # 'pending', 'done' o 'failed'
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    last_schedule_id = db.Column(db.Integer, nullable=False, default=0)
+
+    schedules = db.Column(db.Integer, nullable=False, default=0)
+    posted = db.Column(db.Integer, nullable=False, default=0)
+    skipped = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+
+class CategoryRule(db.Model):
+    # Regla de categorización del usuario: los movimientos cuya descripción
+    # contiene estas palabras van a esta categoría (ver app/categorizer.py).
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
+    pattern = db.Column(db.String(64), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    category = db.relationship('Category')
+
+class CategoryHistory(db.Model):
+    # Cuántos movimientos de cada usuario tienen cada descripción en cada
+    # categoría. Lo mantienen triggers sobre "transaction" (ver su
+    # migración) y es de lo que aprende la categorización automática.
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    description = db.Column(db.String(140), primary_key=True)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+class Job(db.Model):
+    # Trabajo en segundo plano (ver app/jobs.py): la web lo encola y lo
+    # ejecuta un proceso de 'flask worker'. La propia tabla es la cola.
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    kind = db.Column(db.String(32), nullable=False)
+    # Parámetros del trabajo en JSON
+    params = db.Column(db.Text, nullable=False, default='{}')
+    # 'queued', 'running', 'done', 'failed' o 'cancelled'
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    # No se intenta antes de esta hora (reintentos con espera creciente)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    # Proceso que lo está ejecutando (host:pid) y su último latido
+    worker = db.Column(db.String(64))
+    heartbeat_at = db.Column(db.DateTime)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    # Fichero generado, relativo a JOBS_DIR, y el nombre con el que se descarga
+    artifact = db.Column(db.String(128))
+    artifact_name = db.Column(db.String(128))
+    # Resultado en JSON (resumen que se enseña al usuario)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    # Los procesos de 'flask worker' buscan el siguiente trabajo por aquí
+    __table_args__ = (db.Index('ix_job_status_run_after', 'status', 'run_after'),)
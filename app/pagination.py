@@ -0,0 +1,43 @@
+# app/pagination.py
+# Paginación por cursor (keyset) sobre (fecha, id).
+# A diferencia de OFFSET, el coste de cada página es constante: la base de
+# datos salta directamente a la posición del cursor usando el índice, sin
+# recorrer las filas de las páginas anteriores.
+from datetime import datetime
+from sqlalchemy import tuple_
+
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(date, row_id):
+    """Convierte la última fila de una página en un cursor opaco para la URL."""
+    return f"{date.strftime(CURSOR_DATE_FORMAT)}-{row_id}"
+
+
+def decode_cursor(cursor):
+    """Devuelve (fecha, id) o None si el cursor no existe o no es válido."""
+    if not cursor:
+        return None
+    try:
+        date_part, id_part = cursor.split('-', 1)
+        return datetime.strptime(date_part, CURSOR_DATE_FORMAT), int(id_part)
+    except ValueError:
+        return None
+
+
+def keyset_page(query, date_column, id_column, cursor=None, per_page=50):
+    """Devuelve (filas, siguiente_cursor) ordenando de más reciente a más antiguo.
+
+    Las filas de la consulta deben tener los atributos 'date' e 'id'.
+    siguiente_cursor es None cuando ya no quedan más filas.
+    """
+    position = decode_cursor(cursor)
+    if position is not None:
+        query = query.filter(tuple_(date_column, id_column) < tuple_(*position))
+
+    # Pedimos una fila de más para saber si hay página siguiente
+    rows = query.order_by(date_column.desc(), id_column.desc()).limit(per_page + 1).all()
+    if len(rows) <= per_page:
+        return rows, None
+    rows = rows[:per_page]
+    return rows, encode_cursor(rows[-1].date, rows[-1].id)
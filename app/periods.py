@@ -0,0 +1,55 @@
+# app/periods.py
+# Filtros de período (año / mes) que aprovechan los índices sobre la fecha.
+# extract('year', fecha) == 2025 obliga a SQLite a aplicar strftime() a cada
+# fila; en cambio fecha >= '2025-01-01' AND fecha < '2026-01-01' usa el índice.
+from datetime import MAXYEAR, datetime
+from flask import abort, request
+from sqlalchemy import extract
+
+
+def valid_period(year, month=0):
+    """¿Se puede filtrar por este año/mes? (0 = todos). El año llega hasta
+    MAXYEAR - 1 porque el intervalo termina el 1 de enero del año siguiente."""
+    return (year == 0 or 1 <= year < MAXYEAR) and 0 <= month <= 12
+
+
+def request_period(default_year=0, default_month=0):
+    """Año y mes de la URL (?year=&month=). Un período imposible (month=13,
+    year=99999) responde 400 en todas las vistas, en lugar de un 500 al
+    construir las fechas o una respuesta vacía según la vista."""
+    year = request.args.get('year', default_year, type=int)
+    month = request.args.get('month', default_month, type=int)
+    if not valid_period(year, month):
+        abort(400)
+    return year, month
+
+
+def period_range(year, month=0):
+    """Convierte una selección de año/mes en un intervalo semiabierto [inicio, fin).
+
+    0 significa 'todos'. Devuelve None si la selección no es un intervalo
+    continuo (todos los años, o un mes de todos los años). ValueError si la
+    selección no es válida (ver valid_period).
+    """
+    if not valid_period(year, month):
+        raise ValueError(f'Período no válido: año {year}, mes {month}')
+    if not year:
+        return None
+    if not month:
+        return datetime(year, 1, 1), datetime(year + 1, 1, 1)
+    if month == 12:
+        return datetime(year, 12, 1), datetime(year + 1, 1, 1)
+    return datetime(year, month, 1), datetime(year, month + 1, 1)
+
+
+def period_filters(date_column, year=0, month=0):
+    """Lista de condiciones para filtrar date_column por el período elegido."""
+    period = period_range(year, month)
+    if period is not None:
+        start, end = period
+        return [date_column >= start, date_column < end]
+    if month:
+        # Un mismo mes de todos los años no es un intervalo: no queda otra
+        # que extraer el mes de cada fila.
+        return [extract('month', date_column) == month]
+    return []
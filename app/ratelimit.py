@@ -0,0 +1,148 @@
+# app/ratelimit.py
+# Límite de intentos de inicio de sesión, compartido entre procesos.
+#
+# Comprobar una contraseña (scrypt) cuesta a propósito decenas de
+# milisegundos de CPU: una ráfaga de intentos puede ocupar los 3 procesos de
+# gunicorn y dejar sin servicio a los demás usuarios. Antes de calcular
+# ningún hash, cada intento gasta una ficha de dos cubos (token bucket): el
+# de su IP y el del nombre de usuario. Los cubos se rellenan a ritmo
+# constante; si alguno está vacío, el intento se rechaza con un 429.
+#
+# Cada vez que un cubo se vacía queda bloqueado un tiempo que se dobla con
+# cada reincidencia (LOGIN_BACKOFF, hasta LOGIN_BACKOFF_MAX). Las
+# reincidencias se olvidan tras LOGIN_BACKOFF_MAX segundos sin bloqueos, y
+# las de un nombre de usuario también al iniciar sesión con él.
+#
+# El estado está en un fichero SQLite propio (RATELIMIT_DB) y no en app.db:
+# los intentos de un ataque no compiten por el bloqueo de escritura con los
+# movimientos de los usuarios. Son datos desechables, así que sin fsync.
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from flask import request
+from app import app
+
+# allowed: si se puede comprobar la contraseña; scope: 'ip' o 'user', el cubo
+# que lo impide; retry_after: segundos de espera; blocked: el bloqueo empieza ahora
+Decision = namedtuple('Decision', 'allowed scope retry_after blocked')
+
+_ALLOWED = Decision(True, None, 0, False)
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS bucket (
+        key TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated REAL NOT NULL,
+        strikes INTEGER NOT NULL,
+        blocked_until REAL NOT NULL
+    ) WITHOUT ROWID
+"""
+# Cada cuántos intentos por proceso se borran los cubos que ya están como nuevos
+PURGE_EVERY = 500
+# Tope de reincidencias que cuentan para el bloqueo (2 ** 20 ya supera cualquier máximo)
+MAX_STRIKES = 20
+
+_local = threading.local()
+
+
+def _connection():
+    # Una conexión por hilo y proceso: las heredadas de un fork no sirven
+    connection = getattr(_local, 'connection', None)
+    if connection is None or _local.pid != os.getpid():
+        path = app.config['RATELIMIT_DB']
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        connection = sqlite3.connect(path, timeout=app.config['SQLITE_BUSY_TIMEOUT'] / 1000,
+                                     isolation_level=None)
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = OFF')
+        connection.execute(_SCHEMA)
+        _local.connection, _local.pid, _local.calls = connection, os.getpid(), 0
+    return connection
+
+
+def _limits():
+    config = app.config
+    return {'ip': (config['LOGIN_IP_BURST'], config['LOGIN_IP_REFILL']),
+            'user': (config['LOGIN_USER_BURST'], config['LOGIN_USER_REFILL'])}
+
+
+def client_ip():
+    """IP del cliente. Detrás de Nginx (petición desde la propia máquina) es
+    la última de X-Forwarded-For, la que añade Nginx, o X-Real-IP."""
+    address = request.remote_addr
+    if address in ('127.0.0.1', '::1'):
+        forwarded = request.headers.get('X-Forwarded-For')
+        if forwarded:
+            return forwarded.rsplit(',', 1)[-1].strip()
+        return request.headers.get('X-Real-IP', address)
+    return address
+
+
+def _user_key(username):
+    return 'user:' + (username or '').strip().lower()[:64]
+
+
+def acquire(ip, username, now=None):
+    """Gasta una ficha de los cubos de la IP y del usuario, o ninguna si
+    alguno está vacío o bloqueado. Devuelve una Decision."""
+    if not app.config['LOGIN_RATE_LIMIT']:
+        return _ALLOWED
+    now = time.time() if now is None else now
+    backoff, backoff_max = app.config['LOGIN_BACKOFF'], app.config['LOGIN_BACKOFF_MAX']
+    limits = _limits()
+    connection = _connection()
+
+    # BEGIN IMMEDIATE: leer y actualizar los cubos es atómico entre procesos
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        states, denied = [], None
+        for scope, key in (('ip', f'ip:{ip}'), ('user', _user_key(username))):
+            burst, refill = limits[scope]
+            row = connection.execute('SELECT tokens, updated, strikes, blocked_until FROM bucket '
+                                     'WHERE key = ?', (key,)).fetchone()
+            tokens, updated, strikes, blocked_until = row or (burst, now, 0, 0)
+            tokens = min(burst, tokens + max(0, now - updated) / refill)
+            if strikes and now - blocked_until > backoff_max:
+                strikes = 0
+            blocked = False
+            if blocked_until <= now and tokens < 1:
+                strikes = min(strikes + 1, MAX_STRIKES)
+                blocked_until = now + min(backoff * 2 ** (strikes - 1), backoff_max)
+                blocked = True
+            states.append([key, tokens, strikes, blocked_until])
+            if blocked_until > now and (denied is None or blocked_until - now > denied.retry_after):
+                denied = Decision(False, scope, blocked_until - now, blocked)
+        for key, tokens, strikes, blocked_until in states:
+            if denied is None:
+                tokens -= 1
+            connection.execute('INSERT OR REPLACE INTO bucket VALUES (?, ?, ?, ?, ?)',
+                               (key, tokens, now, strikes, blocked_until))
+        connection.execute('COMMIT')
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+
+    _local.calls += 1
+    if _local.calls % PURGE_EVERY == 0:
+        purge(now)
+    if denied is None:
+        return _ALLOWED
+    return denied._replace(retry_after=math.ceil(denied.retry_after))
+
+
+def succeeded(username):
+    """Inicio de sesión correcto: se olvidan los fallos de ese usuario."""
+    if app.config['LOGIN_RATE_LIMIT']:
+        _connection().execute('DELETE FROM bucket WHERE key = ?', (_user_key(username),))
+
+
+def purge(now=None):
+    """Borra los cubos llenos y sin reincidencias pendientes (equivalen a no
+    tener fila). Devuelve cuántos."""
+    now = time.time() if now is None else now
+    backoff_max = app.config['LOGIN_BACKOFF_MAX']
+    full_after = max(burst * refill for burst, refill in _limits().values())
+    return _connection().execute('DELETE FROM bucket WHERE updated < ? AND blocked_until < ?',
+                                 (now - full_after, now - backoff_max)).rowcount
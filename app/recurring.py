@@ -0,0 +1,347 @@
+# app/recurring.py
+# Procesado de las transacciones recurrentes.
+#
+# - Se ponen al día todas las ocurrencias pendientes: si el cron no se ha
+#   ejecutado en tres meses, una recurrente mensual genera tres movimientos.
+# - Las recurrentes se leen por bloques (sin cargar objetos ORM) y las
+#   transacciones se insertan con un executemany por bloque, con un commit
+#   por bloque en lugar de una única transacción gigante.
+# - Es idempotente: cada transacción generada guarda (recurring_id,
+#   occurrence_date) con un índice único, y antes de insertar se descartan
+#   las ocurrencias ya contabilizadas. Repetir la ejecución no duplica nada.
+# - Se puede repartir por usuario entre varios procesos (shards). Cada shard
+#   hace commit por bloques y guarda un punto de control, así que una
+#   ejecución interrumpida se reanuda donde se quedó.
+import calendar
+import multiprocessing
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, date, timedelta
+from sqlalchemy import select, insert, update, bindparam
+from sqlalchemy.exc import SQLAlchemyError
+from app import app, db, ledger, metrics
+from app.database import run_with_retry, is_locked_error
+from app.models import Transaction, RecurringTransaction, RecurringRun, RecurringRunShard
+
+
+def _add_months(value, months):
+    """Suma meses como relativedelta (el 31 pasa al último día de los meses
+    más cortos), pero sin su coste, que domina cuando hay muchas fechas."""
+    month_index = value.month - 1 + months
+    year, month = value.year + month_index // 12, month_index % 12 + 1
+    day = min(value.day, calendar.monthrange(year, month)[1])
+    return value.replace(year=year, month=month, day=day)
+
+
+# Fecha de la ocurrencia n de cada frecuencia a partir de la primera
+FREQUENCY_STEPS = {
+    'monthly': lambda first, n: _add_months(first, n),
+    'weekly': lambda first, n: first + timedelta(weeks=n),
+    'yearly': lambda first, n: _add_months(first, 12 * n),
+}
+
+_transaction = Transaction.__table__
+_recurring = RecurringTransaction.__table__
+
+
+def occurrence_index(first_date, frequency, moment):
+    """Número n de la primera ocurrencia (contando desde first_date, la 0)
+    que cae en moment o después."""
+    if frequency == 'weekly':
+        n = (moment - first_date).days // 7
+    else:
+        months = (moment.year - first_date.year) * 12 + moment.month - first_date.month
+        n = months if frequency == 'monthly' else months // 12
+    # La estimación puede pasarse en uno (día del mes u hora); se ajusta hacia delante
+    n = max(n - 1, 0)
+    nth = FREQUENCY_STEPS[frequency]
+    while nth(first_date, n) < moment:
+        n += 1
+    return n
+
+
+def iter_occurrences(first_date, frequency, since=None):
+    """Genera sin fin las fechas de una recurrente que empieza en first_date,
+    desde la primera que cae en since o después (por defecto, desde el principio).
+
+    Cada fecha se calcula desde la primera (first_date + n * periodo) para
+    que un día 31 no se vaya desplazando tras pasar por un mes más corto.
+    Por eso se parte de start_date y no de next_date, que puede ser ya un
+    día recortado (el 28 de febrero de una recurrente del 31).
+    """
+    nth = FREQUENCY_STEPS[frequency]
+    n = occurrence_index(first_date, frequency, since) if since is not None else 0
+    while True:
+        yield nth(first_date, n)
+        n += 1
+
+
+def due_occurrences(start_date, next_date, frequency, today):
+    """Devuelve (fechas pendientes desde next_date hasta today incluido, nueva next_date)."""
+    dates = []
+    for occurrence in iter_occurrences(start_date, frequency, since=next_date):
+        if occurrence.date() > today:
+            return dates, occurrence
+        dates.append(occurrence)
+
+
+def _due_schedules(limit, after_id, chunk_size, shard=0, shards=1):
+    query = select(_recurring.c.id, _recurring.c.user_id, _recurring.c.category_id,
+                   _recurring.c.description, _recurring.c.amount,
+                   _recurring.c.frequency, _recurring.c.start_date, _recurring.c.next_date).where(
+        _recurring.c.next_date < limit, _recurring.c.id > after_id)
+    if shards > 1:
+        # Repartimos por usuario: todas las recurrentes de un usuario caen en
+        # el mismo shard, así dos procesos nunca tocan el mismo saldo.
+        query = query.where(_recurring.c.user_id % shards == shard)
+    return db.session.execute(query.order_by(_recurring.c.id).limit(chunk_size)).all()
+
+
+def _already_posted(rows):
+    """Conjunto de (recurring_id, occurrence_date) de rows que ya existen."""
+    if not rows:
+        return set()
+    recurring_ids = {row['recurring_id'] for row in rows}
+    first_date = min(row['occurrence_date'] for row in rows)
+    return set(db.session.execute(
+        select(_transaction.c.recurring_id, _transaction.c.occurrence_date).where(
+            _transaction.c.recurring_id.in_(recurring_ids),
+            _transaction.c.occurrence_date >= first_date)).all())
+
+
+def _expand(schedules, today, stats, log):
+    """Devuelve (filas de transacciones a crear, nuevas next_date) de un bloque."""
+    rows = []
+    advances = []
+    for schedule in schedules:
+        if schedule.frequency not in FREQUENCY_STEPS:
+            stats['invalid'] += 1
+            if log:
+                log(f"Frecuencia desconocida '{schedule.frequency}' en la recurrente {schedule.id}; se ignora.")
+            continue
+        dates, new_next_date = due_occurrences(schedule.start_date, schedule.next_date,
+                                                 schedule.frequency, today)
+        rows.extend({
+            'description': schedule.description, 'amount': schedule.amount,
+            'date': occurrence, 'category_id': schedule.category_id,
+            'user_id': schedule.user_id, 'recurring_id': schedule.id,
+            'occurrence_date': occurrence.date(),
+        } for occurrence in dates)
+        advances.append({'b_id': schedule.id, 'b_next_date': new_next_date})
+    return rows, advances
+
+
+def _write(rows, advances, dry_run=False):
+    """Inserta las ocurrencias nuevas y avanza next_date. No hace commit.
+
+    Devuelve las filas creadas (o las que se crearían en dry_run).
+    """
+    posted = _already_posted(rows)
+    new_rows = [row for row in rows if (row['recurring_id'], row['occurrence_date']) not in posted]
+    if dry_run:
+        return new_rows
+
+    if new_rows:
+        db.session.execute(insert(_transaction), new_rows)
+        ledger.apply_transactions(
+            (row['user_id'], row['category_id'], row['amount'], row['date']) for row in new_rows)
+    if advances:
+        db.session.execute(
+            update(_recurring).where(_recurring.c.id == bindparam('b_id'))
+            .values(next_date=bindparam('b_next_date')), advances)
+    return new_rows
+
+
+def process_due(today=None, chunk_size=1000, log=None, shard=0, shards=1,
+                checkpoint=None, dry_run=False):
+    """Contabiliza todas las ocurrencias pendientes hasta today (incluido).
+
+    Con shards > 1 solo procesa las recurrentes de los usuarios de este
+    shard. Si se pasa checkpoint (RecurringRunShard) se continúa desde su
+    última recurrente y se actualiza en la misma transacción que cada bloque.
+    Con dry_run no se escribe nada y solo se cuenta lo que se contabilizaría.
+
+    Devuelve un diccionario con estadísticas del proceso.
+    """
+    today = today or date.today()
+    # next_date es DATETIME: todo lo que sea anterior a mañana a las 00:00 vence hoy
+    limit = datetime.combine(today + timedelta(days=1), datetime.min.time())
+    stats = {'schedules': 0, 'posted': 0, 'skipped': 0, 'invalid': 0, 'failed': 0,
+             'chunks': 0, 'amount': 0}
+    started = time.perf_counter()
+
+    last_id = checkpoint.last_schedule_id if checkpoint is not None else 0
+    while True:
+        schedules = _due_schedules(limit, last_id, chunk_size, shard, shards)
+        if not schedules:
+            break
+        last_id = schedules[-1].id
+
+        rows, advances = _expand(schedules, today, stats, log)
+        failed = 0
+        if dry_run:
+            new_rows = _write(rows, advances, dry_run=True)
+        else:
+            def write_chunk():
+                new_rows = _write(rows, advances)
+                _update_checkpoint(checkpoint, last_id, len(advances), new_rows, len(rows), 0)
+                db.session.commit()
+                return new_rows
+            try:
+                # Los bloqueos con las peticiones web se reintentan sin dar el bloque por malo
+                new_rows = run_with_retry(write_chunk)
+            except SQLAlchemyError as error:
+                if is_locked_error(error):
+                    raise
+                # Un bloque con una fila problemática no debe tumbar a los demás:
+                # repetimos el bloque recurrente a recurrente y saltamos las que fallen.
+                db.session.rollback()
+                new_rows, failed = _write_one_by_one(rows, advances, log)
+                _update_checkpoint(checkpoint, last_id, len(advances), new_rows, len(rows), failed)
+                db.session.commit()
+
+        stats['schedules'] += len(advances) - failed
+        stats['posted'] += len(new_rows)
+        stats['skipped'] += len(rows) - len(new_rows)
+        stats['failed'] += failed
+        stats['amount'] += sum(row['amount'] for row in new_rows)
+        stats['chunks'] += 1
+
+    stats['seconds'] = time.perf_counter() - started
+    stats['rows_per_second'] = stats['posted'] / stats['seconds'] if stats['seconds'] else 0
+    return stats
+
+
+def _write_one_by_one(rows, advances, log):
+    """Escribe un bloque recurrente a recurrente, con un commit por cada una."""
+    rows_by_schedule = defaultdict(list)
+    for row in rows:
+        rows_by_schedule[row['recurring_id']].append(row)
+
+    new_rows = []
+    failed = 0
+    for advance in advances:
+        schedule_rows = rows_by_schedule[advance['b_id']]
+        def write_schedule():
+            written = _write(schedule_rows, [advance])
+            db.session.commit()
+            return written
+        try:
+            new_rows.extend(run_with_retry(write_schedule))
+        except SQLAlchemyError as error:
+            db.session.rollback()
+            failed += 1
+            if log:
+                log(f"No se pudo procesar la recurrente {advance['b_id']}: {error}")
+    return new_rows, failed
+
+
+def _update_checkpoint(checkpoint, last_id, schedules, new_rows, rows, failed):
+    """Avanza el punto de control del shard (se guarda con el commit del bloque)."""
+    if checkpoint is None:
+        return
+    checkpoint.last_schedule_id = last_id
+    checkpoint.schedules += schedules - failed
+    checkpoint.posted += len(new_rows)
+    checkpoint.skipped += rows - len(new_rows)
+    checkpoint.failed += failed
+
+
+# --- Ejecución en paralelo y reanudable ---
+
+def _init_worker():
+    # Cada proceso hijo abre sus propias conexiones: las heredadas del padre
+    # no se pueden compartir entre procesos.
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def _run_shard(run_id, shard, shards, today, chunk_size):
+    """Procesa un shard de una ejecución y marca su punto de control."""
+    with app.app_context():
+        checkpoint = db.session.get(RecurringRunShard, (run_id, shard))
+        try:
+            stats = process_due(today, chunk_size, app.logger.warning, shard, shards, checkpoint)
+        except Exception as error:
+            db.session.rollback()
+            checkpoint = db.session.get(RecurringRunShard, (run_id, shard))
+            checkpoint.status = 'failed'
+            checkpoint.error = str(error)
+            db.session.commit()
+            app.logger.error(f"El shard {shard} de la ejecución {run_id} ha fallado: {error}")
+            return shard, None
+        checkpoint.status = 'done'
+        checkpoint.error = None
+        db.session.commit()
+        return shard, stats
+
+
+def _dry_run_shard(shard, shards, today, chunk_size):
+    with app.app_context():
+        return shard, process_due(today, chunk_size, app.logger.warning, shard, shards, dry_run=True)
+
+
+def _start_or_resume_run(today, shards):
+    """Reanuda la última ejecución interrumpida de hoy o crea una nueva."""
+    run = RecurringRun.query.filter_by(run_date=today, shards=shards).filter(
+        RecurringRun.status != 'done').order_by(RecurringRun.id.desc()).first()
+    if run is None:
+        run = RecurringRun(run_date=today, shards=shards, status='running')
+        db.session.add(run)
+        db.session.flush()
+        for shard in range(shards):
+            db.session.add(RecurringRunShard(run_id=run.id, shard=shard, status='pending',
+                                             last_schedule_id=0, schedules=0, posted=0,
+                                             skipped=0, failed=0))
+        resumed = False
+    else:
+        run.status = 'running'
+        resumed = True
+    db.session.commit()
+    return run, resumed
+
+
+def run(today=None, workers=1, chunk_size=1000, dry_run=False, log=None):
+    """Procesa las recurrentes repartiendo los usuarios en 'workers' procesos.
+
+    Devuelve (ejecución o None en dry_run, {shard: estadísticas}).
+    Las estadísticas de un shard que ha fallado son None.
+    """
+    today = today or date.today()
+    shards = max(workers, 1)
+    started = time.perf_counter()
+
+    if dry_run:
+        jobs = [(shard, shards, today, chunk_size) for shard in range(shards)]
+        return None, dict(_map(_dry_run_shard, jobs, workers))
+
+    recurring_run, resumed = _start_or_resume_run(today, shards)
+    pending = [s.shard for s in recurring_run.shard_states if s.status != 'done']
+    if log and resumed:
+        log(f"Reanudando la ejecución {recurring_run.id}: quedan {len(pending)} de {shards} shards.")
+    run_id = recurring_run.id
+
+    jobs = [(run_id, shard, shards, today, chunk_size) for shard in pending]
+    results = dict(_map(_run_shard, jobs, workers))
+
+    recurring_run = db.session.get(RecurringRun, run_id)
+    db.session.refresh(recurring_run)
+    states = {s.status for s in recurring_run.shard_states}
+    recurring_run.status = 'done' if states == {'done'} else 'failed'
+    recurring_run.finished_at = datetime.utcnow()
+    db.session.commit()
+    metrics.record_recurring_run(results, time.perf_counter() - started, recurring_run.status)
+    return recurring_run, results
+
+
+def _map(function, jobs, workers):
+    """Ejecuta los trabajos en un pool de procesos (o aquí mismo si workers=1)."""
+    if workers <= 1 or not jobs:
+        return [function(*job) for job in jobs]
+    # Cerramos la sesión del padre antes de crear los hijos
+    db.session.remove()
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker) as pool:
+        return list(pool.map(function, *zip(*jobs)))
@@ -1,70 +1,102 @@
 # app/routes.py
-from flask import render_template, flash, redirect, url_for, request, Response
+from flask import (render_template, flash, redirect, url_for, request, Response, jsonify, stream_with_context,
+                   session, send_file, abort)
 from flask_login import current_user, login_user, logout_user, login_required
-from sqlalchemy import func, extract, case
-from datetime import datetime, timedelta
-from app import app, db
-import csv
-from io import StringIO
-from app.models import User, Transaction, Category, Budget, RecurringTransaction
+from datetime import datetime
+import os
+from markupsafe import Markup
+from sqlalchemy.exc import IntegrityError
+from app import (app, db, archive, ledger, exports, categories, categorizer, forecast, fragments, imports, jobs,
+                 metrics, ratelimit, search)
+from app.models import (User, Transaction, Category, CategoryRule, Budget, RecurringTransaction, Job,
+                        MonthlyRollup)
 from app.forms import (LoginForm, RegistrationForm, TransactionForm, 
-                       CategoryForm, ReportForm, ChangePasswordForm, RecurringTransactionForm)
+                       CategoryForm, ReportForm, ChangePasswordForm, RecurringTransactionForm, ImportForm,
+                       SearchForm, CategoryRuleForm)
+from app.pagination import keyset_page
+from app.versions import mark_changed
+from app.periods import period_filters, request_period
+from app.database import retry_on_locked
 
 # app/routes.py
 
+def transaction_feed_query(user_id, year=0, month=0):
+    """Consulta ligera para las tablas de movimientos: solo las columnas que se
+    muestran, con el nombre de la categoría ya unido (sin cargas perezosas)."""
+    query = db.session.query(
+        Transaction.id, Transaction.date, Transaction.description,
+        Transaction.amount, Category.name.label('category_name')
+    ).outerjoin(Category, Transaction.category_id == Category.id).filter(
+        Transaction.user_id == user_id, *period_filters(Transaction.date, year, month))
+    return query
+
+def transaction_page(user_id, year=0, month=0, cursor=None, per_page=50, archived=True):
+    """Página de movimientos del periodo: (filas, siguiente cursor).
+
+    Si el periodo llega a años archivados (y archived=True) se unen sus
+    ficheros (ver app/archive.py); si no, solo se lee la tabla caliente.
+    """
+    if archived and archive.period_years(year):
+        return archive.feed_page(user_id, year, month, cursor, per_page)
+    return keyset_page(transaction_feed_query(user_id, year, month),
+                       Transaction.date, Transaction.id, cursor=cursor, per_page=per_page)
+
+def _transaction_page(year=0, month=0, archived=True):
+    """Página de movimientos del usuario actual a partir del cursor de la URL."""
+    return transaction_page(current_user.id, year, month, cursor=request.args.get('cursor'),
+                            per_page=app.config['TRANSACTIONS_PER_PAGE'], archived=archived)
+
+def _fragment(name, period, scopes, template, context, cache=True):
+    """Parte de una página, guardada ya renderizada mientras no cambien los
+    datos de scopes (ver app/fragments.py). context() hace las consultas y
+    solo se llama si hay que renderizarla."""
+    def render():
+        return render_template(template, **context())
+    if not cache:
+        return Markup(render())
+    return fragments.cached(current_user.id, name, period, scopes, render)
+
 @app.route('/')
 @app.route('/dashboard')
 @login_required
 def dashboard():
     form = TransactionForm()
-    
-    # --- INICIALIZACIÓN DE VARIABLES---
-    chart_labels = []
-    chart_data = []
-    # -------------------------------------------------------------
-
-    form.category.choices = [(c.id, c.name) for c in Category.query.filter_by(user_id=current_user.id).order_by(Category.name).all()]
-    
-    transactions = Transaction.query.filter_by(owner=current_user).order_by(Transaction.date.desc()).all()
-    balance = sum(t.amount for t in transactions) if transactions else 0
+    form.category.choices = categories.category_choices(current_user.id)
 
-    # --- LÓGICA PARA EL GRÁFICO ---
     today = datetime.utcnow()
-    start_of_month = today.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-
-    expense_data = db.session.query(
-        Category.name, 
-        func.sum(Transaction.amount * -1).label('total_gastado')
-    ).join(Transaction).filter(
-        Transaction.user_id == current_user.id,
-        Transaction.amount < 0,
-        Transaction.date >= start_of_month
-    ).group_by(Category.name).order_by(func.sum(Transaction.amount).asc()).all()
-
-    if expense_data:
+    period = f'{today.year}-{today.month:02d}'
+
+    def summary_context():
+        # El saldo está materializado en el usuario: no hace falta sumar el historial
+        balance = current_user.balance
+
+        # Los gráficos leen del resumen mensual, no de las transacciones
+        expense_data = ledger.expenses_by_category(current_user.id, today.year, today.month)
         chart_labels = [item[0] for item in expense_data]
         chart_data = [float(item[1]) for item in expense_data]
-        
-    # --- LÓGICA PARA PRESUPUESTOS ---
-    budgets = Budget.query.filter_by(user_id=current_user.id, year=today.year, month=today.month).all()
-    budgets_dict = {b.category_id: b.amount for b in budgets}
-    
-    expenses_this_month = db.session.query(
-        Transaction.category_id,
-        func.sum(Transaction.amount).label('total_spent')
-    ).filter(
-        Transaction.user_id == current_user.id,
-        Transaction.amount < 0,
-        extract('year', Transaction.date) == today.year,
-        extract('month', Transaction.date) == today.month
-    ).group_by(Transaction.category_id).all()
-    
-    expenses_dict = {e.category_id: abs(e.total_spent) for e in expenses_this_month}
-    
-    return render_template('dashboard.html', title='Dashboard', 
-                           transactions=transactions, form=form, balance=balance,
-                           chart_labels=chart_labels, chart_data=chart_data,
-                           budgets=budgets_dict, expenses=expenses_dict)
+
+        # Progreso ya calculado (nombre, presupuesto, gastado, %, estado); la
+        # plantilla solo lo pinta.
+        budget_progress = ledger.budget_progress(current_user.id, today.year, today.month)
+        return dict(balance=balance, chart_labels=chart_labels, chart_data=chart_data,
+                    budget_progress=budget_progress)
+
+    def movements_context():
+        # Solo la primera página de movimientos, y solo de la tabla caliente (los
+        # más recientes); el resto se carga bajo demanda
+        transactions, next_cursor = _transaction_page(archived=False)
+        return dict(transactions=transactions, next_cursor=next_cursor)
+
+    # El formulario (con su token CSRF) se renderiza siempre; el resto, solo
+    # si han cambiado los datos del usuario
+    summary = _fragment('dashboard_summary', period, ('transactions', 'categories', 'budgets'),
+                        '_dashboard_summary.html', summary_context)
+    movements = _fragment('dashboard_movements', '', ('transactions', 'categories'),
+                          '_dashboard_movements.html', movements_context,
+                          cache=not request.args.get('cursor'))
+
+    return render_template('dashboard.html', title='Dashboard', form=form,
+                           summary=summary, movements=movements)
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -72,11 +104,26 @@ def login():
         return redirect(url_for('dashboard'))
     form = LoginForm()
     if form.validate_on_submit():
+        ip = ratelimit.client_ip()
+        # Antes de calcular ningún hash de contraseña (ver app/ratelimit.py)
+        decision = ratelimit.acquire(ip, form.username.data)
+        if not decision.allowed:
+            metrics.record_login(f'limited_{decision.scope}', decision.scope if decision.blocked else None)
+            if decision.blocked:
+                app.logger.warning(f"Login blocked for {decision.retry_after}s ({decision.scope}) "
+                                   f"for user '{form.username.data}' from IP {ip}")
+            flash(f'Demasiados intentos. Vuelve a intentarlo dentro de {decision.retry_after} segundos.')
+            response = app.make_response((render_template('login.html', title='Iniciar Sesión', form=form), 429))
+            response.headers['Retry-After'] = str(decision.retry_after)
+            return response
         user = User.query.filter_by(username=form.username.data).first()
         if user is None or not user.check_password(form.password.data):
+            metrics.record_login('failure')
             flash('Usuario o contraseña inválidos')
-            app.logger.warning(f"Failed login attempt for user '{form.username.data}' from IP {request.remote_addr}")
+            app.logger.warning(f"Failed login attempt for user '{form.username.data}' from IP {ip}")
             return redirect(url_for('login'))
+        ratelimit.succeeded(form.username.data)
+        metrics.record_login('success')
         login_user(user, remember=form.remember_me.data)
         return redirect(url_for('dashboard'))
     return render_template('login.html', title='Iniciar Sesión', form=form)
@@ -87,6 +134,7 @@ def logout():
     return redirect(url_for('login'))
 
 @app.route('/register', methods=['GET', 'POST'])
+@retry_on_locked
 def register():
     # NUEVO: Comprobamos el interruptor antes de hacer nada más.
     if not app.config['REGISTRATION_ENABLED']:
@@ -107,14 +155,15 @@ def register():
 
 @app.route('/add_transaction', methods=['POST'])
 @login_required
+@retry_on_locked
 def add_transaction():
     form = TransactionForm()
     # Volvemos a cargar las choices por si la validación falla
-    form.category.choices = [(c.id, c.name) for c in Category.query.filter_by(user_id=current_user.id).order_by(Category.name).all()]
+    form.category.choices = categories.category_choices(current_user.id)
 
     if form.validate_on_submit():
         # Obtenemos el objeto Categoría completo desde la BBDD
-        selected_category = Category.query.get(form.category.data)
+        selected_category = categories.get_category(current_user.id, form.category.data)
 
         amount = form.amount.data
         # Si la categoría es de tipo 'gasto', hacemos el número negativo
@@ -127,11 +176,13 @@ def add_transaction():
         # En lugar de 'category=', usamos 'category_id=' para guardar solo el ID.
         t = Transaction(description=form.description.data,
                         amount=amount,
+                        date=datetime.utcnow(),
                         category_id=selected_category.id, # <-- CORRECCIÓN AQUÍ
-                        owner=current_user)
+                        user_id=current_user.id)
         # --- FIN DE LA CORRECCIÓN ---
 
         db.session.add(t)
+        ledger.apply_transaction(current_user.id, selected_category.id, amount, t.date)
         db.session.commit()
         flash('¡Transacción añadida!')
     else:
@@ -147,62 +198,135 @@ def add_transaction():
 def manage_categories():
     form = CategoryForm()
     # Buscamos las categorías del usuario y las separamos por tipo
-    income_categories = Category.query.filter_by(user_id=current_user.id, type='ingreso').order_by(Category.name).all()
-    expense_categories = Category.query.filter_by(user_id=current_user.id, type='gasto').order_by(Category.name).all()
+    income_categories = categories.user_categories(current_user.id, 'ingreso')
+    expense_categories = categories.user_categories(current_user.id, 'gasto')
+    rule_form = CategoryRuleForm()
+    rule_form.category.choices = categories.category_choices(current_user.id)
+    rules = CategoryRule.query.filter_by(user_id=current_user.id).order_by(CategoryRule.pattern).all()
+    # Los nombres salen de la caché de categorías: rule.category haría una consulta por regla
+    category_names = {c.id: c.name for c in categories.user_categories(current_user.id)}
     return render_template('manage_categories.html', title='Gestionar Categorías', form=form,
-                           income_categories=income_categories, expense_categories=expense_categories)
+                           income_categories=income_categories, expense_categories=expense_categories,
+                           rule_form=rule_form, rules=rules, category_names=category_names)
 
 @app.route('/add_category', methods=['POST'])
 @login_required
+@retry_on_locked
 def add_category():
     form = CategoryForm()
     if form.validate_on_submit():
         # Comprobar si ya existe una categoría con ese nombre para el usuario
-        existing_category = Category.query.filter_by(user_id=current_user.id, name=form.name.data).first()
+        existing_category = any(c.name == form.name.data for c in categories.user_categories(current_user.id))
         if existing_category:
             flash('Ya existe una categoría con ese nombre.', 'warning')
         else:
             new_category = Category(name=form.name.data, type=form.type.data, user_id=current_user.id)
             db.session.add(new_category)
+            # Invalida la caché de categorías del usuario en todos los procesos
+            mark_changed(current_user.id, 'categories')
             db.session.commit()
             flash('¡Nueva categoría añadida con éxito!', 'success')
     return redirect(url_for('manage_categories'))
 
 @app.route('/delete_category/<int:category_id>', methods=['POST'])
 @login_required
+@retry_on_locked
 def delete_category(category_id):
     # Buscamos la categoría asegurándonos de que pertenece al usuario actual
     category_to_delete = Category.query.filter_by(id=category_id, user_id=current_user.id).first_or_404()
 
-    # Buena práctica: Comprobar si la categoría está siendo usada en alguna transacción
-    if category_to_delete.transactions:
+    # Buena práctica: Comprobar si la categoría está siendo usada en alguna transacción.
+    # Los movimientos archivados ya no están en la tabla caliente, pero siguen
+    # contando en el resumen mensual (ver app/archive.py)
+    in_use = db.session.query(
+        Transaction.query.filter_by(user_id=current_user.id, category_id=category_id).exists()
+    ).scalar() or db.session.query(
+        MonthlyRollup.query.filter(MonthlyRollup.user_id == current_user.id,
+                                   MonthlyRollup.category_id == category_id,
+                                   MonthlyRollup.count > 0).exists()
+    ).scalar()
+    if in_use:
         flash('No se puede eliminar la categoría porque tiene transacciones asociadas.', 'danger')
         return redirect(url_for('manage_categories'))
 
+    # Sus reglas de categorización dejan de tener sentido
+    CategoryRule.query.filter_by(user_id=current_user.id, category_id=category_id).delete()
     db.session.delete(category_to_delete)
+    mark_changed(current_user.id, 'categories', 'rules')
     db.session.commit()
     flash('Categoría eliminada con éxito.', 'success')
     return redirect(url_for('manage_categories'))
 
+@app.route('/add_rule', methods=['POST'])
+@login_required
+@retry_on_locked
+def add_rule():
+    form = CategoryRuleForm()
+    form.category.choices = categories.category_choices(current_user.id)
+    if form.validate_on_submit():
+        if not categorizer.description_key(form.pattern.data):
+            flash('La regla debe contener al menos una palabra.', 'warning')
+        else:
+            db.session.add(CategoryRule(pattern=form.pattern.data.strip(), category_id=form.category.data,
+                                        user_id=current_user.id))
+            # Invalida el modelo de categorización del usuario en todos los procesos
+            mark_changed(current_user.id, 'rules')
+            db.session.commit()
+            flash('¡Regla añadida!', 'success')
+    else:
+        for field, errors in form.errors.items():
+            for error in errors:
+                flash(f"Error en el campo '{getattr(form, field).label.text}': {error}", 'danger')
+    return redirect(url_for('manage_categories'))
+
+@app.route('/delete_rule/<int:rule_id>', methods=['POST'])
+@login_required
+@retry_on_locked
+def delete_rule(rule_id):
+    rule = CategoryRule.query.filter_by(id=rule_id, user_id=current_user.id).first_or_404()
+    db.session.delete(rule)
+    mark_changed(current_user.id, 'rules')
+    db.session.commit()
+    flash('Regla eliminada.', 'success')
+    return redirect(url_for('manage_categories'))
+
+@app.route('/categories/suggest')
+@login_required
+def suggest_category():
+    """Categoría sugerida para una descripción (el formulario del dashboard
+    la preselecciona mientras se escribe)."""
+    amount = request.args.get('amount', type=float)
+    suggestion = categorizer.suggest(current_user.id, request.args.get('description', ''), amount)
+    if suggestion is None:
+        return jsonify(category_id=None)
+    return jsonify(category_id=suggestion.category_id, source=suggestion.source,
+                   confidence=suggestion.confidence)
+
 @app.route('/edit_transaction/<int:transaction_id>', methods=['GET', 'POST'])
 @login_required
+@retry_on_locked
 def edit_transaction(transaction_id):
     # Buscamos la transacción y nos aseguramos de que pertenece al usuario actual
     transaction = Transaction.query.filter_by(id=transaction_id, user_id=current_user.id).first_or_404()
     form = TransactionForm()
 
     # Rellenamos el desplegable de categorías, como en el dashboard
-    form.category.choices = [(c.id, c.name) for c in Category.query.filter_by(user_id=current_user.id).all()]
+    form.category.choices = categories.category_choices(current_user.id)
 
     if form.validate_on_submit():
         # Guardamos los datos actualizados
-        selected_category = Category.query.get(form.category.data)
+        selected_category = categories.get_category(current_user.id, form.category.data)
         amount = form.amount.data
         if selected_category.type == 'gasto':
             amount = -abs(amount)
         else:
             amount = abs(amount)
 
+        # Revertimos el importe antiguo y aplicamos el nuevo en los saldos
+        ledger.apply_transaction(transaction.user_id, transaction.category_id, transaction.amount,
+                                 transaction.date, sign=-1)
+        ledger.apply_transaction(transaction.user_id, selected_category.id, amount, transaction.date)
+
         transaction.description = form.description.data
         transaction.amount = amount
         transaction.category_id = selected_category.id
@@ -219,8 +343,11 @@ def edit_transaction(transaction_id):
 
 @app.route('/delete_transaction/<int:transaction_id>', methods=['POST'])
 @login_required
+@retry_on_locked
 def delete_transaction(transaction_id):
     transaction = Transaction.query.filter_by(id=transaction_id, user_id=current_user.id).first_or_404()
+    ledger.apply_transaction(transaction.user_id, transaction.category_id, transaction.amount,
+                             transaction.date, sign=-1)
     db.session.delete(transaction)
     db.session.commit()
     flash('¡Transacción eliminada!', 'success')
@@ -231,67 +358,152 @@ def delete_transaction(transaction_id):
 def reports():
     form = ReportForm()
 
-    selected_year = request.args.get('year', datetime.utcnow().year, type=int)
-    selected_month = request.args.get('month', datetime.utcnow().month, type=int)
+    selected_year, selected_month = request_period(datetime.utcnow().year, datetime.utcnow().month)
 
     form.year.data = selected_year
     form.month.data = selected_month
 
-    # --- Lógica para la tabla de transacciones (sin cambios) ---
-    query = Transaction.query.filter_by(user_id=current_user.id)
-    if selected_year != 0:
-        query = query.filter(extract('year', Transaction.date) == selected_year)
-    if selected_month != 0:
-        query = query.filter(extract('month', Transaction.date) == selected_month)
-    transactions = query.order_by(Transaction.date.desc()).all()
-
-    total_income = sum(t.amount for t in transactions if t.amount > 0)
-    total_expenses = sum(t.amount for t in transactions if t.amount < 0)
-    net_savings = total_income + total_expenses
-
-    # --- NUEVA LÓGICA PARA EL GRÁFICO DE EVOLUCIÓN ---
     today = datetime.utcnow()
-    six_months_ago = today - timedelta(days=180)
-
-    # Consulta para obtener ingresos y gastos agrupados por año y mes
-    monthly_data = db.session.query(
-        extract('year', Transaction.date).label('year'),
-        extract('month', Transaction.date).label('month'),
-        func.sum(case((Transaction.amount > 0, Transaction.amount), else_=0)).label('total_income'),
-        func.sum(case((Transaction.amount < 0, Transaction.amount), else_=0)).label('total_expenses')
-    ).filter(
-        Transaction.user_id == current_user.id,
-        Transaction.date >= six_months_ago
-    ).group_by('year', 'month').order_by('year', 'month').all()
-
-    # Procesar datos para el gráfico
-    chart_evolution_labels = [f"{d.year}-{str(d.month).zfill(2)}" for d in monthly_data]
-    chart_evolution_income = [float(d.total_income) for d in monthly_data]
-    chart_evolution_expenses = [abs(float(d.total_expenses)) for d in monthly_data]
-    # --- FIN DE LA NUEVA LÓGICA ---
+    period = f'{selected_year}-{selected_month:02d}'
+
+    def movements_context():
+        # --- Lógica para la tabla de transacciones (paginada por cursor) ---
+        transactions, next_cursor = _transaction_page(selected_year, selected_month)
+        return dict(transactions=transactions, next_cursor=next_cursor,
+                    selected_year=selected_year, selected_month=selected_month)
+
+    def totals_context():
+        # Los totales salen del resumen mensual sobre todo el período,
+        # no de la página que se muestra.
+        total_income, total_expenses = ledger.period_totals(current_user.id, selected_year, selected_month)
+        return dict(total_income=total_income, total_expenses=total_expenses,
+                    net_savings=total_income + total_expenses)
+
+    def evolution_context():
+        # Ingresos y gastos de los últimos 6 meses, leídos del resumen mensual
+        monthly_data = ledger.monthly_evolution(current_user.id, months=6)
+        return dict(chart_evolution_labels=[f"{d.year}-{str(d.month).zfill(2)}" for d in monthly_data],
+                    chart_evolution_income=[float(d.total_income) for d in monthly_data],
+                    chart_evolution_expenses=[abs(float(d.total_expenses)) for d in monthly_data])
+
+    totals = _fragment('report_totals', period, ('transactions',),
+                       '_report_totals.html', totals_context)
+    # Los 6 meses se cuentan desde hoy, no desde el período elegido
+    evolution = _fragment('report_evolution', f'{today.year}-{today.month:02d}', ('transactions',),
+                          '_report_evolution.html', evolution_context)
+    movements = _fragment('report_movements', period, ('transactions', 'categories'),
+                          '_report_movements.html', movements_context,
+                          cache=not request.args.get('cursor'))
 
     return render_template('reports.html', title='Informes', form=form,
-                           transactions=transactions, total_income=total_income,
-                           total_expenses=total_expenses, net_savings=net_savings,
                            selected_year=selected_year, selected_month=selected_month,
-                           # Pasamos los nuevos datos a la plantilla
-                           chart_evolution_labels=chart_evolution_labels,
-                           chart_evolution_income=chart_evolution_income,
-                           chart_evolution_expenses=chart_evolution_expenses)
+                           totals=totals, evolution=evolution, movements=movements)
+
+@app.route('/forecast')
+@login_required
+def cash_forecast():
+    """Saldo previsto día a día según las transacciones recurrentes."""
+    months = request.args.get('months', 12, type=int)
+    if months not in forecast.HORIZONS:
+        months = 12
+    result = forecast.user_forecast(current_user.id, months)
+    category_names = {c.id: c.name for c in categories.user_categories(current_user.id)}
+    # Para la tabla, solo los días con movimientos previstos
+    upcoming = [day for day in result.days if day.income or day.expense][:60]
+    return render_template('forecast.html', title='Previsión', forecast=result, months=months,
+                           horizons=forecast.HORIZONS, upcoming=upcoming, category_names=category_names,
+                           chart_labels=[day.date.isoformat() for day in result.days],
+                           chart_balance=[float(day.balance) for day in result.days])
+
+@app.route('/transactions/feed')
+@login_required
+def transactions_feed():
+    """Fragmento JSON con la siguiente página de movimientos ("Cargar más")."""
+    year, month = request_period()
+    transactions, next_cursor = _transaction_page(year, month)
+    next_url = None
+    if next_cursor:
+        next_url = url_for('transactions_feed', cursor=next_cursor, year=year or None, month=month or None)
+    return jsonify(html=render_template('_transaction_rows.html', transactions=transactions),
+                   next_cursor=next_cursor, next_url=next_url)
+
+def _search_form():
+    form = SearchForm(request.args)
+    form.category.choices = [(0, 'Todas')] + categories.category_choices(current_user.id)
+    return form
+
+def _search_page(form):
+    """Página de resultados de la búsqueda: (filas, siguiente cursor)."""
+    ranked = form.order.data == 'relevance'
+    query = search.search_query(current_user.id, form.q.data, form.category.data,
+                                form.date_from.data, form.date_to.data,
+                                form.amount_min.data, form.amount_max.data, ranked=ranked)
+    if query is None:
+        return [], None
+    if ranked:
+        # Por relevancia el cursor es la posición del primer resultado
+        offset = request.args.get('cursor', 0, type=int)
+        rows, next_offset = search.offset_page(query, max(offset, 0), app.config['TRANSACTIONS_PER_PAGE'])
+        return rows, next_offset and str(next_offset)
+    return keyset_page(query, Transaction.date, Transaction.id, cursor=request.args.get('cursor'),
+                       per_page=app.config['TRANSACTIONS_PER_PAGE'])
+
+def _search_url(endpoint, cursor):
+    """URL de la página siguiente con los mismos filtros."""
+    args = request.args.to_dict()
+    args.pop('submit', None)
+    args['cursor'] = cursor
+    return url_for(endpoint, **args)
+
+@app.route('/search')
+@login_required
+def search_transactions():
+    form = _search_form()
+    transactions, next_cursor = [], None
+    # Sin ningún filtro no buscamos: el listado completo ya está en Informes
+    searched = any(request.args.get(field.name) not in (None, '', '0')
+                   for field in form if field.name not in ('order', 'submit'))
+    if searched and form.validate():
+        transactions, next_cursor = _search_page(form)
+    page_url = feed_url = None
+    if next_cursor:
+        page_url = _search_url('search_transactions', next_cursor)
+        feed_url = _search_url('search_feed', next_cursor)
+    return render_template('search.html', title='Buscar', form=form, searched=searched,
+                           transactions=transactions, next_cursor=next_cursor,
+                           page_url=page_url, feed_url=feed_url)
+
+@app.route('/search/feed')
+@login_required
+def search_feed():
+    """Siguiente página de resultados en JSON ("Cargar más")."""
+    form = _search_form()
+    if not form.validate():
+        return jsonify(error='Filtros no válidos'), 400
+    transactions, next_cursor = _search_page(form)
+    return jsonify(html=render_template('_transaction_rows.html', transactions=transactions),
+                   next_cursor=next_cursor,
+                   next_url=next_cursor and _search_url('search_feed', next_cursor))
 
 @app.route('/profile', methods=['GET', 'POST'])
 @login_required
+@retry_on_locked
 def profile():
     form = ChangePasswordForm()
     if form.validate_on_submit():
+        user = current_user.model
         # Primero, verificamos que la contraseña actual es correcta
-        if not current_user.check_password(form.current_password.data):
+        if not user.check_password(form.current_password.data):
             flash('La contraseña actual es incorrecta.', 'danger')
             return redirect(url_for('profile'))
         
         # Si es correcta, actualizamos a la nueva contraseña
-        current_user.set_password(form.new_password.data)
+        user.set_password(form.new_password.data)
+        # Las demás sesiones del usuario se cierran (ver app/auth.py)
+        mark_changed(user.id, 'auth')
         db.session.commit()
+        # y esta sigue abierta con el identificador nuevo
+        login_user(user, remember=app.config.get('REMEMBER_COOKIE_NAME', 'remember_token') in request.cookies)
         flash('¡Tu contraseña ha sido actualizada con éxito!', 'success')
         return redirect(url_for('dashboard'))
         
@@ -301,44 +513,202 @@ def profile():
 @login_required
 def export_csv():
     # Reutilizamos la misma lógica de filtrado de la página de informes
-    selected_year = request.args.get('year', type=int)
-    selected_month = request.args.get('month', type=int)
+    selected_year, selected_month = request_period()
 
-    query = Transaction.query.filter_by(user_id=current_user.id)
+    compressed = request.args.get('gzip', 0, type=int) == 1
 
-    if selected_year and selected_year != 0:
-        query = query.filter(extract('year', Transaction.date) == selected_year)
-    if selected_month and selected_month != 0:
-        query = query.filter(extract('month', Transaction.date) == selected_month)
+    # El CSV se genera y se envía por trozos: la memoria no depende del
+    # número de filas. stream_with_context mantiene viva la petición (y la
+    # sesión de base de datos) mientras el generador se consume.
+    chunks = exports.iter_csv(current_user.id, selected_year, selected_month)
+    if compressed:
+        return Response(
+            stream_with_context(exports.gzip_chunks(chunks)),
+            mimetype="application/gzip",
+            headers={"Content-disposition":
+                     "attachment; filename=informe_contabilidad.csv.gz"})
 
-    transactions = query.order_by(Transaction.date.asc()).all()
+    return Response(
+        stream_with_context(chunks),
+        mimetype="text/csv",
+        headers={"Content-disposition":
+                 "attachment; filename=informe_contabilidad.csv"})
 
-    # Usamos StringIO para crear el archivo CSV en memoria
-    si = StringIO()
-    cw = csv.writer(si)
+@app.route('/export_csv/background', methods=['POST'])
+@login_required
+@retry_on_locked
+def export_csv_background():
+    """La misma exportación, pero la genera 'flask worker' y se descarga después."""
+    year, month = request_period()
+    return _enqueue_job('export_csv', year=year, month=month,
+                        gzip=request.args.get('gzip', 0, type=int) == 1)
+
+def _wants_json():
+    return request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json'
+
+def _enqueue_job(kind, **params):
+    """Encola un trabajo del usuario actual y responde con su id (JSON) o su página."""
+    try:
+        job = jobs.enqueue(kind, current_user.id, **params)
+    except jobs.QueueFull:
+        db.session.rollback()
+        message = 'Ya tienes demasiados trabajos pendientes. Espera a que terminen o cancela alguno.'
+        if _wants_json():
+            return jsonify(error=message), 429
+        flash(message, 'warning')
+        return redirect(url_for('list_jobs'))
+    db.session.commit()
+    if _wants_json():
+        return jsonify(id=job.id, status=job.status,
+                       status_url=url_for('job_status', job_id=job.id)), 202
+    flash('El trabajo está en cola. Esta página se actualiza sola hasta que termine.', 'info')
+    return redirect(url_for('job_detail', job_id=job.id))
 
-    # Escribimos las cabeceras
-    cw.writerow(['Fecha', 'Descripcion', 'Categoria', 'Importe'])
+@app.route('/jobs')
+@login_required
+def list_jobs():
+    user_jobs = Job.query.filter_by(user_id=current_user.id).order_by(Job.id.desc()).limit(50).all()
+    return render_template('jobs.html', title='Mis Trabajos', jobs=[jobs.describe(job) for job in user_jobs])
 
-    # Escribimos los datos de las transacciones
-    for t in transactions:
-        cw.writerow([t.date.strftime('%Y-%m-%d'), t.description, t.category.name, t.amount])
+@app.route('/jobs/<int:job_id>')
+@login_required
+def job_detail(job_id):
+    job = Job.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+    return render_template('job.html', title='Trabajo', job=jobs.describe(job))
 
-    # Preparamos la respuesta para el navegador
-    output = si.getvalue()
+@app.route('/jobs/<int:job_id>/status')
+@login_required
+def job_status(job_id):
+    job = Job.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+    return jsonify(jobs.describe(job))
 
-    return Response(
-        output,
-        mimetype="text/csv",
-        headers={"Content-disposition":
-                 "attachment; filename=informe_contabilidad.csv"})
+@app.route('/jobs/<int:job_id>/download')
+@login_required
+def download_job(job_id):
+    job = Job.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+    path = jobs.artifact_path(job)
+    if path is None:
+        abort(404)
+    return send_file(path, as_attachment=True, download_name=job.artifact_name)
+
+@app.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_job(job_id):
+    job = Job.query.filter_by(id=job_id, user_id=current_user.id).first_or_404()
+    if jobs.cancel(job):
+        flash('Trabajo cancelado.', 'info')
+    else:
+        flash('El trabajo ya había terminado.', 'warning')
+    return redirect(url_for('job_detail', job_id=job.id))
+
+@app.route('/import', methods=['GET', 'POST'])
+@login_required
+def import_statement():
+    """Sube un extracto y muestra la previsualización; no escribe nada."""
+    form = ImportForm()
+    form.expense_category.choices = categories.category_choices(current_user.id, 'gasto')
+    form.income_category.choices = categories.category_choices(current_user.id, 'ingreso')
+    if not form.expense_category.choices or not form.income_category.choices:
+        flash('Para importar necesitas al menos una categoría de gastos y otra de ingresos.', 'warning')
+        return redirect(url_for('manage_categories'))
+
+    if form.validate_on_submit():
+        upload = form.file.data
+        token = imports.save_upload(upload, current_user.id)
+        path = imports.upload_path(current_user.id, token)
+        file_format = form.format.data
+        if file_format == 'auto':
+            file_format = imports.detect_format(path, upload.filename)
+
+        # Solo una importación pendiente por sesión: la anterior se descarta
+        previous = session.pop('pending_import', None)
+        if previous:
+            imports.discard_upload(current_user.id, previous['token'])
+        pending = {'token': token, 'filename': upload.filename, 'format': file_format,
+                   'expense_category': form.expense_category.data,
+                   'income_category': form.income_category.data}
+        summary = imports.process(path, file_format, current_user.id,
+                                  pending['expense_category'], pending['income_category'])
+        pending['new'] = summary['new']
+        pending['lines'] = summary['rows'] + summary['error_count']
+        session['pending_import'] = pending
+        return render_template('import_preview.html', title='Importar Extracto', summary=summary,
+                               pending=pending, format_name=imports.FORMATS[file_format])
+
+    return render_template('import.html', title='Importar Extracto', form=form)
+
+@app.route('/import/confirm', methods=['POST'])
+@login_required
+@retry_on_locked
+def confirm_import():
+    pending = session.get('pending_import')
+    path = pending and imports.upload_path(current_user.id, pending['token'])
+    if not path or not os.path.exists(path):
+        session.pop('pending_import', None)
+        flash('No hay ninguna importación pendiente (o ha caducado). Vuelve a subir el fichero.', 'warning')
+        return redirect(url_for('import_statement'))
+
+    if pending.get('new', 0) >= app.config['IMPORT_BACKGROUND_ROWS']:
+        # Los extractos grandes los importa 'flask worker'; el fichero se queda
+        # en IMPORT_DIR hasta que el trabajo lo procese.
+        session.pop('pending_import', None)
+        return _enqueue_job('import_statement', token=pending['token'], format=pending['format'],
+                            expense_category=pending['expense_category'],
+                            income_category=pending['income_category'], lines=pending.get('lines'))
+
+    try:
+        summary = imports.process(path, pending['format'], current_user.id,
+                                  pending['expense_category'], pending['income_category'], write=True)
+        db.session.commit()
+    except imports.ImportCategoryError as error:
+        db.session.rollback()
+        session.pop('pending_import', None)
+        imports.discard_upload(current_user.id, pending['token'])
+        flash(str(error), 'warning')
+        return redirect(url_for('import_statement'))
+    except IntegrityError:
+        db.session.rollback()
+        # Si ahora hay menos movimientos nuevos que en la previsualización, el
+        # índice único ha parado un duplicado que entró a la vez desde otra
+        # importación: al volver a confirmar se omitirán. Si no, volver a
+        # confirmar no arreglaría nada.
+        summary = imports.process(path, pending['format'], current_user.id,
+                                  pending['expense_category'], pending['income_category'])
+        if summary['new'] < pending.get('new', 0):
+            pending['new'] = summary['new']
+            session['pending_import'] = pending
+            flash('Otra importación ha añadido algunos de estos movimientos a la vez. Vuelve a confirmar.', 'danger')
+        else:
+            app.logger.exception(f"Import failed for user {current_user.id} ({pending['format']})")
+            session.pop('pending_import', None)
+            imports.discard_upload(current_user.id, pending['token'])
+            flash('No se ha podido importar el extracto. Revisa el fichero y vuelve a subirlo.', 'danger')
+        return redirect(url_for('import_statement'))
+
+    imports.discard_upload(current_user.id, pending['token'])
+    session.pop('pending_import', None)
+    flash(f"Importados {summary['new']} movimientos. {summary['duplicates']} ya existían y se han omitido; "
+          f"{summary['error_count']} líneas no se han podido leer.", 'success')
+    return redirect(url_for('dashboard'))
+
+@app.route('/import/cancel', methods=['POST'])
+@login_required
+def cancel_import():
+    pending = session.pop('pending_import', None)
+    if pending:
+        imports.discard_upload(current_user.id, pending['token'])
+    flash('Importación cancelada.', 'info')
+    return redirect(url_for('import_statement'))
 
 @app.route('/budgets', methods=['GET', 'POST'])
 @login_required
+@retry_on_locked
 def manage_budgets():
     # Por defecto, trabajamos con el mes y año actuales
-    year = request.args.get('year', datetime.utcnow().year, type=int)
-    month = request.args.get('month', datetime.utcnow().month, type=int)
+    year, month = request_period(datetime.utcnow().year, datetime.utcnow().month)
+    # Los presupuestos son siempre de un mes concreto
+    if not year or not month:
+        abort(400)
 
     if request.method == 'POST':
         # Procesamos el formulario enviado para guardar/actualizar los presupuestos
@@ -359,12 +729,13 @@ def manage_budgets():
                     # Si no existe, creamos uno nuevo
                     budget = Budget(user_id=current_user.id, category_id=category_id, year=year, month=month, amount=amount)
                     db.session.add(budget)
+        mark_changed(current_user.id, 'budgets')
         db.session.commit()
         flash('Presupuestos actualizados con éxito', 'success')
         return redirect(url_for('manage_budgets', year=year, month=month))
 
     # Obtenemos solo las categorías de gastos para presupuestar
-    expense_categories = Category.query.filter_by(user_id=current_user.id, type='gasto').all()
+    expense_categories = categories.user_categories(current_user.id, 'gasto')
     
     # Obtenemos los presupuestos existentes para este período
     budgets = Budget.query.filter_by(user_id=current_user.id, year=year, month=month).all()
@@ -377,13 +748,14 @@ def manage_budgets():
 
 @app.route('/recurring_transactions', methods=['GET', 'POST'])
 @login_required
+@retry_on_locked
 def manage_recurring_transactions():
     form = RecurringTransactionForm()
-    form.category.choices = [(c.id, c.name) for c in Category.query.filter_by(user_id=current_user.id).order_by('name').all()]
+    form.category.choices = categories.category_choices(current_user.id)
 
     if form.validate_on_submit():
         # Lógica para añadir una nueva transacción recurrente
-        selected_category = Category.query.get(form.category.data)
+        selected_category = categories.get_category(current_user.id, form.category.data)
         amount = form.amount.data
         if selected_category and selected_category.type == 'gasto':
             amount = -abs(amount)
@@ -401,6 +773,8 @@ def manage_recurring_transactions():
             user_id=current_user.id
         )
         db.session.add(rt)
+        # Invalida la previsión de tesorería del usuario (ver app/forecast.py)
+        mark_changed(current_user.id, 'recurring')
         db.session.commit()
         flash('¡Transacción recurrente añadida con éxito!', 'success')
         return redirect(url_for('manage_recurring_transactions'))
@@ -414,16 +788,17 @@ def manage_recurring_transactions():
 
 @app.route('/edit_recurring/<int:rt_id>', methods=['GET', 'POST'])
 @login_required
+@retry_on_locked
 def edit_recurring_transaction(rt_id):
     rt = RecurringTransaction.query.get_or_404(rt_id)
     if rt.user_id != current_user.id:
         return redirect(url_for('manage_recurring_transactions')) # O mostrar un error 403
 
     form = RecurringTransactionForm(obj=rt)
-    form.category.choices = [(c.id, c.name) for c in Category.query.filter_by(user_id=current_user.id).order_by('name').all()]
+    form.category.choices = categories.category_choices(current_user.id)
 
     if form.validate_on_submit():
-        selected_category = Category.query.get(form.category.data)
+        selected_category = categories.get_category(current_user.id, form.category.data)
         amount = form.amount.data
         if selected_category.type == 'gasto':
             amount = -abs(amount)
@@ -438,6 +813,7 @@ def edit_recurring_transaction(rt_id):
         # Opcional: recalcular next_date si la fecha de inicio cambia
         # rt.next_date = form.start_date.data 
         
+        mark_changed(current_user.id, 'recurring')
         db.session.commit()
         flash('¡Transacción recurrente actualizada!', 'success')
         return redirect(url_for('manage_recurring_transactions'))
@@ -448,12 +824,17 @@ def edit_recurring_transaction(rt_id):
 
 @app.route('/delete_recurring/<int:rt_id>', methods=['POST'])
 @login_required
+@retry_on_locked
 def delete_recurring_transaction(rt_id):
     rt = RecurringTransaction.query.get_or_404(rt_id)
     if rt.user_id != current_user.id:
         return redirect(url_for('manage_recurring_transactions'))
 
+    # Las transacciones ya generadas se conservan, pero dejan de apuntar a ella
+    Transaction.query.filter_by(recurring_id=rt.id).update(
+        {Transaction.recurring_id: None}, synchronize_session=False)
     db.session.delete(rt)
+    mark_changed(current_user.id, 'recurring')
     db.session.commit()
     flash('Transacción recurrente eliminada.', 'success')
     return redirect(url_for('manage_recurring_transactions'))
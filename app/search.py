@@ -0,0 +1,137 @@
+# app/search.py
+# Búsqueda de movimientos por descripción.
+#
+# Las descripciones están indexadas en la tabla virtual FTS5 transaction_fts
+# (ver su migración), que mantienen unos triggers. Buscar con
+# LIKE '%café%' obliga a leer la tabla entera; con FTS5 se consulta el
+# índice invertido y el coste depende de las coincidencias, no del tamaño
+# de la tabla. El tokenizador ignora mayúsculas y acentos: "cafe" encuentra
+# "Café" y "CAFÉ".
+#
+# El texto se combina con los filtros de categoría, fechas e importe. Los
+# resultados se ordenan por fecha (paginados por cursor, como el resto de
+# listados) o por relevancia (bm25).
+import re
+from datetime import timedelta
+from sqlalchemy import func, literal_column, select, table, column, text
+from app import db
+from app.models import Transaction, Category
+
+# Palabras de la búsqueda: solo letras y números, nunca sintaxis de FTS5
+_TERM = re.compile(r'\w+')
+MAX_TERMS = 8
+# La ordenación por relevancia se pagina con OFFSET: no tiene sentido ir más allá
+MAX_RELEVANCE_RESULTS = 1000
+# Hasta cuántas coincidencias en todo el índice conviene partir de ellas
+# (ver search_query)
+FEW_MATCHES = 2000
+
+transaction_fts = table('transaction_fts', column('rowid'), column('description'))
+_fts_available = None
+
+
+def fts_available():
+    """True si la base de datos tiene el índice FTS5 (solo SQLite)."""
+    global _fts_available
+    if _fts_available is None:
+        _fts_available = db.engine.dialect.name == 'sqlite' and db.session.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'transaction_fts'")).first() is not None
+    return _fts_available
+
+
+def fts_query(search_text):
+    """Convierte lo que escribe el usuario en una consulta FTS5 segura.
+
+    Cada palabra va entre comillas (así nada se interpreta como operador),
+    todas son obligatorias y la última se busca como prefijo, para que
+    'merca' ya encuentre 'Mercadona' (si tiene al menos dos letras: los
+    prefijos de una sola no están indexados y recorrerían medio índice).
+    Devuelve None si no hay palabras.
+    """
+    terms = _TERM.findall(search_text or '')[:MAX_TERMS]
+    if not terms:
+        return None
+    query = ' '.join(f'"{term}"' for term in terms)
+    return query + '*' if len(terms[-1]) > 1 else query
+
+
+def _match(match):
+    return literal_column('transaction_fts').op('MATCH')(match)
+
+
+def _few_matches(match):
+    """True si la consulta FTS5 tiene como mucho FEW_MATCHES coincidencias
+    (de todos los usuarios). Con LIMIT, contar cuesta lo mismo siempre."""
+    limited = select(transaction_fts.c.rowid).where(_match(match)).limit(FEW_MATCHES + 1).subquery()
+    return db.session.execute(select(func.count()).select_from(limited)).scalar() <= FEW_MATCHES
+
+
+def search_query(user_id, search_text=None, category_id=None, date_from=None, date_to=None,
+                 amount_min=None, amount_max=None, ranked=False):
+    """Consulta con las mismas columnas que los listados de movimientos.
+
+    date_to es inclusivo (todo ese día). Los importes se comparan en valor
+    absoluto: entre 10 y 50 encuentra tanto un gasto de -30 como un ingreso
+    de 30. Con ranked=True sale ya ordenada por relevancia; si no, se
+    ordena por fecha al paginar. Devuelve None si el texto no contiene
+    ninguna palabra buscable.
+    """
+    query = db.session.query(
+        Transaction.id, Transaction.date, Transaction.description,
+        Transaction.amount, Category.name.label('category_name')
+    ).outerjoin(Category, Transaction.category_id == Category.id)
+    user_filter = Transaction.user_id == user_id
+
+    if search_text:
+        match = fts_query(search_text)
+        if match is None:
+            return None
+        if not fts_available():
+            for term in _TERM.findall(search_text)[:MAX_TERMS]:
+                query = query.filter(Transaction.description.ilike(f'%{term}%'))
+        elif ranked:
+            # Una sola pasada por el índice devuelve cada coincidencia con su
+            # puntuación (la columna oculta rank es bm25: más negativo, más relevante)
+            matches = select(transaction_fts.c.rowid, literal_column('rank').label('rank')).where(
+                _match(match)).subquery()
+            query = query.join(matches, matches.c.rowid == Transaction.id).order_by(
+                matches.c.rank, Transaction.date.desc(), Transaction.id.desc())
+        else:
+            # Con muchas coincidencias, SQLite recorre los movimientos del
+            # usuario por el índice (user_id, date) y para al llenar la página.
+            # Con pocas, ese recorrido podría leer todos sus movimientos sin
+            # encontrar nada: es mejor ir de cada coincidencia a su fila por la
+            # clave primaria. "user_id + 0" impide usar el índice de usuario y
+            # obliga a SQLite a elegir ese camino.
+            query = query.filter(Transaction.id.in_(select(transaction_fts.c.rowid).where(_match(match))))
+            if _few_matches(match):
+                user_filter = Transaction.user_id + 0 == user_id
+
+    query = query.filter(user_filter)
+    if ranked and not (search_text and fts_available()):
+        # Sin texto (o sin FTS5) no hay puntuación: por fecha
+        query = query.order_by(Transaction.date.desc(), Transaction.id.desc())
+    if category_id:
+        query = query.filter(Transaction.category_id == category_id)
+    if date_from:
+        query = query.filter(Transaction.date >= date_from)
+    if date_to:
+        query = query.filter(Transaction.date < date_to + timedelta(days=1))
+    if amount_min is not None:
+        query = query.filter(func.abs(Transaction.amount) >= amount_min)
+    if amount_max is not None:
+        query = query.filter(func.abs(Transaction.amount) <= amount_max)
+    return query
+
+
+def offset_page(query, offset=0, per_page=50):
+    """Página de una consulta ya ordenada: (filas, siguiente offset o None).
+
+    Solo para la ordenación por relevancia, que no admite cursor por fecha;
+    como OFFSET se encarece con cada página, se corta en MAX_RELEVANCE_RESULTS.
+    """
+    rows = query.offset(offset).limit(per_page + 1).all()
+    next_offset = offset + per_page
+    if len(rows) <= per_page or next_offset >= MAX_RELEVANCE_RESULTS:
+        return rows[:per_page], None
+    return rows[:per_page], next_offset
@@ -0,0 +1,24 @@
+# app/text.py
+# Normalización de textos para comparar descripciones y nombres: la usan la
+# importación de extractos (app/imports.py) y la categorización automática
+# (app/categorizer.py).
+import re
+import unicodedata
+
+_WORD = re.compile(r'[^\W\d_]+')
+
+
+def normalize(text):
+    """Minúsculas, sin acentos y con los espacios colapsados (para comparar)."""
+    text = text or ''
+    if text.isascii():
+        return ' '.join(text.lower().split())
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(text.lower().split())
+
+
+def words(text):
+    """Palabras normalizadas, sin números ni signos: 'COMPRA 1234 Mercadoña'
+    da ['compra', 'mercadona']."""
+    return _WORD.findall(normalize(text))
@@ -0,0 +1,102 @@
+# app/versions.py
+# Sellos de versión por usuario, compartidos entre procesos.
+#
+# Cada proceso de gunicorn (y los comandos CLI) guarda sus propias cachés en
+# memoria. Para saber si una entrada sigue siendo válida comparamos la
+# versión con la que se guardó con el sello actual del usuario, que es un
+# fichero pequeño junto a la base de datos: leerlo no cuesta ninguna consulta.
+# Cualquier proceso que cambie datos del usuario escribe un sello nuevo y
+# todas las cachés de todos los procesos quedan invalidadas a la vez.
+import os
+import time
+import uuid
+from collections import OrderedDict
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from app import app, db
+
+# Sello que devolvemos cuando un usuario todavía no ha cambiado nunca
+INITIAL_VERSION = '0'
+# Ámbitos con sello propio: de cuáles depende cada caché lo decide ella
+SCOPES = ('transactions', 'categories', 'budgets', 'recurring', 'rules', 'auth')
+
+
+def _stamp_path(user_id, scope):
+    return os.path.join(app.config['VERSION_STAMPS_DIR'], f'{user_id}.{scope}')
+
+
+def get_version(user_id, scope):
+    """Versión actual de un ámbito ('categories', ...) de un usuario."""
+    try:
+        with open(_stamp_path(user_id, scope)) as stamp:
+            return stamp.read() or INITIAL_VERSION
+    except FileNotFoundError:
+        return INITIAL_VERSION
+
+
+def data_version(user_id, *scopes):
+    """Versión combinada de varios ámbitos: cambia si cambia cualquiera de ellos."""
+    return '.'.join(get_version(user_id, scope) for scope in scopes)
+
+
+def bump_version(user_id, *scopes):
+    """Escribe un sello nuevo para los ámbitos indicados."""
+    os.makedirs(app.config['VERSION_STAMPS_DIR'], exist_ok=True)
+    for scope in scopes:
+        path = _stamp_path(user_id, scope)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as stamp:
+            stamp.write(uuid.uuid4().hex)
+        # os.replace es atómico: otro proceso lee el sello viejo o el nuevo
+        os.replace(tmp_path, path)
+
+
+def mark_changed(user_id, *scopes):
+    """Programa el cambio de versión para cuando la sesión haga commit.
+
+    Si cambiáramos el sello antes del commit, otro proceso podría volver a
+    llenar su caché con los datos antiguos usando ya la versión nueva.
+    """
+    pending = db.session.info.setdefault('changed_versions', set())
+    pending.update((user_id, scope) for scope in scopes)
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_after_commit(session):
+    for user_id, scope in session.info.pop('changed_versions', ()):
+        bump_version(user_id, scope)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_after_rollback(session):
+    session.info.pop('changed_versions', None)
+
+
+class VersionedCache:
+    """Caché LRU en memoria cuyas entradas se guardan junto a su versión.
+
+    Con max_age (segundos), además, una entrada se vuelve a cargar pasado
+    ese tiempo aunque su versión no haya cambiado.
+    """
+
+    def __init__(self, max_entries=1024, max_age=None):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._entries = OrderedDict()
+
+    def get_or_load(self, key, version, loader):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version and (
+                self.max_age is None or time.monotonic() - entry[2] < self.max_age):
+            self._entries.move_to_end(key)
+            return entry[1]
+
+        value = loader()
+        self._entries[key] = (version, value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self._entries.clear()
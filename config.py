@@ -24,3 +24,120 @@ class Config:
 
     #Configuración explicita del modo debug. siempre false a menos que se indique en el export
     DEBUG = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
+
+    # Número de movimientos por página en el dashboard y en los informes.
+    TRANSACTIONS_PER_PAGE = int(os.environ.get('TRANSACTIONS_PER_PAGE', 50))
+
+    # Directorio de los sellos de versión por usuario (ver app/versions.py).
+    # Lo comparten todos los procesos de gunicorn y los comandos CLI.
+    VERSION_STAMPS_DIR = os.environ.get('VERSION_STAMPS_DIR') or \
+        os.path.join(basedir, 'instance', 'versions')
+
+    # Número máximo de usuarios con las categorías en caché por proceso.
+    CATEGORY_CACHE_SIZE = int(os.environ.get('CATEGORY_CACHE_SIZE', 1024))
+    # Y con el modelo de categorización automática (ver app/categorizer.py).
+    CATEGORIZER_CACHE_SIZE = int(os.environ.get('CATEGORIZER_CACHE_SIZE', 256))
+    # Y con previsiones de tesorería (una por usuario y horizonte, ver app/forecast.py).
+    FORECAST_CACHE_SIZE = int(os.environ.get('FORECAST_CACHE_SIZE', 256))
+    # Y con el usuario de la sesión (ver app/auth.py), que además se vuelve a
+    # leer de la base de datos pasados USER_CACHE_TTL segundos.
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1024))
+    USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 300))
+
+    # Fragmentos ya renderizados del dashboard y los informes (ver
+    # app/fragments.py): memoria máxima por proceso, en bytes, y directorio
+    # opcional para compartirlos entre procesos. En disco se borran los que
+    # llevan FRAGMENT_CACHE_MAX_AGE segundos sin usarse.
+    FRAGMENT_CACHE_ENABLED = os.environ.get('FRAGMENT_CACHE_ENABLED', 'True').lower() == 'true'
+    FRAGMENT_CACHE_BYTES = int(os.environ.get('FRAGMENT_CACHE_BYTES', 16 * 1024 * 1024))
+    FRAGMENT_CACHE_DIR = os.environ.get('FRAGMENT_CACHE_DIR') or None
+    FRAGMENT_CACHE_MAX_AGE = int(os.environ.get('FRAGMENT_CACHE_MAX_AGE', 24 * 3600))
+
+    # Perfil de SQLite que se aplica a cada conexión (ver app/database.py).
+    # WAL permite leer mientras otro proceso escribe; con WAL, synchronous
+    # NORMAL es seguro ante caídas de la aplicación. Los tamaños van en las
+    # unidades de SQLite: cache_size negativo son KiB, mmap_size son bytes.
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))  # milisegundos
+    SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE', -65536))  # 64 MiB
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 268435456))  # 256 MiB
+    SQLITE_TEMP_STORE = os.environ.get('SQLITE_TEMP_STORE', 'MEMORY')
+
+    # Reintentos de las escrituras que chocan con otro proceso
+    SQLITE_WRITE_RETRIES = int(os.environ.get('SQLITE_WRITE_RETRIES', 5))
+    SQLITE_RETRY_BACKOFF = float(os.environ.get('SQLITE_RETRY_BACKOFF', 0.05))  # segundos
+
+    # Instrumentación de SQL por petición (ver app/instrumentation.py).
+    # Desactivada por defecto: añade la cabecera Server-Timing y escribe un
+    # log de rendimiento aparte con lo que supere los umbrales.
+    PERF_INSTRUMENTATION = os.environ.get('PERF_INSTRUMENTATION', 'False').lower() == 'true'
+    PERF_LOG_FILE = os.environ.get('PERF_LOG_FILE') or '/var/log/contabilidad/perf.log'
+    PERF_SLOW_REQUEST_MS = float(os.environ.get('PERF_SLOW_REQUEST_MS', 500))
+    PERF_SLOW_QUERY_MS = float(os.environ.get('PERF_SLOW_QUERY_MS', 100))
+    # Repeticiones de la misma sentencia en una petición a partir de las que avisamos de un N+1
+    PERF_N_PLUS_ONE_THRESHOLD = int(os.environ.get('PERF_N_PLUS_ONE_THRESHOLD', 10))
+
+    # Métricas Prometheus en /metrics (ver app/metrics.py). METRICS_DIR es
+    # el directorio compartido por todos los procesos; METRICS_TOKEN, si se
+    # define, permite leer /metrics desde fuera con 'Authorization: Bearer'.
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'False').lower() == 'true'
+    METRICS_DIR = os.environ.get('METRICS_DIR') or os.path.join(basedir, 'instance', 'metrics')
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+    # Importación de extractos (ver app/imports.py): dónde esperan los
+    # ficheros subidos hasta que se confirman y cuánto tiempo como máximo.
+    IMPORT_DIR = os.environ.get('IMPORT_DIR') or os.path.join(basedir, 'instance', 'imports')
+    IMPORT_MAX_AGE = int(os.environ.get('IMPORT_MAX_AGE', 24 * 3600))  # segundos
+    # A partir de cuántos movimientos nuevos se importa en segundo plano (ver app/jobs.py)
+    IMPORT_BACKGROUND_ROWS = int(os.environ.get('IMPORT_BACKGROUND_ROWS', 20000))
+    # Tamaño máximo de cualquier petición (el extracto más grande que se puede subir)
+    MAX_CONTENT_LENGTH = int(os.environ.get('IMPORT_MAX_MB', 50)) * 1024 * 1024
+
+    # Trabajos en segundo plano (ver app/jobs.py), que ejecuta 'flask worker'.
+    # JOBS_DIR guarda los ficheros generados hasta que caducan (JOB_RETENTION).
+    JOBS_DIR = os.environ.get('JOBS_DIR') or os.path.join(basedir, 'instance', 'jobs')
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+    JOB_RETRY_BACKOFF = float(os.environ.get('JOB_RETRY_BACKOFF', 30))  # segundos, se dobla en cada intento
+    # Trabajos a la vez como máximo por tipo ('tipo=n,tipo=n') y por usuario
+    JOB_KIND_LIMITS = os.environ.get('JOB_KIND_LIMITS',
+                                     'export_csv=2,import_statement=1,rebuild_balances=1,rebuild_rollups=1')
+    JOB_USER_LIMIT = int(os.environ.get('JOB_USER_LIMIT', 1))
+    # Trabajos pendientes (en cola o en marcha) que puede acumular un usuario
+    JOB_USER_QUEUE_LIMIT = int(os.environ.get('JOB_USER_QUEUE_LIMIT', 5))
+    JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 1))  # segundos
+    JOB_HEARTBEAT = float(os.environ.get('JOB_HEARTBEAT', 5))  # segundos
+    # Un trabajo sin latido durante este tiempo se da por huérfano y se reintenta
+    JOB_STALE_AFTER = int(os.environ.get('JOB_STALE_AFTER', 600))  # segundos
+    JOB_RETENTION = int(os.environ.get('JOB_RETENTION', 7 * 24 * 3600))  # segundos
+
+    # Ficheros estáticos con huella y precomprimidos ('flask assets build', ver app/assets.py).
+    ASSETS_DIR = os.environ.get('ASSETS_DIR') or os.path.join(basedir, 'instance', 'assets')
+
+    # Ficheros de los años archivados ('flask archive', ver app/archive.py).
+    ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR') or os.path.join(basedir, 'instance', 'archive')
+
+    # Copias de seguridad ('flask backup', ver app/backups.py).
+    BACKUP_DIR = os.environ.get('BACKUP_DIR') or os.path.join(basedir, 'instance', 'backups')
+    # Se conservan las últimas BACKUP_KEEP y la primera de cada mes de los últimos BACKUP_KEEP_MONTHLY
+    BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', 14))
+    BACKUP_KEEP_MONTHLY = int(os.environ.get('BACKUP_KEEP_MONTHLY', 6))
+    # Páginas copiadas por paso y pausa entre pasos (segundos), para no frenar a los escritores
+    BACKUP_PAGES_PER_STEP = int(os.environ.get('BACKUP_PAGES_PER_STEP', 1024))
+    BACKUP_STEP_SLEEP = float(os.environ.get('BACKUP_STEP_SLEEP', 0.02))
+    # Reinicios por escrituras concurrentes antes de terminar la copia de un solo paso
+    BACKUP_MAX_RESTARTS = int(os.environ.get('BACKUP_MAX_RESTARTS', 3))
+
+    # Límite de intentos de inicio de sesión (ver app/ratelimit.py): cada IP
+    # y cada nombre de usuario tienen un cubo de *_BURST intentos que recupera
+    # uno cada *_REFILL segundos. Al vaciarse, bloqueo de LOGIN_BACKOFF
+    # segundos que se dobla con cada reincidencia hasta LOGIN_BACKOFF_MAX.
+    LOGIN_RATE_LIMIT = os.environ.get('LOGIN_RATE_LIMIT', 'True').lower() == 'true'
+    RATELIMIT_DB = os.environ.get('RATELIMIT_DB') or os.path.join(basedir, 'instance', 'ratelimit.db')
+    LOGIN_IP_BURST = int(os.environ.get('LOGIN_IP_BURST', 10))
+    LOGIN_IP_REFILL = float(os.environ.get('LOGIN_IP_REFILL', 6))  # segundos
+    LOGIN_USER_BURST = int(os.environ.get('LOGIN_USER_BURST', 5))
+    LOGIN_USER_REFILL = float(os.environ.get('LOGIN_USER_REFILL', 60))  # segundos
+    LOGIN_BACKOFF = float(os.environ.get('LOGIN_BACKOFF', 30))  # segundos
+    LOGIN_BACKOFF_MAX = float(os.environ.get('LOGIN_BACKOFF_MAX', 3600))  # segundos
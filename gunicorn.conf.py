@@ -0,0 +1,18 @@
+# gunicorn.conf.py
+# Ganchos de gunicorn para las métricas multiproceso (ver app/metrics.py).
+import glob
+import os
+from config import Config
+
+
+def on_starting(server):
+    # Los ficheros de una ejecución anterior tienen PIDs que ya no existen
+    for path in glob.glob(os.path.join(Config.METRICS_DIR, '*.db')):
+        os.remove(path)
+
+
+def child_exit(server, worker):
+    # Los valores acumulados del proceso se conservan; los indicadores "en vivo" se descartan
+    if Config.METRICS_ENABLED:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid, Config.METRICS_DIR)
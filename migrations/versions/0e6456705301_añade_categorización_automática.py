@@ -0,0 +1,95 @@
+"""Añade reglas de categorización e historial de categorías
+
+Revision ID: 0e6456705301
+Revises: 14e838c49293
+Create Date: 2026-10-18 19:10:52.847120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0e6456705301'
+down_revision = '14e838c49293'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('category_rule',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('category_id', sa.Integer(), nullable=False),
+    sa.Column('pattern', sa.String(length=64), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['category_id'], ['category.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('category_rule', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_category_rule_user_id'), ['user_id'], unique=False)
+
+    op.create_table('category_history',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('description', sa.String(length=140), nullable=False),
+    sa.Column('category_id', sa.Integer(), nullable=False),
+    sa.Column('count', sa.Integer(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['category_id'], ['category.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'description', 'category_id')
+    )
+
+    # Rellenamos el historial con las transacciones ya existentes
+    op.execute("""
+        INSERT INTO category_history (user_id, description, category_id, count)
+        SELECT user_id, coalesce(description, ''), category_id, count(*) FROM "transaction"
+        WHERE user_id IS NOT NULL AND category_id IS NOT NULL
+        GROUP BY user_id, coalesce(description, ''), category_id
+    """)
+
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    # Triggers: cualquier escritura (formularios, recurrentes, importaciones)
+    # actualiza el historial en la misma transacción.
+    add = """
+        INSERT INTO category_history (user_id, description, category_id, count)
+        VALUES (new.user_id, coalesce(new.description, ''), new.category_id, 1)
+        ON CONFLICT (user_id, description, category_id) DO UPDATE SET count = count + 1;
+    """
+    remove = """
+        UPDATE category_history SET count = count - 1
+        WHERE user_id = old.user_id AND description = coalesce(old.description, '')
+          AND category_id = old.category_id;
+        DELETE FROM category_history
+        WHERE user_id = old.user_id AND description = coalesce(old.description, '')
+          AND category_id = old.category_id AND count <= 0;
+    """
+    op.execute(f"""
+        CREATE TRIGGER category_history_insert AFTER INSERT ON "transaction"
+        WHEN new.user_id IS NOT NULL AND new.category_id IS NOT NULL BEGIN {add} END
+    """)
+    op.execute(f"""
+        CREATE TRIGGER category_history_delete AFTER DELETE ON "transaction"
+        WHEN old.user_id IS NOT NULL AND old.category_id IS NOT NULL BEGIN {remove} END
+    """)
+    op.execute(f"""
+        CREATE TRIGGER category_history_update_old AFTER UPDATE OF user_id, description, category_id
+        ON "transaction" WHEN old.user_id IS NOT NULL AND old.category_id IS NOT NULL BEGIN {remove} END
+    """)
+    op.execute(f"""
+        CREATE TRIGGER category_history_update_new AFTER UPDATE OF user_id, description, category_id
+        ON "transaction" WHEN new.user_id IS NOT NULL AND new.category_id IS NOT NULL BEGIN {add} END
+    """)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        for trigger in ('category_history_update_new', 'category_history_update_old',
+                        'category_history_delete', 'category_history_insert'):
+            op.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    op.drop_table('category_history')
+    with op.batch_alter_table('category_rule', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_category_rule_user_id'))
+
+    op.drop_table('category_rule')
@@ -0,0 +1,65 @@
+"""Añade la búsqueda de texto completo en las descripciones
+
+Revision ID: 14e838c49293
+Revises: 8c7d4fea9c21
+Create Date: 2026-10-18 18:02:37.215904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '14e838c49293'
+down_revision = '8c7d4fea9c21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Solo SQLite tiene FTS5; en otros motores la búsqueda usa LIKE (ver app/search.py)
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+
+    # Índice de contenido externo: guarda solo los términos, el texto sigue
+    # en "transaction". unicode61 con remove_diacritics 2 hace que "cafe"
+    # encuentre "Café"; prefix indexa los prefijos de 2 y 3 letras para que
+    # las búsquedas mientras se escribe ("merc*") no recorran todo el índice.
+    op.execute("""
+        CREATE VIRTUAL TABLE transaction_fts USING fts5(
+            description,
+            content='transaction', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3')
+    """)
+    # Los triggers lo mantienen al día con cualquier escritura, también las
+    # inserciones masivas de process-recurring y de las importaciones.
+    op.execute("""
+        CREATE TRIGGER transaction_fts_insert AFTER INSERT ON "transaction" BEGIN
+            INSERT INTO transaction_fts(rowid, description) VALUES (new.id, new.description);
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER transaction_fts_delete AFTER DELETE ON "transaction" BEGIN
+            INSERT INTO transaction_fts(transaction_fts, rowid, description)
+            VALUES ('delete', old.id, old.description);
+        END
+    """)
+    op.execute("""
+        CREATE TRIGGER transaction_fts_update AFTER UPDATE OF description ON "transaction" BEGIN
+            INSERT INTO transaction_fts(transaction_fts, rowid, description)
+            VALUES ('delete', old.id, old.description);
+            INSERT INTO transaction_fts(rowid, description) VALUES (new.id, new.description);
+        END
+    """)
+
+    # Indexamos las transacciones que ya existen
+    op.execute("INSERT INTO transaction_fts(transaction_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TRIGGER IF EXISTS transaction_fts_update')
+    op.execute('DROP TRIGGER IF EXISTS transaction_fts_delete')
+    op.execute('DROP TRIGGER IF EXISTS transaction_fts_insert')
+    op.execute('DROP TABLE IF EXISTS transaction_fts')
@@ -0,0 +1,54 @@
+"""Añade el resumen mensual por usuario y categoría
+
+Revision ID: 31563059c082
+Revises: 48dfbc4b80c2
+Create Date: 2026-10-18 11:40:07.918233
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '31563059c082'
+down_revision = '48dfbc4b80c2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('monthly_rollup',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('year', sa.Integer(), nullable=False),
+    sa.Column('month', sa.Integer(), nullable=False),
+    sa.Column('category_id', sa.Integer(), nullable=False),
+    sa.Column('income', sa.Numeric(precision=12, scale=2), server_default='0', nullable=False),
+    sa.Column('expense', sa.Numeric(precision=12, scale=2), server_default='0', nullable=False),
+    sa.Column('count', sa.Integer(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['category_id'], ['category.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'year', 'month', 'category_id')
+    )
+
+    # Rellenamos el resumen con las transacciones ya existentes
+    transaction = sa.table('transaction',
+        sa.column('user_id', sa.Integer), sa.column('category_id', sa.Integer),
+        sa.column('amount', sa.Numeric), sa.column('date', sa.DateTime))
+    rollup = sa.table('monthly_rollup',
+        sa.column('user_id'), sa.column('year'), sa.column('month'), sa.column('category_id'),
+        sa.column('income'), sa.column('expense'), sa.column('count'))
+    year = sa.extract('year', transaction.c.date)
+    month = sa.extract('month', transaction.c.date)
+    op.execute(rollup.insert().from_select(
+        ['user_id', 'year', 'month', 'category_id', 'income', 'expense', 'count'],
+        sa.select(
+            transaction.c.user_id, year, month, transaction.c.category_id,
+            sa.func.coalesce(sa.func.sum(sa.case((transaction.c.amount > 0, transaction.c.amount), else_=0)), 0),
+            sa.func.coalesce(sa.func.sum(sa.case((transaction.c.amount < 0, transaction.c.amount), else_=0)), 0),
+            sa.func.count()
+        ).where(transaction.c.category_id.isnot(None)).group_by(
+            transaction.c.user_id, year, month, transaction.c.category_id)))
+
+
+def downgrade():
+    op.drop_table('monthly_rollup')
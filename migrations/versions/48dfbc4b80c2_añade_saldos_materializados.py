@@ -0,0 +1,40 @@
+"""Añade saldos materializados a usuarios y categorías
+
+Revision ID: 48dfbc4b80c2
+Revises: 7dfb037d3067
+Create Date: 2026-10-18 10:12:31.402118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '48dfbc4b80c2'
+down_revision = '7dfb037d3067'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('balance', sa.Numeric(precision=12, scale=2), server_default='0', nullable=False))
+
+    with op.batch_alter_table('category', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('balance', sa.Numeric(precision=12, scale=2), server_default='0', nullable=False))
+
+    # Rellenamos los saldos con las transacciones ya existentes
+    op.execute(
+        'UPDATE "user" SET balance = COALESCE('
+        '(SELECT SUM(amount) FROM "transaction" WHERE "transaction".user_id = "user".id), 0)')
+    op.execute(
+        'UPDATE category SET balance = COALESCE('
+        '(SELECT SUM(amount) FROM "transaction" WHERE "transaction".category_id = category.id), 0)')
+
+
+def downgrade():
+    with op.batch_alter_table('category', schema=None) as batch_op:
+        batch_op.drop_column('balance')
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('balance')
@@ -0,0 +1,100 @@
+"""Los ids de las transacciones no se reutilizan (AUTOINCREMENT)
+
+Revision ID: 5b7e2f0c1a93
+Revises: 0e6456705301
+Create Date: 2026-10-18 21:40:12.503117
+
+"""
+import os
+import re
+import sqlite3
+from alembic import op
+from flask import current_app
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e2f0c1a93'
+down_revision = '0e6456705301'
+branch_labels = None
+depends_on = None
+
+
+def _archived_rows():
+    """{id: (user_id, date, amount)} de los años archivados (ver app/archive.py)."""
+    directory = current_app.config['ARCHIVE_DIR']
+    try:
+        names = [name for name in os.listdir(directory) if re.match(r'^transactions-\d{4}\.db$', name)]
+    except FileNotFoundError:
+        return {}
+    rows = {}
+    for name in names:
+        connection = sqlite3.connect(f'file:{os.path.join(directory, name)}?mode=ro', uri=True)
+        try:
+            rows.update((row[0], row[1:]) for row in connection.execute(
+                'SELECT id, user_id, date, amount FROM "transaction"'))
+        finally:
+            connection.close()
+    return rows
+
+
+def _rebuild(bind, table_sql):
+    # SQLite no permite cambiar la clave primaria: se copia la tabla a una
+    # nueva y se vuelven a crear sus índices y triggers (FTS, historial de
+    # categorías), que desaparecen con la tabla antigua.
+    dependents = bind.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE tbl_name = 'transaction' "
+        "AND type IN ('index', 'trigger') AND sql IS NOT NULL").scalars().all()
+    op.execute(table_sql.replace('CREATE TABLE "transaction"', 'CREATE TABLE transaction_new', 1))
+    op.execute('INSERT INTO transaction_new SELECT * FROM "transaction"')
+    op.execute('DROP TABLE "transaction"')
+    op.execute('ALTER TABLE transaction_new RENAME TO "transaction"')
+    for sql in dependents:
+        op.execute(sql)
+
+
+def upgrade():
+    # Sin AUTOINCREMENT, SQLite da a cada fila nueva el id más alto de la
+    # tabla + 1: al archivar los movimientos más recientes de un año, sus ids
+    # se vuelven a usar y chocan con los del archivo. Con AUTOINCREMENT el
+    # contador (sqlite_sequence) no baja nunca. Otros motores no reutilizan ids.
+    bind = op.get_bind()
+    if bind.dialect.name != 'sqlite':
+        return
+    table_sql = bind.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'transaction'").scalar()
+    if 'AUTOINCREMENT' in table_sql.upper():
+        return
+    table_sql = re.sub(r'\bid INTEGER NOT NULL( PRIMARY KEY)?,', 'id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,', table_sql, 1)
+    table_sql = re.sub(r'\s*PRIMARY KEY \(id\),', '', table_sql, 1)
+    _rebuild(bind, table_sql)
+
+    # El contador empieza por encima de todo lo que ya existe, archivado incluido
+    archived = _archived_rows()
+    op.execute('DELETE FROM sqlite_sequence WHERE name = \'transaction\'')
+    bind.exec_driver_sql(
+        'INSERT INTO sqlite_sequence (name, seq) '
+        'SELECT \'transaction\', max(coalesce(max(id), 0), ?) FROM "transaction"', (max(archived, default=0),))
+
+    # Los movimientos que ya recibieron el id de uno archivado reciben uno
+    # nuevo (los que son la misma fila, de un archivado interrumpido, no)
+    renumbered = 0
+    for row_id, user_id, date, amount in bind.exec_driver_sql(
+            'SELECT id, user_id, date, amount FROM "transaction"').all():
+        if row_id in archived and archived[row_id] != (user_id, date, amount):
+            bind.exec_driver_sql("UPDATE sqlite_sequence SET seq = seq + 1 WHERE name = 'transaction'")
+            bind.exec_driver_sql('UPDATE "transaction" SET id = (SELECT seq FROM sqlite_sequence '
+                                 'WHERE name = \'transaction\') WHERE id = ?', (row_id,))
+            renumbered += 1
+    if renumbered:
+        # El índice de texto completo va por id
+        op.execute("INSERT INTO transaction_fts(transaction_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'sqlite':
+        return
+    table_sql = bind.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'transaction'").scalar()
+    table_sql = table_sql.replace('PRIMARY KEY AUTOINCREMENT,', 'PRIMARY KEY,', 1)
+    _rebuild(bind, table_sql)
@@ -0,0 +1,32 @@
+"""Añade el vínculo entre transacciones y sus ocurrencias recurrentes
+
+Revision ID: 82f876b08df6
+Revises: ede8c445ad82
+Create Date: 2026-10-18 13:05:52.661409
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '82f876b08df6'
+down_revision = 'ede8c445ad82'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('transaction', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('recurring_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('occurrence_date', sa.Date(), nullable=True))
+        batch_op.create_foreign_key('fk_transaction_recurring_id', 'recurring_transaction', ['recurring_id'], ['id'], ondelete='SET NULL')
+        batch_op.create_index('uq_transaction_recurring_occurrence', ['recurring_id', 'occurrence_date'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('transaction', schema=None) as batch_op:
+        batch_op.drop_index('uq_transaction_recurring_occurrence')
+        batch_op.drop_constraint('fk_transaction_recurring_id', type_='foreignkey')
+        batch_op.drop_column('occurrence_date')
+        batch_op.drop_column('recurring_id')
@@ -0,0 +1,52 @@
+"""Añade las tablas de estado y puntos de control de process-recurring
+
+Revision ID: c2199798926e
+Revises: 82f876b08df6
+Create Date: 2026-10-18 14:02:17.305518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2199798926e'
+down_revision = '82f876b08df6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('recurring_run',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('run_date', sa.Date(), nullable=False),
+    sa.Column('shards', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=10), nullable=False),
+    sa.Column('started_at', sa.DateTime(), nullable=False),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('recurring_run', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_recurring_run_run_date'), ['run_date'], unique=False)
+
+    op.create_table('recurring_run_shard',
+    sa.Column('run_id', sa.Integer(), nullable=False),
+    sa.Column('shard', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=10), nullable=False),
+    sa.Column('last_schedule_id', sa.Integer(), nullable=False),
+    sa.Column('schedules', sa.Integer(), nullable=False),
+    sa.Column('posted', sa.Integer(), nullable=False),
+    sa.Column('skipped', sa.Integer(), nullable=False),
+    sa.Column('failed', sa.Integer(), nullable=False),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.ForeignKeyConstraint(['run_id'], ['recurring_run.id'], ),
+    sa.PrimaryKeyConstraint('run_id', 'shard')
+    )
+
+
+def downgrade():
+    op.drop_table('recurring_run_shard')
+    with op.batch_alter_table('recurring_run', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_recurring_run_run_date'))
+
+    op.drop_table('recurring_run')
@@ -0,0 +1,28 @@
+"""Añade el hash de importación de extractos a las transacciones
+
+Revision ID: ec8fe6744af0
+Revises: c2199798926e
+Create Date: 2026-10-18 16:20:41.118307
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ec8fe6744af0'
+down_revision = 'c2199798926e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('transaction', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('import_hash', sa.String(length=40), nullable=True))
+        batch_op.create_index('uq_transaction_user_id_import_hash', ['user_id', 'import_hash'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('transaction', schema=None) as batch_op:
+        batch_op.drop_index('uq_transaction_user_id_import_hash')
+        batch_op.drop_column('import_hash')
@@ -0,0 +1,34 @@
+"""Añade índices compuestos por usuario y fecha
+
+Revision ID: ede8c445ad82
+Revises: 31563059c082
+Create Date: 2026-10-18 12:21:44.530871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ede8c445ad82'
+down_revision = '31563059c082'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('transaction', schema=None) as batch_op:
+        batch_op.create_index('ix_transaction_user_id_date', ['user_id', 'date'], unique=False)
+        batch_op.create_index('ix_transaction_user_id_category_id_date', ['user_id', 'category_id', 'date'], unique=False)
+
+    with op.batch_alter_table('recurring_transaction', schema=None) as batch_op:
+        batch_op.create_index('ix_recurring_transaction_user_id_next_date', ['user_id', 'next_date'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('recurring_transaction', schema=None) as batch_op:
+        batch_op.drop_index('ix_recurring_transaction_user_id_next_date')
+
+    with op.batch_alter_table('transaction', schema=None) as batch_op:
+        batch_op.drop_index('ix_transaction_user_id_category_id_date')
+        batch_op.drop_index('ix_transaction_user_id_date')
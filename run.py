@@ -1,9 +1,10 @@
 # run.py
-from app import app, db
-from app.models import User, Transaction, RecurringTransaction # <-- Importar RecurringTransaction
-from datetime import datetime, date
-from dateutil.relativedelta import relativedelta
+from app import app, db, ledger, recurring, benchmark, jobs, backups, archive, assets
+from app.models import User, Transaction
+from datetime import date
 import click
+from flask.cli import AppGroup
+import os
 
 @app.shell_context_processor
 def make_shell_context():
@@ -11,35 +12,229 @@ def make_shell_context():
 
 # --- NUEVO COMANDO CLI ---
 @app.cli.command("process-recurring")
-def process_recurring_transactions():
+@click.option('--chunk-size', type=int, default=1000, show_default=True,
+              help='Recurrentes procesadas por bloque (un commit por bloque).')
+@click.option('--workers', type=int, default=1, show_default=True,
+              help='Procesos en paralelo; los usuarios se reparten entre ellos.')
+@click.option('--dry-run', is_flag=True, help='Muestra lo que se contabilizaría sin escribir nada.')
+def process_recurring_transactions(chunk_size, workers, dry_run):
     """Busca y procesa las transacciones recurrentes pendientes."""
-    today = date.today()
-    # Buscamos transacciones recurrentes cuya próxima fecha de ejecución es hoy o ya ha pasado
-    due_transactions = RecurringTransaction.query.filter(RecurringTransaction.next_date <= today).all()
-
-    click.echo(f"Se encontraron {len(due_transactions)} transacciones recurrentes para procesar.")
-
-    for rt in due_transactions:
-        # 1. Crear la transacción normal
-        new_transaction = Transaction(
-            description=rt.description,
-            amount=rt.amount,
-            date=datetime.combine(rt.next_date, datetime.min.time()),
-            category_id=rt.category_id,
-            user_id=rt.user_id
-        )
-        db.session.add(new_transaction)
-
-        # 2. Calcular la siguiente fecha de ejecución
-        current_next_date = rt.next_date
-        if rt.frequency == 'monthly':
-            rt.next_date = current_next_date + relativedelta(months=1)
-        elif rt.frequency == 'weekly':
-            rt.next_date = current_next_date + relativedelta(weeks=1)
-        elif rt.frequency == 'yearly':
-            rt.next_date = current_next_date + relativedelta(years=1)
-
-        click.echo(f"Procesada '{rt.description}'. Nueva fecha de ejecución: {rt.next_date.strftime('%Y-%m-%d')}")
+    recurring_run, results = recurring.run(date.today(), workers=workers, chunk_size=chunk_size,
+                                           dry_run=dry_run, log=click.echo)
 
-    db.session.commit()
+    if dry_run:
+        click.echo("Modo de prueba: no se ha escrito nada.")
+    for shard, stats in sorted(results.items()):
+        if stats is None:
+            click.echo(f"[shard {shard}] ha fallado; se reanudará en la próxima ejecución.")
+            continue
+        verb = 'se contabilizarían' if dry_run else 'contabilizadas'
+        click.echo(f"[shard {shard}] {stats['schedules']} recurrentes, {stats['posted']} transacciones {verb} "
+                   f"({stats['amount']:.2f} €), {stats['skipped']} ya existentes, "
+                   f"{stats['failed']} con error, {stats['invalid']} inválidas. "
+                   f"{stats['seconds']:.2f} s ({stats['rows_per_second']:.0f} transacciones/s).")
+
+    if recurring_run is not None:
+        click.echo(f"Ejecución {recurring_run.id}: {recurring_run.status}.")
+        if recurring_run.status != 'done':
+            raise SystemExit(1)
     click.echo("Proceso finalizado.")
+
+@app.cli.command("rebuild-balances")
+@click.option('--user-id', type=int, default=None, help='Recalcular solo este usuario.')
+@click.option('--background', is_flag=True, help="Encolarlo para 'flask worker' en lugar de hacerlo ahora.")
+def rebuild_balances(user_id, background):
+    """Recalcula los saldos materializados a partir de las transacciones."""
+    if background:
+        _enqueue('rebuild_balances', only_user_id=user_id)
+        return
+    ledger.rebuild_balances(user_id)
+    db.session.commit()
+    click.echo("Saldos recalculados.")
+
+@app.cli.command("rebuild-rollups")
+@click.option('--user-id', type=int, default=None, help='Recalcular solo este usuario.')
+@click.option('--background', is_flag=True, help="Encolarlo para 'flask worker' en lugar de hacerlo ahora.")
+def rebuild_rollups(user_id, background):
+    """Regenera el resumen mensual a partir de las transacciones."""
+    if background:
+        _enqueue('rebuild_rollups', only_user_id=user_id)
+        return
+    ledger.rebuild_rollups(user_id)
+    db.session.commit()
+    click.echo("Resumen mensual regenerado.")
+
+def _enqueue(kind, **params):
+    # Son trabajos de administración: sin usuario dueño ni límite de cola
+    job = jobs.enqueue(kind, **params)
+    db.session.commit()
+    click.echo(f"Trabajo {job.id} en cola.")
+
+@app.cli.command("worker")
+@click.option('--processes', type=int, default=None,
+              help='Trabajos en paralelo (por defecto JOB_WORKERS).')
+@click.option('--burst', is_flag=True, help='Terminar cuando no queden trabajos en cola.')
+def run_worker(processes, burst):
+    """Ejecuta los trabajos en segundo plano (exportaciones, importaciones...)."""
+    jobs.work(processes=processes, burst=burst, log=click.echo)
+    click.echo("Worker detenido.")
+
+@app.cli.command("verify-rollups")
+@click.option('--user-id', type=int, default=None, help='Comprobar solo este usuario.')
+def verify_rollups(user_id):
+    """Comprueba que el resumen mensual coincide con las transacciones."""
+    differences = ledger.verify_rollups(user_id)
+    for key, expected, stored in differences:
+        click.echo(f"Diferencia en (usuario, año, mes, categoría)={key}: esperado {expected}, guardado {stored}")
+    if differences:
+        click.echo(f"{len(differences)} diferencias. Ejecuta 'flask rebuild-rollups' para corregirlas.")
+        raise SystemExit(1)
+    click.echo("El resumen mensual está al día.")
+
+@app.cli.command("backup")
+@click.option('--dest', type=click.Path(file_okay=False), default=None,
+              help='Directorio de las copias (por defecto BACKUP_DIR).')
+@click.option('--keep', type=int, default=None, help='Copias recientes a conservar (por defecto BACKUP_KEEP).')
+@click.option('--list', 'list_only', is_flag=True, help='Solo lista las copias del manifiesto.')
+def backup_database(dest, keep, list_only):
+    """Copia verificada y comprimida de la base de datos, sin parar la aplicación."""
+    directory = dest or app.config['BACKUP_DIR']
+    if list_only:
+        for snapshot in backups.load_manifest(directory)['snapshots']:
+            click.echo(f"{snapshot['file']}  {snapshot['created_at']}  {snapshot['size'] / 1048576:.1f} MB  "
+                       f"revisión {snapshot['revision']}")
+        return
+    try:
+        entry = backups.backup(directory, keep=keep, log=click.echo)
+    except backups.BackupError as error:
+        raise click.ClickException(str(error))
+    click.echo(f"Copia {entry['file']} en {directory}: {entry['db_size'] / 1048576:.1f} MB "
+               f"({entry['size'] / 1048576:.1f} MB comprimida) en {entry['seconds']} s, integridad ok.")
+
+@app.cli.command("restore")
+@click.argument('snapshot', type=click.Path(dir_okay=False))
+@click.option('--check-only', is_flag=True, help='Solo verifica la copia, sin restaurarla.')
+@click.option('--yes', is_flag=True, help='No pedir confirmación.')
+def restore_database(snapshot, check_only, yes):
+    """Verifica una copia y sustituye con ella la base de datos actual."""
+    try:
+        if check_only:
+            os.remove(backups.verify(snapshot, log=click.echo))
+            return
+        if not yes:
+            click.confirm(f"Se sustituirá {backups.database_path()} por {snapshot}. ¿Continuar?", abort=True)
+        revision = backups.restore(snapshot, log=click.echo)
+    except backups.BackupError as error:
+        raise click.ClickException(str(error))
+    click.echo(f"Base de datos restaurada (revisión {revision}). Si no es la actual, ejecuta 'flask db upgrade'.")
+
+@app.cli.command("archive")
+@click.option('--before', type=int, required=True, help='Archivar los movimientos de los años anteriores a este.')
+@click.option('--vacuum', is_flag=True,
+              help='Compactar después app.db (bloquea la base de datos mientras dura).')
+def archive_transactions(before, vacuum):
+    """Mueve los movimientos de años cerrados a ficheros por año."""
+    try:
+        moved = archive.archive_before(before, log=click.echo)
+    except archive.ArchiveError as error:
+        raise click.ClickException(str(error))
+    for year, count in moved.items():
+        click.echo(f"{year}: {count} movimientos en {archive.archive_path(year)}")
+    if not moved:
+        click.echo("No hay movimientos que archivar.")
+    if vacuum:
+        db.session.execute(db.text('VACUUM'))
+        click.echo("app.db compactada.")
+
+assets_cli = AppGroup('assets', help='Ficheros estáticos con huella y precomprimidos.')
+
+@assets_cli.command("build")
+@click.option('--quiet', is_flag=True, help='No listar los ficheros.')
+def build_assets(quiet):
+    """Genera ASSETS_DIR a partir de app/static."""
+    manifest = assets.build(log=None if quiet else click.echo)
+    encodings = 'br y gzip' if assets.brotli is not None else 'gzip y deflate; instala brotli para tener br'
+    click.echo(f"{len(manifest['files'])} ficheros en {app.config['ASSETS_DIR']} ({encodings}).")
+
+@assets_cli.command("clean")
+def clean_assets():
+    """Borra ASSETS_DIR: las páginas vuelven a enlazar /static."""
+    assets.clean()
+    click.echo(f"{app.config['ASSETS_DIR']} borrado.")
+
+app.cli.add_command(assets_cli)
+
+@app.cli.command("seed-benchmark")
+@click.option('--users', type=int, default=10, show_default=True, help='Usuarios sintéticos a crear.')
+@click.option('--transactions', type=int, default=100000, show_default=True, help='Transacciones por usuario.')
+@click.option('--years', type=int, default=5, show_default=True, help='Años de historial a repartir.')
+@click.option('--recurring', 'recurring_per_user', type=int, default=20, show_default=True,
+              help='Recurrentes por usuario.')
+@click.option('--seed', 'seed_value', type=int, default=42, show_default=True,
+              help='Semilla: la misma semilla genera los mismos datos.')
+def seed_benchmark(users, transactions, years, recurring_per_user, seed_value):
+    """Genera datos sintéticos para medir el rendimiento."""
+    user_ids = benchmark.seed(users=users, transactions_per_user=transactions, years=years,
+                              recurring_per_user=recurring_per_user, seed_value=seed_value, log=click.echo)
+    click.echo(f"{len(user_ids)} usuarios creados (contraseña '{benchmark.BENCHMARK_PASSWORD}').")
+
+@app.cli.command("benchmark")
+@click.option('--username', default=f'{benchmark.BENCHMARK_USER_PREFIX}0', show_default=True,
+              help='Usuario con el que se recorren las rutas.')
+@click.option('--iterations', type=int, default=20, show_default=True, help='Peticiones por ruta.')
+@click.option('--output', type=click.Path(dir_okay=False), default='benchmark.json', show_default=True,
+              help='Fichero JSON donde guardar los resultados.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Resultados anteriores con los que comparar.')
+@click.option('--threshold', type=float, default=0.2, show_default=True,
+              help='Empeoramiento relativo a partir del cual hay regresión.')
+@click.option('--skip-recurring', is_flag=True, help='No medir process-recurring.')
+def run_benchmark(username, iterations, output, baseline, threshold, skip_recurring):
+    """Mide latencia, consultas y memoria de las rutas principales."""
+    results = benchmark.run_benchmarks(username, iterations=iterations,
+                                       include_recurring=not skip_recurring, log=click.echo)
+    benchmark.save(results, output)
+    click.echo(f"Resultados guardados en {output}.")
+    if baseline:
+        regressions = benchmark.compare(results, benchmark.load(baseline), threshold)
+        for name, metric, before, now in regressions:
+            click.echo(f"Regresión en {name}: {metric} {before} -> {now}")
+        if regressions:
+            raise SystemExit(1)
+        click.echo("Sin regresiones respecto a la referencia.")
+
+@app.cli.command("benchmark-concurrency")
+@click.option('--username', default=f'{benchmark.BENCHMARK_USER_PREFIX}0', show_default=True,
+              help='Usuario sobre el que se lee y se escribe.')
+@click.option('--writers', type=int, default=3, show_default=True, help='Procesos que escriben.')
+@click.option('--readers', type=int, default=3, show_default=True, help='Procesos que leen.')
+@click.option('--seconds', type=int, default=10, show_default=True, help='Duración de la prueba.')
+def run_benchmark_concurrency(username, writers, readers, seconds):
+    """Lectores y escritores simultáneos en varios procesos; falla si hay bloqueos."""
+    results = benchmark.stress(username, writers=writers, readers=readers, seconds=seconds, log=click.echo)
+    click.echo(f"Modo de diario: {results['journal_mode']}.")
+    if results['writer']['errors'] or results['reader']['errors']:
+        click.echo("Ha habido errores de bloqueo.")
+        raise SystemExit(1)
+    click.echo("Sin errores de bloqueo.")
+
+@app.cli.command("benchmark-login")
+@click.option('--username', default=f'{benchmark.BENCHMARK_USER_PREFIX}0', show_default=True,
+              help='Usuario que inicia sesión legítimamente; se ataca a los demás usuarios de prueba.')
+@click.option('--attackers', type=int, default=3, show_default=True, help='Procesos atacantes.')
+@click.option('--rate', type=float, default=20, show_default=True,
+              help='Intentos por segundo de cada proceso atacante.')
+@click.option('--seconds', type=int, default=10, show_default=True, help='Duración de cada fase.')
+@click.option('--no-limit', is_flag=True, help='Sin límite de intentos, para comparar.')
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help='Fichero JSON donde guardar los resultados.')
+def run_benchmark_login(username, attackers, rate, seconds, no_limit, output):
+    """Latencia de los inicios de sesión legítimos durante un ataque de fuerza bruta."""
+    results = benchmark.login_attack(username, attackers=attackers, rate=rate, seconds=seconds,
+                                     rate_limit=not no_limit, log=click.echo)
+    if output:
+        benchmark.save(results, output)
+        click.echo(f"Resultados guardados en {output}.")
+    baseline, attack = results['baseline']['legit'], results['attack']['legit']
+    click.echo(f"p95 de los inicios de sesión legítimos: {baseline['p95_ms']} ms sin ataque, "
+               f"{attack['p95_ms']} ms con ataque.")
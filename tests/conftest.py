@@ -0,0 +1,34 @@
+# tests/conftest.py
+# La configuración (config.py) se lee del entorno al importar la aplicación:
+# antes de importarla, todo apunta a un directorio temporal.
+import os
+import shutil
+import tempfile
+import pytest
+
+_tmp = tempfile.mkdtemp(prefix='contabilidad-tests-')
+os.environ.update(
+    DATABASE_URL=f'sqlite:///{os.path.join(_tmp, "app.db")}',
+    ARCHIVE_DIR=os.path.join(_tmp, 'archive'),
+    VERSION_STAMPS_DIR=os.path.join(_tmp, 'versions'),
+    JOBS_DIR=os.path.join(_tmp, 'jobs'),
+    IMPORT_DIR=os.path.join(_tmp, 'imports'),
+    RATELIMIT_DB=os.path.join(_tmp, 'ratelimit.db'),
+    # Sin debug, la aplicación escribe su log en /var/log/contabilidad
+    FLASK_DEBUG='true',
+)
+
+from flask_migrate import upgrade  # noqa: E402
+from app import app as flask_app, db  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def app():
+    """La aplicación con el esquema de las migraciones (índices, triggers y
+    FTS incluidos) en una base de datos SQLite temporal."""
+    with flask_app.app_context():
+        upgrade(directory=os.path.join(os.path.dirname(os.path.dirname(__file__)), 'migrations'))
+        yield flask_app
+        db.session.remove()
+        db.engine.dispose()
+    shutil.rmtree(_tmp, ignore_errors=True)
@@ -0,0 +1,79 @@
+# tests/test_query_plans.py
+# Las consultas de cada petición deben ir por los índices compuestos por
+# usuario (ver app/periods.py y la migración de los índices). Se comprueba
+# con EXPLAIN QUERY PLAN: si alguien cambia una consulta o un índice y SQLite
+# pasa a recorrer la tabla entera (SCAN), el test falla.
+from datetime import datetime
+import pytest
+from sqlalchemy import select, text
+from app import db, exports
+from app.models import RecurringTransaction, Transaction
+from app.routes import transaction_feed_query
+from app.search import search_query
+
+
+def query_plan(statement):
+    """Líneas de detalle de EXPLAIN QUERY PLAN para una sentencia SQLAlchemy."""
+    if hasattr(statement, 'statement'):
+        statement = statement.statement
+    sql = statement.compile(db.engine, compile_kwargs={'literal_binds': True})
+    return [row[3] for row in db.session.execute(text(f'EXPLAIN QUERY PLAN {sql}'))]
+
+
+def assert_uses_index(plan, table, index):
+    steps = [step for step in plan if step.split()[1:2] == [table]]
+    assert steps, plan
+    assert all(index in step for step in steps), plan
+    assert not any(step.startswith('SCAN') for step in steps), plan
+
+
+@pytest.mark.parametrize('year, month', [(2025, 3), (2025, 0), (0, 0)])
+def test_feed_uses_user_date_index(app, year, month):
+    # Igual que keyset_page: más recientes primero, una fila de más
+    query = transaction_feed_query(1, year, month).order_by(
+        Transaction.date.desc(), Transaction.id.desc()).limit(51)
+    plan = query_plan(query)
+    assert_uses_index(plan, 'transaction', 'ix_transaction_user_id_date')
+    # El orden sale del índice, sin ordenar en una tabla temporal
+    assert not any('TEMP B-TREE' in step for step in plan), plan
+
+
+def test_feed_next_page_uses_user_date_index(app):
+    query = transaction_feed_query(1, 2025, 0).filter(
+        Transaction.date < datetime(2025, 6, 1)).order_by(
+        Transaction.date.desc(), Transaction.id.desc()).limit(51)
+    assert_uses_index(query_plan(query), 'transaction', 'ix_transaction_user_id_date')
+
+
+@pytest.mark.parametrize('year, month', [(2025, 3), (2025, 0), (0, 0)])
+def test_export_uses_user_date_index(app, year, month):
+    plan = query_plan(exports.export_statement(1, year, month))
+    assert_uses_index(plan, 'transaction', 'ix_transaction_user_id_date')
+    assert not any('TEMP B-TREE' in step for step in plan), plan
+
+
+def test_category_filter_uses_user_category_date_index(app):
+    # Búsqueda filtrada por categoría, sin texto
+    plan = query_plan(search_query(1, None, 3))
+    assert_uses_index(plan, 'transaction', 'ix_transaction_user_id_category_id_date')
+
+
+def test_category_in_use_uses_user_category_date_index(app):
+    # Comprobación de delete_category antes de borrar una categoría
+    plan = query_plan(select(Transaction.query.filter_by(user_id=1, category_id=3).exists()))
+    assert_uses_index(plan, 'transaction', 'ix_transaction_user_id_category_id_date')
+
+
+def test_recurring_due_uses_user_next_date_index(app):
+    # Recurrentes de un usuario que vencen antes de una fecha
+    query = select(RecurringTransaction.id, RecurringTransaction.next_date).where(
+        RecurringTransaction.user_id == 1, RecurringTransaction.next_date < datetime(2025, 3, 1))
+    assert_uses_index(query_plan(query), 'recurring_transaction', 'ix_recurring_transaction_user_id_next_date')
+
+
+def test_recurring_list_uses_user_next_date_index(app):
+    # Página de recurrentes: las del usuario por fecha de la próxima ejecución
+    query = RecurringTransaction.query.filter_by(user_id=1).order_by(RecurringTransaction.next_date.asc())
+    plan = query_plan(query)
+    assert_uses_index(plan, 'recurring_transaction', 'ix_recurring_transaction_user_id_next_date')
+    assert not any('TEMP B-TREE' in step for step in plan), plan